@@ -3,11 +3,10 @@ import datetime
 from uuid import UUID
 
 from fastapi import Depends, HTTPException, Request, status
-from sqlalchemy.orm import Session
 from jose import JWTError, jwt
-from app.database import SessionLocal
+from app.database import SessionLocal, AsyncSessionLocal, AnySession
 
-from app import schemas, crud, security
+from app import schemas, crud, security, database, principal_cache, hashing
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +21,14 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+get_session = get_async_db if database.DATABASE_MODE == "async" else get_db
+
+
 # JSON Web Token (JWT) Functions
 
 
@@ -31,7 +38,7 @@ def generic_token_creation(
     """
     Creates a JWT
     """
-    logger.debug(f"{current_uuid} - Entered authenticate user function")
+    logger.debug("%s - Entered authenticate user function", current_uuid)
     to_encode = data.copy()
     expire = datetime.datetime.utcnow() + expires_delta
     to_encode.update({"exp": expire})
@@ -39,33 +46,99 @@ def generic_token_creation(
         encoded_jwt = jwt.encode(
             to_encode, security.SECRET_KEY, algorithm=security.ALGORITHM
         )
-        logger.info(f"{current_uuid} - Created JWT")
+        logger.info("%s - Created JWT", current_uuid)
     else:
         encoded_jwt = jwt.encode(
             to_encode, security.JWT_REFRESH_SECRET_KEY, algorithm=security.ALGORITHM
         )
-        logger.info(f"{current_uuid} - Created JWT Refresh Token")
-    logger.debug(f"{current_uuid} - Exiting authenticate user function")
+        logger.info("%s - Created JWT Refresh Token", current_uuid)
+    logger.debug("%s - Exiting authenticate user function", current_uuid)
     return encoded_jwt
 
 
-def authenticate_user(current_uuid: UUID, db: Session, username: str, password: str):
+def create_token_pair(
+    current_uuid: UUID,
+    username: str,
+    user_id: int,
+    refresh_token_id: str,
+    family_id: str,
+):
+    """
+    Creates an access token and a refresh token, the refresh token carries its recorded ID (jti) and family (fam)
+    The access token also carries the users ID (uid), so requests can be rate limited per user without a query
+    """
+    return {
+        "access_token": generic_token_creation(
+            current_uuid=current_uuid,
+            data={"sub": username, "uid": user_id},
+            expires_delta=datetime.timedelta(
+                minutes=security.ACCESS_TOKEN_EXPIRE_MINUTES
+            ),
+            token_type="access",
+        ),
+        "refresh_token": generic_token_creation(
+            current_uuid=current_uuid,
+            data={"sub": username, "jti": refresh_token_id, "fam": family_id},
+            expires_delta=datetime.timedelta(
+                minutes=security.REFRESH_TOKEN_EXPIRE_MINUTES
+            ),
+            token_type="refresh",
+        ),
+        "token_type": "bearer",
+    }
+
+
+def refresh_token_expiry():
+    return datetime.datetime.utcnow() + datetime.timedelta(
+        minutes=security.REFRESH_TOKEN_EXPIRE_MINUTES
+    )
+
+
+def decode_refresh_token(current_uuid: UUID, token: str):
+    """
+    Validates a refresh token and returns its ID and family
+
+    Raises:
+        HTTPException: A 401 if the token is invalid, expired or was issued before refresh tokens were recorded
+    """
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(
+            token, security.JWT_REFRESH_SECRET_KEY, algorithms=[security.ALGORITHM]
+        )
+    except JWTError:
+        logger.info("%s - Failed to decode refresh token", current_uuid)
+        raise credentials_exception
+    token_id, family_id = payload.get("jti"), payload.get("fam")
+    if not isinstance(token_id, str) or not isinstance(family_id, str):
+        logger.info("%s - Refresh token has no ID or family", current_uuid)
+        raise credentials_exception
+    return token_id, family_id
+
+
+async def authenticate_user(
+    current_uuid: UUID, db: AnySession, username: str, password: str
+):
     """
     Checks if a user exists with credentials provided
     """
-    logger.debug(f"{current_uuid} - Entered authenticate user function")
-    user = crud.get_user_by_username(
-        current_uuid=current_uuid, db=db, username=username
+    logger.debug("%s - Entered authenticate user function", current_uuid)
+    user = await database.run_in_session(
+        db, crud.get_user_by_username, current_uuid=current_uuid, username=username
     )
-    logger.debug(f"{current_uuid} - Retrived users details")
+    logger.debug("%s - Retrived users details", current_uuid)
     if not user:
-        logger.info(f"{current_uuid} - User does not exist")
+        logger.info("%s - User does not exist", current_uuid)
         return False
-    if not security.verify_password(password, user.hashed_password):
-        logger.info(f"{current_uuid} - Users password is incorrect")
+    if not await hashing.verify_password(password, user.hashed_password):
+        logger.info("%s - Users password is incorrect", current_uuid)
         return False
-    logger.info(f"{current_uuid} - User authenticated")
-    logger.debug(f"{current_uuid} - Exiting authenticate user function")
+    logger.info("%s - User authenticated", current_uuid)
+    logger.debug("%s - Exiting authenticate user function", current_uuid)
     return user
 
 
@@ -73,43 +146,62 @@ def authenticate_user(current_uuid: UUID, db: Session, username: str, password:
 # Won't work in tests due to quirks in the security of JWTS
 
 
-def get_current_user(
+async def get_current_user(
     request: Request,
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_session),
     token: str = Depends(security.reuseable_oauth),
 ):  # pragma: no cover
     """
-    Gets the current logged in user entity based on the JWT (token) passed in
+    Gets the current logged in user based on the JWT (token) passed in.
+    Tokens already validated by this worker are answered from the principal cache, without decoding or a query.
     """
     current_uuid = request.state.uuid
-    logger.debug(f"{current_uuid} - Entered get current user function")
+    logger.debug("%s - Entered get current user function", current_uuid)
+    cached_user = principal_cache.cache.get(token)
+    if cached_user is not None:
+        logger.debug(
+            "%s - Retrived current USER(ID=%s USERNAME=%s) from cache",
+            current_uuid,
+            cached_user.id,
+            cached_user.username,
+        )
+        return cached_user
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        logger.debug(f"{current_uuid} - Decoding JWT")
+        logger.debug("%s - Decoding JWT", current_uuid)
         payload = jwt.decode(
             token, security.SECRET_KEY, algorithms=[security.ALGORITHM]
         )
-        logger.debug(f"{current_uuid} - Getting username from JWT")
+        logger.debug("%s - Getting username from JWT", current_uuid)
         username: str = payload.get("sub")
         if username is None:
-            logger.info(f"{current_uuid} - JWT doesn't contain username")
+            logger.info("%s - JWT doesn't contain username", current_uuid)
             raise credentials_exception
         token_data = schemas.TokenData(username=username)
     except JWTError:
-        logger.info(f"{current_uuid} - Failed to decode JWT")
+        logger.info("%s - Failed to decode JWT", current_uuid)
         raise credentials_exception
-    user = crud.get_user_by_username(
-        current_uuid=current_uuid, db=db, username=token_data.username
+    user = await database.run_in_session(
+        db,
+        crud.get_user_by_username,
+        current_uuid=current_uuid,
+        username=token_data.username,
     )
     if user is None:
-        logger.info(f"{current_uuid} - User does not exist")
+        logger.info("%s - User does not exist", current_uuid)
         raise credentials_exception
+    # Cached as a detached schema so it can be shared between requests and sessions
+    user = schemas.User.from_orm(user)
+    principal_cache.cache.put(token, user, token_expires_at=payload.get("exp"))
     logger.info(
-        f"{current_uuid} - Retrived current USER(ID={user.id} USERNAME={user.username})"
+        "%s - Retrived current USER(ID=%s USERNAME=%s)",
+        current_uuid,
+        user.id,
+        user.username,
     )
     return user
 
@@ -118,17 +210,23 @@ def get_current_active_user(
     request: Request,
     current_user: schemas.User = Depends(get_current_user),
 ):  # pragma: no cover
-    logger.debug(f"{request.state.uuid} - Running get current active user function")
+    logger.debug("%s - Running get current active user function", request.state.uuid)
     return current_user
 
 
 def is_admin(request: Request, user: schemas.User = Depends(get_current_active_user)):
-    logger.debug(f"{request.state.uuid} - Running is admin function")
+    logger.debug("%s - Running is admin function", request.state.uuid)
     if user.admin == False:
         logger.info(
-            f"{request.state.uuid} - USER(ID={user.id} USERNAME={user.username}) attempted to hit a restricted admin endpoint as a non-admin"
+            "%s - USER(ID=%s USERNAME=%s) attempted to hit a restricted admin endpoint as a non-admin",
+            request.state.uuid,
+            user.id,
+            user.username,
         )
         raise HTTPException(status_code=403, detail="Operation not permitted")
     logger.info(
-        f"{request.state.uuid} - USER(ID={user.id} USERNAME={user.username}) is authorised to use this endpoint as admin"
+        "%s - USER(ID=%s USERNAME=%s) is authorised to use this endpoint as admin",
+        request.state.uuid,
+        user.id,
+        user.username,
     )
@@ -0,0 +1,401 @@
+import datetime
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app import database, models, recurrence
+
+logger = logging.getLogger(__name__)
+
+# In-process index of which desks are occupied on which days, used to answer free desk searches without a query
+# Every desk has one bit per day of a rolling window starting today, a set bit means the desk has a booking
+# (approved or pending) that day. The bits are stored little endian in a bytearray per desk.
+# Recurring bookings are kept as rules and only expanded into bits for the days inside the window
+# Only one rebuild runs at a time in each worker. Its queries run without the lock held so searches carry on, and
+# changes made meanwhile are recorded and applied again once the rebuilt index is swapped in, as the queries may
+# have run before they were committed. Once built, a stale index is refreshed on a background thread while
+# searches keep using it, so only the first search after the index is invalidated waits for a rebuild, which it
+# does on the threadpool so the event loop is never blocked.
+
+# Number of days, starting from today, the bitmaps cover
+AVAILABILITY_WINDOW_DAYS = int(os.environ.get("AVAILABILITY_WINDOW_DAYS", 365))
+# Each worker keeps its own index, so it is rebuilt from the database once it is older than this many seconds
+# to pick up bookings made through other workers
+AVAILABILITY_INDEX_MAX_AGE = float(os.environ.get("AVAILABILITY_INDEX_MAX_AGE", 60))
+
+
+class AvailabilityIndex:
+    def __init__(self, window_days: int, max_age: float):
+        self.window_days = window_days
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        # Held for the whole of a rebuild, so concurrent searches and startup don't each run its queries
+        self._rebuild_lock = threading.Lock()
+        # Changes made since the running rebuild started, as (FUNCTION, ARGS), or None when not rebuilding
+        self._changes = None
+        # Incremented by invalidate, so a rebuild whose queries ran before an invalidation doesn't count as fresh
+        self._invalidations = 0
+        self._window_start = None
+        self._built_at = None
+        # DESK_ID -> (ROOM_ID, NUMBER)
+        self._desks = {}
+        # DESK_ID -> bytearray with a bit for every day in the window
+        self._occupied = {}
+        # DESK_ID -> set of dates booked after the window, moved into the bitmap as the window rolls forward
+        self._beyond_window = {}
+        # RECURRING_BOOKING_ID -> (DESK_ID, START_DATE, END_DATE, WEEKDAYS MASK)
+        self._rules = {}
+
+    def is_stale(self):
+        return self._built_at is None or (
+            time.monotonic() - self._built_at > self.max_age
+        )
+
+    def is_built(self):
+        return self._built_at is not None
+
+    def rebuild(self, db: Session):
+        """
+        Replaces the index with the desks, upcoming bookings and recurring bookings in the database,
+        waiting for any rebuild already running to finish first
+
+        Parameters:
+                db (Session): A session of a database
+        """
+        with self._rebuild_lock:
+            self._rebuild(db)
+
+    def ensure_built(self, db: Session):
+        """
+        Builds the index if it has never been built or was invalidated. A caller arriving while another is building
+        it waits for that build rather than running its own.
+
+        Parameters:
+                db (Session): A session of a database
+        """
+        if self.is_built():
+            return
+        with self._rebuild_lock:
+            if not self.is_built():
+                self._rebuild(db)
+
+    def refresh_in_background(self, session_factory):
+        """
+        Rebuilds a stale index on a background thread, unless a rebuild is already running
+
+        Parameters:
+                session_factory (sessionmaker): Creates the (synchronous) session the thread queries with
+        """
+        if not self._rebuild_lock.acquire(blocking=False):
+            return
+        if not self.is_stale():
+            # Rebuilt by another thread since the caller checked
+            self._rebuild_lock.release()
+            return
+
+        def refresh():
+            try:
+                db = session_factory()
+                try:
+                    self._rebuild(db)
+                finally:
+                    db.close()
+            except Exception:
+                logger.exception("Failed to rebuild availability index")
+            finally:
+                self._rebuild_lock.release()
+
+        threading.Thread(
+            target=refresh, name="availability-rebuild", daemon=True
+        ).start()
+
+    def _rebuild(self, db: Session):
+        # Called with the rebuild lock held
+        with self._lock:
+            self._changes = []
+            invalidations = self._invalidations
+        try:
+            today = datetime.date.today()
+            desks = db.query(
+                models.Desk.id, models.Desk.room_id, models.Desk.number
+            ).all()
+            bookings = (
+                db.query(models.Booking.desk_id, models.Booking.date)
+                .filter(models.Booking.date >= today)
+                .all()
+            )
+            rules = (
+                db.query(
+                    models.RecurringBooking.id,
+                    models.RecurringBooking.desk_id,
+                    models.RecurringBooking.start_date,
+                    models.RecurringBooking.end_date,
+                    models.RecurringBooking.weekdays,
+                )
+                .filter(models.RecurringBooking.end_date >= today)
+                .all()
+            )
+        except Exception:
+            with self._lock:
+                self._changes = None
+            raise
+        with self._lock:
+            self._window_start = today
+            self._desks = {}
+            self._occupied = {}
+            self._beyond_window = {}
+            self._rules = {}
+            for desk_id, room_id, number in desks:
+                self._add_desk(desk_id, room_id, number)
+            for desk_id, date in bookings:
+                self._set(desk_id, date, True)
+            for rule_id, desk_id, start_date, end_date, mask in rules:
+                self._add_rule(rule_id, desk_id, start_date, end_date, mask)
+            # Setting and clearing bits and adding rules can be repeated, so changes the queries already saw are
+            # applied again without effect
+            changes, self._changes = self._changes, None
+            for change, args in changes:
+                self._roll()
+                change(*args)
+            if self._invalidations == invalidations:
+                self._built_at = time.monotonic()
+        logger.info(
+            "Built availability index for %s desks, %s bookings and %s recurring bookings",
+            len(desks),
+            len(bookings),
+            len(rules),
+        )
+
+    def invalidate(self):
+        """
+        Marks the index as stale so it is rebuilt before the next search, used after changes made outside crud.py
+        """
+        with self._lock:
+            self._built_at = None
+            self._invalidations += 1
+
+    def add_desk(self, desk_id: int, room_id: int, number: int):
+        self._change(self._add_desk, desk_id, room_id, number)
+
+    def remove_desk(self, desk_id: int):
+        self._change(self._remove_desk, desk_id)
+
+    def add_booking(self, desk_id: int, date: datetime.date):
+        self._change(self._set, desk_id, date, True)
+
+    def remove_booking(self, desk_id: int, date: datetime.date):
+        self._change(self._set, desk_id, date, False)
+
+    def add_rule(
+        self,
+        rule_id: int,
+        desk_id: int,
+        start_date: datetime.date,
+        end_date: datetime.date,
+        mask: int,
+    ):
+        self._change(self._add_rule, rule_id, desk_id, start_date, end_date, mask)
+
+    def remove_rule(self, rule_id: int):
+        self._change(self._remove_rule, rule_id)
+
+    def search(self, dates: list[datetime.date], room_ids: list[int] = None):
+        """
+        Finds the desks which are free on every one of the given days
+
+        Parameters:
+                dates (List[datetime.date]): The days a desk must be free on
+                room_ids (List[int] or None): The rooms to search, if none all rooms are searched
+
+        Returns:
+            desks (List[tuple]): The ID, room ID and number of each free desk, ordered by room and number
+
+        Raises:
+            ValueError: If a day is outside of the indexed window
+        """
+        with self._lock:
+            self._roll()
+            offsets = [(date - self._window_start).days for date in dates]
+            if any(offset < 0 or offset >= self.window_days for offset in offsets):
+                raise ValueError(
+                    f"Dates must be within {self.window_days} days from today"
+                )
+            # Only the bytes spanning the requested days are compared against a mask of those days
+            first_byte = min(offsets) // 8
+            last_byte = max(offsets) // 8 + 1
+            mask = 0
+            for offset in offsets:
+                mask |= 1 << (offset - first_byte * 8)
+            rooms = None if room_ids is None else set(room_ids)
+            free_desks = [
+                (desk_id, room_id, number)
+                for desk_id, (room_id, number) in self._desks.items()
+                if (rooms is None or room_id in rooms)
+                and not int.from_bytes(
+                    self._occupied[desk_id][first_byte:last_byte], "little"
+                )
+                & mask
+            ]
+        return sorted(free_desks, key=lambda desk: (desk[1], desk[2]))
+
+    def _change(self, change, *args):
+        # Applies a committed change to the built index, and records it for a rebuild which is running
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((change, args))
+            if self._built_at is not None:
+                self._roll()
+                change(*args)
+
+    def _add_desk(self, desk_id: int, room_id: int, number: int):
+        self._desks[desk_id] = (room_id, number)
+        if desk_id not in self._occupied:
+            self._occupied[desk_id] = bytearray((self.window_days + 7) // 8)
+
+    def _remove_desk(self, desk_id: int):
+        self._desks.pop(desk_id, None)
+        self._occupied.pop(desk_id, None)
+        self._beyond_window.pop(desk_id, None)
+        self._rules = {
+            rule_id: rule for rule_id, rule in self._rules.items() if rule[0] != desk_id
+        }
+
+    def _set(self, desk_id: int, date: datetime.date, occupied: bool):
+        if desk_id not in self._occupied:
+            return
+        offset = (date - self._window_start).days
+        if offset < 0:
+            return
+        if offset >= self.window_days:
+            beyond_window = self._beyond_window.setdefault(desk_id, set())
+            if occupied:
+                beyond_window.add(date)
+            else:
+                beyond_window.discard(date)
+            return
+        if occupied:
+            self._occupied[desk_id][offset // 8] |= 1 << (offset % 8)
+        else:
+            self._occupied[desk_id][offset // 8] &= ~(1 << (offset % 8)) & 0xFF
+
+    def _add_rule(
+        self,
+        rule_id: int,
+        desk_id: int,
+        start_date: datetime.date,
+        end_date: datetime.date,
+        mask: int,
+    ):
+        self._rules[rule_id] = (desk_id, start_date, end_date, mask)
+        self._apply_rule(desk_id, start_date, end_date, mask, occupied=True)
+
+    def _remove_rule(self, rule_id: int):
+        rule = self._rules.pop(rule_id, None)
+        if rule is not None:
+            self._apply_rule(*rule, occupied=False)
+
+    def _apply_rule(
+        self,
+        desk_id: int,
+        start_date: datetime.date,
+        end_date: datetime.date,
+        mask: int,
+        occupied: bool,
+        from_date: datetime.date = None,
+    ):
+        # Only the occurrences inside the window are expanded, later ones are added as the window rolls forward
+        from_date = from_date or self._window_start
+        window_end = self._window_start + datetime.timedelta(days=self.window_days - 1)
+        for date in recurrence.occurrences(
+            start_date, end_date, mask, from_date, window_end
+        ):
+            self._set(desk_id, date, occupied)
+
+    def _roll(self):
+        """
+        Moves the window forward to start today, dropping past days and taking in bookings (and occurrences of
+        recurring bookings) which are now in range
+        """
+        today = datetime.date.today()
+        days_passed = (today - self._window_start).days
+        if days_passed <= 0:
+            return
+        previous_window_end = self._window_start + datetime.timedelta(
+            days=self.window_days
+        )
+        size = (self.window_days + 7) // 8
+        for desk_id, bitmap in self._occupied.items():
+            shifted = int.from_bytes(bitmap, "little") >> days_passed
+            self._occupied[desk_id] = bytearray(shifted.to_bytes(size, "little"))
+        self._window_start = today
+        for desk_id, dates in self._beyond_window.items():
+            entered_window = {
+                date for date in dates if (date - today).days < self.window_days
+            }
+            dates -= entered_window
+            for date in entered_window:
+                self._set(desk_id, date, True)
+        for rule_id, rule in list(self._rules.items()):
+            if rule[2] < today:
+                del self._rules[rule_id]
+                continue
+            self._apply_rule(
+                *rule, occupied=True, from_date=max(previous_window_end, today)
+            )
+
+
+index = AvailabilityIndex(
+    window_days=AVAILABILITY_WINDOW_DAYS, max_age=AVAILABILITY_INDEX_MAX_AGE
+)
+
+
+async def ensure_index_built(current_uuid, db: database.AnySession):
+    """
+    Builds the index if it has never been built or was invalidated, before it is searched. Building it, or waiting
+    for a build already running, blocks on the rebuild lock, so it is done on the threadpool rather than the event
+    loop. An async session can't be used from another thread, so with one the build uses a sync session of its own.
+
+    Parameters:
+            db (Session or AsyncSession): The session of the request
+    """
+    if index.is_built():
+        return
+    logger.info("%s - Building availability index", current_uuid)
+    if isinstance(db, AsyncSession):
+
+        def build():
+            with database.SessionLocal() as sync_db:
+                index.ensure_built(sync_db)
+
+        await run_in_threadpool(build)
+    else:
+        await run_in_threadpool(index.ensure_built, db)
+
+
+def search_free_desks(current_uuid, dates: list[datetime.date], room_ids: list[int]):
+    """
+    Searches the availability index for desks free on all the given days, once built by ensure_index_built.
+    A stale index is searched as it is while it is refreshed in the background.
+
+    Parameters:
+            dates (List[datetime.date]): The days a desk must be free on
+            room_ids (List[int] or None): The rooms to search, if none all rooms are searched
+
+    Returns:
+        desks (List[dict]): The free desks
+    """
+    logger.debug("%s - Entered search free desks function", current_uuid)
+    if index.is_stale():
+        logger.info("%s - Refreshing stale availability index", current_uuid)
+        index.refresh_in_background(database.SessionLocal)
+    free_desks = index.search(dates=dates, room_ids=room_ids)
+    logger.debug("%s - Exiting search free desks function", current_uuid)
+    return [
+        {"id": desk_id, "room_id": room_id, "number": number}
+        for desk_id, room_id, number in free_desks
+    ]
@@ -0,0 +1,35 @@
+import argparse
+import logging
+
+from app import database, hashing
+
+logger = logging.getLogger(__name__)
+
+# Creates the database and its tables, adding test data if the database is new
+# Run once before starting the workers: python -m app.bootstrap [--no-seed]
+
+
+def main(argv=None):  # pragma: no cover
+    parser = argparse.ArgumentParser(
+        prog="python -m app.bootstrap",
+        description="Create the desk booking database and tables, seeding a new database with test data",
+    )
+    parser.add_argument(
+        "--no-seed",
+        action="store_true",
+        help="don't add test data when the database is created",
+    )
+    args = parser.parse_args(argv)
+    try:
+        created = database.bootstrap_database(seed=not args.no_seed)
+    finally:
+        hashing.pool.shutdown()
+    if created:
+        logger.info("Created database")
+    else:
+        logger.info("Database already exists, created any missing tables")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    main()
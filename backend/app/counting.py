@@ -0,0 +1,114 @@
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+
+from app import models
+
+logger = logging.getLogger(__name__)
+
+# Total counts for the Content-Range header of the list endpoints
+# Each table uses one of these strategies, overridable with a COUNT_STRATEGY_<TABLE> enviroment variable:
+#   exact    - COUNT(*) on every request, accurate but scans the whole table
+#   estimate - The row estimate kept in PostgreSQL's planner statistics, instant but approximate
+#   cached   - An exact count refreshed every COUNT_CACHE_MAX_AGE seconds and adjusted by this workers writes
+# Filtered counts (such as the desks in one room) are always exact
+
+COUNT_STRATEGIES = {
+    table: os.environ.get(f"COUNT_STRATEGY_{table.upper()}", default).lower()
+    for table, default in (
+        ("users", "exact"),
+        ("rooms", "exact"),
+        ("desks", "exact"),
+        ("bookings", "cached"),
+    )
+}
+
+COUNT_CACHE_MAX_AGE = float(os.environ.get("COUNT_CACHE_MAX_AGE", 30))
+
+
+class CountCache:
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # TABLE -> [COUNT, MONOTONIC TIME FETCHED]
+        self._counts = {}
+
+    def get(self, db: Session, model):
+        with self._lock:
+            cached = self._counts.get(model.__tablename__)
+            if cached is not None and time.monotonic() - cached[1] <= self.max_age:
+                return cached[0]
+        count = count_exact(db, model)
+        with self._lock:
+            self._counts[model.__tablename__] = [count, time.monotonic()]
+        return count
+
+    def adjust(self, model, delta: int):
+        with self._lock:
+            cached = self._counts.get(model.__tablename__)
+            if cached is not None:
+                cached[0] = max(cached[0] + delta, 0)
+
+    def invalidate(self):
+        with self._lock:
+            self._counts = {}
+
+
+cache = CountCache(max_age=COUNT_CACHE_MAX_AGE)
+
+
+def count_exact(db: Session, model, filters: tuple = ()):
+    return db.query(func.count(model.id)).filter(*filters).scalar()
+
+
+def count_estimate(db: Session, model):
+    """
+    Reads the planners row estimate for a table, falling back to an exact count when there are no statistics
+    """
+    if db.get_bind().dialect.name != "postgresql":
+        return count_exact(db, model)
+    estimate = db.execute(
+        text(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)"
+        ),
+        {"table": model.__tablename__},
+    ).scalar()
+    # A table which has never been analysed has an estimate of -1
+    if estimate is None or estimate < 0:
+        return count_exact(db, model)
+    return estimate
+
+
+def count_entities(
+    current_uuid,
+    db: Session,
+    model: models.Base,
+    filters: tuple = (),
+):
+    """
+    Counts the entities of a model using the strategy configured for its table
+
+    Parameters:
+            db (Session): A session of a database
+            model (models): The table, represented as a model, to count
+            filters (tuple): Conditions the counted entities must meet, filtered counts are always exact
+
+    Returns:
+        total (int): The (possibly approximate) number of entities
+    """
+    strategy = COUNT_STRATEGIES.get(model.__tablename__, "exact")
+    logger.debug(
+        "%s - Counting TABLE(NAME=%s) with the %s strategy",
+        current_uuid,
+        model.__tablename__,
+        strategy,
+    )
+    if filters or strategy == "exact":
+        return count_exact(db, model, filters)
+    if strategy == "estimate":
+        return count_estimate(db, model)
+    return cache.get(db, model)
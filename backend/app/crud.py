@@ -1,15 +1,43 @@
 import logging
+from collections import Counter
 from typing import Union
-from uuid import UUID
+from uuid import UUID, uuid4
+from pydantic import BaseModel
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy import (
+    Boolean,
+    Date,
+    Integer,
+    and_,
+    cast,
+    exists,
+    func,
+    literal,
+    literal_column,
+    null,
+    select,
+    union_all,
+    update,
+)
 from sqlalchemy.orm.exc import NoResultFound
 
 import datetime
 
-from app import models, schemas, security
-
-from datetime import datetime
+from app import (
+    availability,
+    counting,
+    hashing,
+    loading,
+    models,
+    pagination,
+    principal_cache,
+    recurrence,
+    response_cache,
+    schemas,
+)
+
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
@@ -17,12 +45,161 @@ logger = logging.getLogger(__name__)
 # No data encryption is required apart from on passwords since no sensitive information is stored
 
 
+def dialect_insert(db: Session):
+    """
+    Returns the insert construct of the sessions database, which supports ON CONFLICT clauses
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        return sqlite.insert
+    return postgresql.insert
+
+
+def lock_desks(db: Session, desk_ids):
+    """
+    Locks desks until the transaction ends, so checking a desk for clashing bookings and recurring bookings and the
+    write that follows are serialised per desk. Under READ COMMITTED a check can't see a clashing write which isn't
+    committed yet, so without the lock a booking and a recurring booking of the same day could both be created.
+    Desks are locked in ID order so concurrent writes can't deadlock. SQLite only runs one write at a time, so
+    nothing is locked there.
+
+    Parameters:
+            db (Session): A session of a database
+            desk_ids (Iterable[int]): The desks about to be checked and written to
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        return
+    db.execute(
+        select(models.Desk.id)
+        .where(models.Desk.id.in_(set(desk_ids)))
+        .order_by(models.Desk.id)
+        .with_for_update()
+    )
+
+
+def room_bookings_version(room_id: int, date: datetime.date):
+    """
+    Returns the name of the version of the bookings in a room on a date
+    """
+    return f"bookings:{room_id}:{date}"
+
+
+def room_recurring_bookings_version(room_id: int):
+    """
+    Returns the name of the version of the recurring bookings in a room
+    """
+    return f"recurring_bookings:{room_id}"
+
+
+def booking_versions(db: Session, bookings: list[tuple]):
+    """
+    Returns the names of the versions changed by writing bookings, from the room of each desk
+
+    Parameters:
+            db (Session): A session of a database
+            bookings (List[tuple]): The desk ID and date of each booking
+
+    Returns:
+        names (Set[str]): The versions of the rooms bookings on each date
+    """
+    desk_rooms = dict(
+        db.query(models.Desk.id, models.Desk.room_id)
+        .filter(models.Desk.id.in_({desk_id for desk_id, _ in bookings}))
+        .all()
+    )
+    return {
+        room_bookings_version(desk_rooms[desk_id], date)
+        for desk_id, date in bookings
+        if desk_id in desk_rooms
+    }
+
+
+def bump_versions(db: Session, names: set):
+    """
+    Increments versions in the current transaction, so they change exactly when the write is committed.
+    Versions are created on their first write, in a consistent order so concurrent writes can't deadlock.
+
+    Parameters:
+            db (Session): A session of a database
+            names (Set[str]): The tables or groups of rows written to
+    """
+    if not names:
+        return
+    statement = dialect_insert(db)(models.Version).values(
+        [{"name": name, "version": 1} for name in sorted(names)]
+    )
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[models.Version.name],
+            set_={"version": models.Version.version + 1},
+        )
+    )
+
+
+def bump_versions_after_commit(db: Session, names: set):
+    """
+    Increments versions in a transaction of their own, after the write they cover has been committed.
+    Used for bookings, where every booking in a room on a date shares one versions row: bumping it in the booking
+    transaction would hold that rows lock from the INSERT until the commit, serialising concurrent bookings.
+    As the bookings are visible before their versions change, a response is never cached under a new version with the
+    old bookings, only a request between the two commits may be told the previous response is still current.
+
+    Parameters:
+            db (Session): A session of a database, with no uncommitted writes
+            names (Set[str]): The groups of rows written to
+    """
+    bump_versions(db, names)
+    db.commit()
+
+
+def get_versions(current_uuid: UUID, db: Session, names: tuple):
+    """
+    Gets the current versions of the tables or groups of rows a response is read from, in one primary key lookup
+
+    Parameters:
+            db (Session): A session of a database
+            names (tuple): The names of the versions
+
+    Returns:
+        versions (tuple): The version of each name in order, 0 if it has never been written to
+    """
+    logger.debug("%s - Running get versions function", current_uuid)
+    versions = dict(
+        db.query(models.Version.name, models.Version.version)
+        .filter(models.Version.name.in_(names))
+        .all()
+    )
+    return tuple(versions.get(name, 0) for name in names)
+
+
+def query_entities(db: Session, model, schema: Union[BaseModel, None] = None):
+    """
+    Starts a query of the entities of a model, or if a response schema is given of only its columns as rows.
+    Rows aren't tracked by the session, so are cheaper to load for read only endpoints (see loading.projection).
+
+    Parameters:
+            db (Session): A session of a database
+            model (models): The table, represented as a model, to retrive from
+            schema (BaseModel or None): The response schema to select the columns of
+
+    Returns:
+        query (tuple): The query, and a function to convert each result with or None if they can be returned as they are
+    """
+    if schema is None:
+        return db.query(model), None
+    columns, joins, build = loading.projection(model, schema)
+    query = db.query(*columns).select_from(model)
+    for join in joins:
+        query = query.join(join)
+    return query, build
+
+
 def get_all_entities(
     current_uuid: UUID,
     db: Session,
     range: Union[list[int], None],
     sort: Union[list[str], None],
     model: Union[models.User, models.Room, models.Desk, models.Booking],
+    schema: Union[BaseModel, None] = None,
 ):
     """
     Retrives either all entites (from a model) or a range of entities from a database based on an ID
@@ -33,11 +210,12 @@ def get_all_entities(
             range (List[int] or None): A defined range, made up of an offset and limit. If none all entities are retrived.
             sort (List[str] or None): Defines the sort, made up of a property and ascending/decending. If none, entities are sorted by ID acsending.
             model (models): The table, represented as a model, to retrive from
+            schema (BaseModel or None): If given only its columns are retrived, as rows instead of entities
 
     Returns:
         model (List[models.x] or None): A list of the retrived entity or None if not found
     """
-    logger.debug(f"{current_uuid} - Entered get all entities function")
+    logger.debug("%s - Entered get all entities function", current_uuid)
     if sort == None:
         users_id = getattr(model, "id").asc()
     else:
@@ -46,19 +224,65 @@ def get_all_entities(
             if sort[1].upper() == "ASC"
             else getattr(model, sort[0]).desc()
         )
+    query, build = query_entities(db, model, schema)
     if range == None:
-        result = db.query(model).order_by(users_id).all()
+        result = query.order_by(users_id).all()
     else:
-        result = (
-            db.query(model).order_by(users_id).offset(range[0]).limit(range[1]).all()
-        )
+        result = query.order_by(users_id).offset(range[0]).limit(range[1]).all()
+    if build is not None:
+        result = [build(row) for row in result]
     logger.info(
-        f"{current_uuid} - Successfully retrived all entities for MODEL(MODEL={model})"
+        "%s - Successfully retrived all entities for MODEL(MODEL=%s)",
+        current_uuid,
+        model,
     )
-    logger.debug(f"{current_uuid} - Exiting get all entities function")
+    logger.debug("%s - Exiting get all entities function", current_uuid)
     return result
 
 
+def get_entities_by_cursor(
+    current_uuid: UUID,
+    db: Session,
+    cursor: Union[str, None],
+    limit: int,
+    sort: Union[list[str], None],
+    model: Union[models.User, models.Room, models.Desk, models.Booking],
+    filters: tuple = (),
+):
+    """
+    Retrives a page of entities (from a model) after a cursor, using keyset pagination so every page costs the same
+
+    Parameters:
+            db (Session): A session of a database
+            cursor (str or None): The cursor returned with the previous page. If none the first page is retrived.
+            limit (int): The number of entities on a page
+            sort (List[str] or None): Defines the sort for the first page, later pages use the sort held in the cursor
+            model (models): The table, represented as a model, to retrive from
+            filters (tuple): Extra conditions the entities must meet
+
+    Returns:
+        page (tuple): A list of the retrived entities and the cursor of the next page, or None if there are no more
+
+    Raises:
+        ValueError: If the cursor or sort are invalid
+    """
+    logger.debug("%s - Entered get entities by cursor function", current_uuid)
+    entities, next_cursor = pagination.paginate_by_cursor(
+        db.query(model).filter(*filters),
+        model=model,
+        sort=sort,
+        cursor=cursor,
+        limit=limit,
+    )
+    logger.info(
+        "%s - Successfully retrived a page of entities for MODEL(MODEL=%s)",
+        current_uuid,
+        model,
+    )
+    logger.debug("%s - Exiting get entities by cursor function", current_uuid)
+    return entities, next_cursor
+
+
 def get_entity(
     current_uuid: UUID,
     db: Session,
@@ -76,7 +300,7 @@ def get_entity(
     Returns:
             model (models.x or None): SQLAlchemy representation of the retrived entity or None if not found
     """
-    logger.debug(f"{current_uuid} - Running get entity function")
+    logger.debug("%s - Running get entity function", current_uuid)
     return db.query(model).filter(model.id == id).first()
 
 
@@ -102,21 +326,73 @@ def update_entity(
             model (models): The table, represented as a model, to retrive from
 
     Returns:
-            model (models.x or None): SQLAlchemy representation of the retrived entity or None if not found
+            model (models.x or None): SQLAlchemy representation of the retrived entity or None if not found, or if
+                                      a booking would be moved onto a desk and date held by a recurring booking
     """
-    logger.debug(f"{current_uuid} - Entered update entity function")
+    logger.debug("%s - Entered update entity function", current_uuid)
     update_data = updates.dict(exclude_unset=True)
-    logger.debug(f"{current_uuid} - Looping through object to update attributes")
+    if model is models.Booking:
+        previous_booking = (entity_to_update.desk_id, entity_to_update.date)
+        desk_id = update_data.get("desk_id", entity_to_update.desk_id)
+        date = update_data.get("date", entity_to_update.date)
+        if (desk_id, date) != previous_booking:
+            # The desk is locked first, so a recurring booking being created for it is either committed before
+            # the NOT EXISTS check or waits until the move is committed
+            # A desk already booked that day is still caught by the unique constraint, raising IntegrityError
+            lock_desks(db, [desk_id])
+            moved = db.execute(
+                update(models.Booking)
+                .where(
+                    models.Booking.id == entity_to_update.id,
+                    ~recurring_booking_occurs(
+                        literal(desk_id, Integer),
+                        literal(date, Date),
+                        literal(recurrence.weekday_bit(date), Integer),
+                    ),
+                )
+                .values(desk_id=desk_id, date=date)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not moved:
+                db.rollback()
+                logger.info(
+                    "%s - DESK(ID=%s) is held by a recurring booking on %s",
+                    current_uuid,
+                    desk_id,
+                    date,
+                )
+                return None
+    logger.debug("%s - Looping through object to update attributes", current_uuid)
     for key, value in update_data.items():
         setattr(entity_to_update, key, value)
+    if model is models.Booking:
+        bump_versions(
+            db,
+            booking_versions(
+                db,
+                [previous_booking, (entity_to_update.desk_id, entity_to_update.date)],
+            ),
+        )
+    elif model in (models.Room, models.Desk):
+        bump_versions(db, {model.__tablename__})
     db.commit()
+    if model is models.Booking:
+        availability.index.remove_booking(*previous_booking)
+        availability.index.add_booking(entity_to_update.desk_id, entity_to_update.date)
+    elif model is models.Desk:
+        availability.index.add_desk(
+            entity_to_update.id, entity_to_update.room_id, entity_to_update.number
+        )
+    elif model is models.User:
+        principal_cache.cache.invalidate_user(entity_to_update.id)
+    response_cache.cache.invalidate_model(model)
     updated_entity = get_entity(
         current_uuid=current_uuid, db=db, id=model.id, model=model
     )
     logger.info(
-        f"{current_uuid} - Successfully updated MODEL(ID={model.id} MODEL={model})"
+        "%s - Successfully updated MODEL(ID=%s MODEL=%s)", current_uuid, model.id, model
     )
-    logger.debug(f"{current_uuid} - Exiting update entity function")
+    logger.debug("%s - Exiting update entity function", current_uuid)
     return updated_entity
 
 
@@ -134,13 +410,39 @@ def delete_entity(
             id (int): An integer representing an enitys ID in the database
             model (models): The table, represented as a model, to retrive from
     """
-    logger.debug(f"{current_uuid} - Entered delete entity function")
-    db.query(model).filter(model.id == id).delete()
+    logger.debug("%s - Entered delete entity function", current_uuid)
+    if model is models.Booking:
+        # Usually already in the sessions identity map, so this doesn't need a query
+        booking = db.get(models.Booking, id)
+        if booking is not None:
+            bump_versions(db, booking_versions(db, [(booking.desk_id, booking.date)]))
+    elif model is models.RecurringBooking:
+        room_id = (
+            db.query(models.Desk.room_id)
+            .join(models.RecurringBooking)
+            .filter(models.RecurringBooking.id == id)
+            .scalar()
+        )
+        if room_id is not None:
+            bump_versions(db, {room_recurring_bookings_version(room_id)})
+    elif model in (models.Room, models.Desk):
+        bump_versions(db, {model.__tablename__})
+    deleted = db.query(model).filter(model.id == id).delete()
     db.commit()
+    counting.cache.adjust(model, -deleted)
+    if model is models.Booking and booking is not None:
+        availability.index.remove_booking(booking.desk_id, booking.date)
+    elif model is models.RecurringBooking:
+        availability.index.remove_rule(id)
+    elif model is models.Desk:
+        availability.index.remove_desk(id)
+    elif model is models.User:
+        principal_cache.cache.invalidate_user(id)
+    response_cache.cache.invalidate_model(model)
     logger.info(
-        f"{current_uuid} - Successfully deleted MODEL(ID={model.id} MODEL={model})"
+        "%s - Successfully deleted MODEL(ID=%s MODEL=%s)", current_uuid, model.id, model
     )
-    logger.debug(f"{current_uuid} - Exiting delete entity function")
+    logger.debug("%s - Exiting delete entity function", current_uuid)
 
 
 # Users Functions
@@ -157,7 +459,7 @@ def get_user_by_username(current_uuid: UUID, db: Session, username: str):
     Returns:
             user (models.user or None): SQLAlchemy representation of a user or None if not found
     """
-    logger.debug(f"{current_uuid} - Running get user by username function")
+    logger.debug("%s - Running get user by username function", current_uuid)
     return db.query(models.User).filter(models.User.username == username).first()
 
 
@@ -172,24 +474,147 @@ def create_user(current_uuid: UUID, db: Session, user: schemas.UserCreate):
     Returns:
             user (models.user or None): The created user
     """
-    logger.debug(f"{current_uuid} - Entered create user function")
+    logger.debug("%s - Entered create user function", current_uuid)
     db_user = models.User(
         email=user.email,
         username=user.username,
-        hashed_password=security.get_hashed_password(user.password),
+        hashed_password=hashing.hash_password(user.password),
         admin=user.admin,
     )
-    logger.debug(f"{current_uuid} - Created user model")
+    logger.debug("%s - Created user model", current_uuid)
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    counting.cache.adjust(models.User, 1)
     logger.info(
-        f"{current_uuid} - USER(ID={db_user.id}, USERNAME={db_user.username}) successfully created"
+        "%s - USER(ID=%s, USERNAME=%s) successfully created",
+        current_uuid,
+        db_user.id,
+        db_user.username,
     )
-    logger.debug(f"{current_uuid} - Exiting create user function")
+    logger.debug("%s - Exiting create user function", current_uuid)
     return db_user
 
 
+# Refresh Token Functions
+# Refresh tokens are recorded so each can only be used once, using one again means it has leaked
+
+
+def create_refresh_token(
+    current_uuid: UUID, db: Session, user_id: int, expires_at: datetime
+):
+    """
+    Records the first refresh token of a new login, starting a new family of tokens
+
+    Parameters:
+            db (Session): A session of a database
+            user_id (int): An integer representing the users ID in the database
+            expires_at (datetime): When the token expires (UTC)
+
+    Returns:
+        ids (tuple): The ID (jti) of the token and of its family
+    """
+    logger.debug("%s - Entered create refresh token function", current_uuid)
+    # Expired tokens of the user are no longer needed for reuse detection
+    db.query(models.RefreshToken).filter(
+        models.RefreshToken.user_id == user_id,
+        models.RefreshToken.expires_at < datetime.utcnow(),
+    ).delete()
+    token_id, family_id = uuid4().hex, uuid4().hex
+    db.add(
+        models.RefreshToken(
+            id=token_id, family_id=family_id, user_id=user_id, expires_at=expires_at
+        )
+    )
+    db.commit()
+    logger.info("%s - Created refresh token for USER(ID=%s)", current_uuid, user_id)
+    logger.debug("%s - Exiting create refresh token function", current_uuid)
+    return token_id, family_id
+
+
+def rotate_refresh_token(
+    current_uuid: UUID,
+    db: Session,
+    token_id: str,
+    family_id: str,
+    expires_at: datetime,
+):
+    """
+    Uses up a refresh token and records the token replacing it, in one transaction.
+    The token is marked as used by a conditional UPDATE, so two requests can't both use it.
+    If the token was already used every token in its family is revoked, forcing a new login.
+
+    Parameters:
+            db (Session): A session of a database
+            token_id (str): The jti claim of the refresh token
+            family_id (str): The fam claim of the refresh token
+            expires_at (datetime): When the new token expires (UTC)
+
+    Returns:
+        rotation (tuple or None): The user (schemas.User) and the ID of the new token, or None if the token can't be used
+    """
+    logger.debug("%s - Entered rotate refresh token function", current_uuid)
+    user_id = db.execute(
+        update(models.RefreshToken)
+        .where(
+            models.RefreshToken.id == token_id,
+            models.RefreshToken.family_id == family_id,
+            models.RefreshToken.used == False,
+            models.RefreshToken.revoked == False,
+            models.RefreshToken.expires_at >= datetime.utcnow(),
+        )
+        .values(used=True)
+        .returning(models.RefreshToken.user_id)
+    ).scalar()
+    if user_id is None:
+        reused = (
+            db.query(models.RefreshToken.id)
+            .filter(
+                models.RefreshToken.id == token_id,
+                models.RefreshToken.family_id == family_id,
+                models.RefreshToken.used == True,
+            )
+            .first()
+        )
+        if reused is None:
+            db.rollback()
+            logger.info(
+                "%s - Refresh token is unknown, revoked or expired", current_uuid
+            )
+            return None
+        db.execute(
+            update(models.RefreshToken)
+            .where(models.RefreshToken.family_id == family_id)
+            .values(revoked=True)
+        )
+        db.commit()
+        logger.warning(
+            "%s - Refresh token was reused, revoked TOKEN_FAMILY(ID=%s)",
+            current_uuid,
+            family_id,
+        )
+        return None
+    db_user = db.get(models.User, user_id)
+    if db_user is None:
+        db.rollback()
+        logger.info("%s - User of the refresh token does not exist", current_uuid)
+        return None
+    user = schemas.User.from_orm(db_user)
+    new_token_id = uuid4().hex
+    db.add(
+        models.RefreshToken(
+            id=new_token_id,
+            family_id=family_id,
+            user_id=user_id,
+            expires_at=expires_at,
+        )
+    )
+    db.commit()
+    logger.info("%s - Rotated refresh token for USER(ID=%s)", current_uuid, user_id)
+    logger.debug("%s - Exiting rotate refresh token function", current_uuid)
+    return user, new_token_id
+
+
 # Room Functions
 
 
@@ -204,7 +629,7 @@ def get_room_by_name(current_uuid: UUID, db: Session, room_name: str):
     Returns:
             bookings (models.room or None): The retrived room or None if not found
     """
-    logger.debug(f"{current_uuid} - Running get room by name function")
+    logger.debug("%s - Running get room by name function", current_uuid)
     return db.query(models.Room).filter(models.Room.name == room_name).first()
 
 
@@ -219,16 +644,22 @@ def create_room(current_uuid: UUID, db: Session, room: schemas.RoomCreate):
     Returns:
             room (models.user or None): The created room
     """
-    logger.debug(f"{current_uuid} - Entered create room function")
+    logger.debug("%s - Entered create room function", current_uuid)
     db_room = models.Room(name=room.name)
-    logger.debug(f"{current_uuid} - Created room model")
+    logger.debug("%s - Created room model", current_uuid)
     db.add(db_room)
+    bump_versions(db, {models.Room.__tablename__})
     db.commit()
     db.refresh(db_room)
+    counting.cache.adjust(models.Room, 1)
+    response_cache.cache.invalidate_model(models.Room)
     logger.info(
-        f"{current_uuid} - ROOM(ID={db_room.id}, NAME={db_room.name}) successfully created"
+        "%s - ROOM(ID=%s, NAME=%s) successfully created",
+        current_uuid,
+        db_room.id,
+        db_room.name,
     )
-    logger.debug(f"{current_uuid} - Exiting create room function")
+    logger.debug("%s - Exiting create room function", current_uuid)
     return db_room
 
 
@@ -249,7 +680,7 @@ def get_desk_by_room_and_number(
     Returns:
             bookings (models.Desk or None): The retrived desk or None if not found
     """
-    logger.debug(f"{current_uuid} - Running get desk by room and number function")
+    logger.debug("%s - Running get desk by room and number function", current_uuid)
     return (
         db.query(models.Desk)
         .filter(and_(models.Desk.room_id == room_id, models.Desk.number == desk_number))
@@ -263,6 +694,7 @@ def get_desks_in_room(
     room_id: int,
     range: Union[list[int], None],
     sort: Union[list[str], None],
+    schema: Union[BaseModel, None] = None,
 ):
     """
     Retrives either all or a range of the desks in a defined room from a database based on the rooms ID
@@ -273,11 +705,12 @@ def get_desks_in_room(
             room_id (int): An integer representing an users ID in the database
             range (List[int] or None): A defined range, made up of an offset and limit. If none all entities are retrived.
             sort (List[str] or None): Defines the sort, made up of a property and ascending/decending. If none, entities are sorted by ID acsending.
+            schema (BaseModel or None): If given only its columns are retrived, as rows instead of entities
 
     Returns:
         model (List[models.desk] or None): A list of the retrived entity or None if not found
     """
-    logger.debug(f"{current_uuid} - Entered get desks in room function")
+    logger.debug("%s - Entered get desks in room function", current_uuid)
     if sort == None:
         desks_order = getattr(models.Desk, "id").asc()
     else:
@@ -286,24 +719,25 @@ def get_desks_in_room(
             if sort[1].upper() == "ASC"
             else getattr(models.Desk, sort[0]).desc()
         )
+    query, build = query_entities(db, models.Desk, schema)
     if range == None:
         result = (
-            db.query(models.Desk)
-            .filter(models.Desk.room_id == room_id)
-            .order_by(desks_order)
-            .all()
+            query.filter(models.Desk.room_id == room_id).order_by(desks_order).all()
         )
     else:
         result = (
-            db.query(models.Desk)
-            .filter(models.Desk.room_id == room_id)
+            query.filter(models.Desk.room_id == room_id)
             .order_by(desks_order)
             .offset(range[0])
             .limit(range[1])
             .all()
         )
-    logger.info(f"{current_uuid} - Successfully retrived all DESK(ROOM_ID={room_id})")
-    logger.debug(f"{current_uuid} - Exiting get desks in room function")
+    if build is not None:
+        result = [build(row) for row in result]
+    logger.info(
+        "%s - Successfully retrived all DESK(ROOM_ID=%s)", current_uuid, room_id
+    )
+    logger.debug("%s - Exiting get desks in room function", current_uuid)
     return result
 
 
@@ -318,22 +752,72 @@ def create_desk(current_uuid: UUID, db: Session, desk: schemas.DeskCreate):
     Returns:
             user (models.user or None): The created desk
     """
-    logger.debug(f"{current_uuid} - Entered create user function")
+    logger.debug("%s - Entered create user function", current_uuid)
     db_desk = models.Desk(number=desk.number, room_id=desk.room_id)
-    logger.debug(f"{current_uuid} - Created user model")
+    logger.debug("%s - Created user model", current_uuid)
     db.add(db_desk)
+    bump_versions(db, {models.Desk.__tablename__})
     db.commit()
     db.refresh(db_desk)
+    counting.cache.adjust(models.Desk, 1)
+    availability.index.add_desk(db_desk.id, db_desk.room_id, db_desk.number)
+    response_cache.cache.invalidate_model(models.Desk)
     logger.info(
-        f"{current_uuid} - DESK(ID={db_desk.id}, NUMBER={db_desk.number} ROOM_ID={db_desk.room_id}) successfully created"
+        "%s - DESK(ID=%s, NUMBER=%s ROOM_ID=%s) successfully created",
+        current_uuid,
+        db_desk.id,
+        db_desk.number,
+        db_desk.room_id,
     )
-    logger.debug(f"{current_uuid} - Exiting create user function")
+    logger.debug("%s - Exiting create user function", current_uuid)
     return db_desk
 
 
 # Booking Functions
 
 
+# Rows fetched from the server-side cursor at a time when streaming bookings
+EXPORT_BATCH_SIZE = 1000
+
+
+def stream_bookings(
+    current_uuid: UUID,
+    db: Session,
+    from_date: Union[datetime.date, None] = None,
+    to_date: Union[datetime.date, None] = None,
+):
+    """
+    Streams the columns of every booking (optionally in a date range) in batches, without loading them all into memory.
+    Only the columns are selected, so no ORM objects are built, and yield_per uses a server-side cursor on PostgreSQL.
+
+    Parameters:
+            db (Session): A session of a database, which must stay open until the batches are consumed
+            from_date (datetime.date or None): The first day of bookings to include
+            to_date (datetime.date or None): The last day of bookings to include
+
+    Returns:
+        batches (Iterator[List[tuple]]): Batches of the ID, date, desk ID, user ID and approved status of bookings
+    """
+    logger.debug("%s - Entered stream bookings function", current_uuid)
+    statement = select(
+        models.Booking.id,
+        models.Booking.date,
+        models.Booking.desk_id,
+        models.Booking.user_id,
+        models.Booking.approved_status,
+    ).order_by(models.Booking.id)
+    if from_date is not None:
+        statement = statement.where(models.Booking.date >= from_date)
+    if to_date is not None:
+        statement = statement.where(models.Booking.date <= to_date)
+    result = db.execute(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    try:
+        yield from result.partitions()
+    finally:
+        result.close()
+    logger.debug("%s - Exiting stream bookings function", current_uuid)
+
+
 def get_booking_by_desk_and_date(
     current_uuid: UUID, db: Session, desk_id: int, date: datetime.date
 ):
@@ -348,7 +832,7 @@ def get_booking_by_desk_and_date(
     Returns:
             bookings (models.booking or None): The retrived booking or None if not found
     """
-    logger.debug(f"{current_uuid} - Running get booking by desk and date function")
+    logger.debug("%s - Running get booking by desk and date function", current_uuid)
     try:
         return (
             db.query(models.Booking)
@@ -362,24 +846,30 @@ def get_booking_by_desk_and_date(
 
 
 def get_bookings_by_room(
-    current_uuid: UUID, db: Session, room_id: int, date: datetime.date
+    current_uuid: UUID,
+    db: Session,
+    room_id: int,
+    date: datetime.date,
+    schema: Union[BaseModel, None] = None,
 ):
     """
-    Gets all the the bookings that have been made in a specific room
+    Gets all the the bookings that have been made in a specific room, including recurring bookings which occur on the date
 
     Parameters:
             db (Session): A session of a database
             room_id (int): An integer representing an users ID in the database
             date (datetime.date): The date of requested bookings
+            schema (BaseModel or None): If given only its columns of the bookings are retrived, as rows instead of entities
 
     Returns:
-            bookings (List[models.booking] or None): A list of the retrived bookings or None if not found
+            bookings (List[models.booking or dict] or None): A list of the retrived bookings or None if not found,
+                                                             occurrences of recurring bookings are dicts without an ID
     """
-    logger.debug(f"{current_uuid} - Running get booking by room function")
+    logger.debug("%s - Running get booking by room function", current_uuid)
+    query, build = query_entities(db, models.Booking, schema)
     try:
-        return (
-            db.query(models.Booking)
-            .join(models.Desk)
+        bookings = (
+            query.join(models.Desk)
             .filter(
                 and_(
                     models.Desk.room_id == room_id,
@@ -390,6 +880,112 @@ def get_bookings_by_room(
         )
     except NoResultFound:
         return None
+    # Recurring bookings are only expanded for the requested date, never stored as a booking per day
+    rules = (
+        db.query(models.RecurringBooking)
+        .join(models.Desk)
+        .filter(
+            models.Desk.room_id == room_id,
+            models.RecurringBooking.start_date <= date,
+            models.RecurringBooking.end_date >= date,
+            models.RecurringBooking.weekdays.op("&")(recurrence.weekday_bit(date)) != 0,
+        )
+        .all()
+    )
+    return bookings + [
+        {
+            "desk_id": rule.desk_id,
+            "user_id": rule.user_id,
+            "date": date,
+            "approved_status": rule.approved_status,
+            "recurring_booking_id": rule.id,
+        }
+        for rule in rules
+    ]
+
+
+def recurring_booking_occurs(desk_id, date, weekday):
+    """
+    Creates an EXISTS clause which is true when a recurring booking holds a desk on a date
+
+    Parameters:
+            desk_id (ColumnElement): The desk ID, a column or literal
+            date (ColumnElement): The date
+            weekday (ColumnElement): The bit of the dates weekday, from recurrence.weekday_bit
+
+    Returns:
+        clause (Exists): The clause, negated with ~ to skip held desks
+    """
+    recurring_booking = models.RecurringBooking
+    return exists().where(
+        recurring_booking.desk_id == desk_id,
+        recurring_booking.start_date <= date,
+        recurring_booking.end_date >= date,
+        recurring_booking.weekdays.op("&")(weekday) != 0,
+    )
+
+
+def insert_bookings_statement(db: Session, bookings: list[schemas.BookingCreate]):
+    """
+    Creates an INSERT ... SELECT of bookings which skips any desk already booked that day, either by a booking
+    (ON CONFLICT DO NOTHING) or by a recurring booking (NOT EXISTS), and returns the columns of the created bookings
+    with the room of each desk, so the versions to bump are known without another query.
+    Callers lock the desks first (see lock_desks), as NOT EXISTS can't see a recurring booking which isn't committed.
+    It inserts into the table rather than the model, as the ORM can't return the room ID alongside a booking.
+
+    Parameters:
+            db (Session): A session of a database
+            bookings (List[schemas.BookingCreate]): The bookings to insert
+
+    Returns:
+        statement (Insert): The statement, executed with db.execute() and read with booking_from_row
+    """
+    rows = [
+        select(
+            literal(booking.user_id, Integer).label("user_id"),
+            literal(booking.desk_id, Integer).label("desk_id"),
+            literal(booking.date, Date).label("date"),
+            literal(booking.approved_status, Boolean).label("approved_status"),
+            literal(recurrence.weekday_bit(booking.date), Integer).label("weekday"),
+        )
+        for booking in bookings
+    ]
+    new_bookings = (union_all(*rows) if len(rows) > 1 else rows[0]).subquery(
+        "new_bookings"
+    )
+    occurs = recurring_booking_occurs(
+        new_bookings.c.desk_id, new_bookings.c.date, new_bookings.c.weekday
+    )
+    columns = ["user_id", "desk_id", "date", "approved_status"]
+    # The inserted row is referred to by its table name, as RETURNING is rendered without table names and
+    # SQLAlchemy would otherwise add bookings to the FROM of the subquery
+    room_id = (
+        select(models.Desk.room_id)
+        .where(models.Desk.id == literal_column("bookings.desk_id", Integer))
+        .scalar_subquery()
+    )
+    return (
+        dialect_insert(db)(models.Booking.__table__)
+        .from_select(
+            columns,
+            select(*[new_bookings.c[column] for column in columns]).where(~occurs),
+        )
+        .on_conflict_do_nothing()
+        .returning(*models.Booking.__table__.columns, room_id.label("room_id"))
+    )
+
+
+def booking_from_row(row):
+    """
+    Creates a detached booking from a row returned by insert_bookings_statement
+
+    Returns:
+        booking (models.Booking): The created booking, which is not part of any session
+        room_id (int): The room of the booked desk
+    """
+    values = dict(row._mapping)
+    room_id = values.pop("room_id")
+    return models.Booking(**values), room_id
 
 
 def create_booking(current_uuid: UUID, db: Session, booking: schemas.BookingCreate):
@@ -401,42 +997,403 @@ def create_booking(current_uuid: UUID, db: Session, booking: schemas.BookingCrea
             booking (schemas.BookingCreate): An object with the properties required to make a booking
 
     Returns:
-            user (models.user or None): The created booking
+            user (models.user or None): The created booking or None if the desk is already booked on that date
     """
-    logger.debug(f"{current_uuid} - Entered create booking function")
-    db_booking = models.Booking(
-        user_id=booking.user_id,
-        desk_id=booking.desk_id,
-        date=booking.date,
-        approved_status=booking.approved_status,
-    )
-    logger.debug(f"{current_uuid} - Created booking model")
-    db.add(db_booking)
+    logger.debug("%s - Entered create booking function", current_uuid)
+    # A single INSERT ... ON CONFLICT DO NOTHING RETURNING, so checking for an existing booking and creating
+    # the new one can't race, no row is returned if the desk is already booked that day
+    # The desk is locked first so a recurring booking can't be created for it in between (see lock_desks)
+    lock_desks(db, [booking.desk_id])
+    row = db.execute(insert_bookings_statement(db, [booking])).first()
     db.commit()
-    db.refresh(db_booking)
+    if row is None:
+        logger.info(
+            "%s - DESK(ID=%s) is already booked on %s",
+            current_uuid,
+            booking.desk_id,
+            booking.date,
+        )
+        return None
+    db_booking, room_id = booking_from_row(row)
+    bump_versions_after_commit(db, {room_bookings_version(room_id, db_booking.date)})
+    counting.cache.adjust(models.Booking, 1)
+    availability.index.add_booking(db_booking.desk_id, db_booking.date)
     logger.info(
-        f"{current_uuid} - BOOKING(ID={db_booking.id}, USER_ID={db_booking.user_id}) successfully created"
+        "%s - BOOKING(ID=%s, USER_ID=%s) successfully created",
+        current_uuid,
+        db_booking.id,
+        db_booking.user_id,
     )
-    logger.debug(f"{current_uuid} - Exiting create room function")
+    logger.debug("%s - Exiting create room function", current_uuid)
     return db_booking
 
 
-def get_users_bookings(current_uuid: UUID, db: Session, user_id: int):
+def create_bookings(
+    current_uuid: UUID, db: Session, bookings: list[schemas.BookingCreate]
+):
+    """
+    Creates several bookings in one multi-row statement and transaction, either all are created or none are
+
+    Parameters:
+            db (Session): A session of a database
+            bookings (List[schemas.BookingCreate]): The bookings to make
+
+    Returns:
+        results (List[dict]): For every booking in order, its desk ID, date, status and (if created) the created booking.
+                              The status is created, conflict (the desk is already booked), duplicate (the desk and date
+                              appear more than once) or not_created (rolled back because another booking failed)
+    """
+    logger.debug("%s - Entered create bookings function", current_uuid)
+    keys = [(booking.desk_id, booking.date) for booking in bookings]
+    key_counts = Counter(keys)
+    if any(count > 1 for count in key_counts.values()):
+        logger.info("%s - Batch books the same desk twice on one day", current_uuid)
+        return [
+            {
+                "desk_id": desk_id,
+                "date": date,
+                "status": "duplicate"
+                if key_counts[(desk_id, date)] > 1
+                else "not_created",
+                "booking": None,
+            }
+            for desk_id, date in keys
+        ]
+    lock_desks(db, [booking.desk_id for booking in bookings])
+    rows = [
+        booking_from_row(row)
+        for row in db.execute(insert_bookings_statement(db, bookings))
+    ]
+    created = {
+        (db_booking.desk_id, db_booking.date): db_booking for db_booking, _ in rows
+    }
+    if len(created) < len(bookings):
+        db.rollback()
+        logger.info(
+            "%s - %s desks in the batch are already booked, rolled back",
+            current_uuid,
+            len(bookings) - len(created),
+        )
+        return [
+            {
+                "desk_id": desk_id,
+                "date": date,
+                "status": "not_created" if (desk_id, date) in created else "conflict",
+                "booking": None,
+            }
+            for desk_id, date in keys
+        ]
+    db.commit()
+    bump_versions_after_commit(
+        db,
+        {
+            room_bookings_version(room_id, db_booking.date)
+            for db_booking, room_id in rows
+        },
+    )
+    counting.cache.adjust(models.Booking, len(created))
+    for desk_id, date in keys:
+        availability.index.add_booking(desk_id, date)
+    logger.info("%s - %s BOOKINGS successfully created", current_uuid, len(created))
+    logger.debug("%s - Exiting create bookings function", current_uuid)
+    return [
+        {
+            "desk_id": desk_id,
+            "date": date,
+            "status": "created",
+            "booking": created[(desk_id, date)],
+        }
+        for desk_id, date in keys
+    ]
+
+
+def find_adjacent_free_desks(
+    current_uuid: UUID, db: Session, room_id: int, date: datetime.date, count: int
+):
+    """
+    Finds the first run of adjacent desks (by desk number) in a room which are all free on a date
+
+    Parameters:
+            db (Session): A session of a database
+            room_id (int): An integer representing the rooms ID in the database
+            date (datetime.date): The date the desks must be free on
+            count (int): The number of adjacent desks needed
+
+    Returns:
+        desk_ids (List[int] or None): The IDs of the desks, or None if there is no such run
+    """
+    logger.debug("%s - Entered find adjacent free desks function", current_uuid)
+    desks = (
+        db.query(models.Desk.id, models.Booking.id, models.RecurringBooking.id)
+        .outerjoin(
+            models.Booking,
+            and_(models.Booking.desk_id == models.Desk.id, models.Booking.date == date),
+        )
+        .outerjoin(
+            models.RecurringBooking,
+            and_(
+                models.RecurringBooking.desk_id == models.Desk.id,
+                models.RecurringBooking.start_date <= date,
+                models.RecurringBooking.end_date >= date,
+                models.RecurringBooking.weekdays.op("&")(recurrence.weekday_bit(date))
+                != 0,
+            ),
+        )
+        .filter(models.Desk.room_id == room_id)
+        .order_by(models.Desk.number)
+        .all()
+    )
+    run = []
+    for desk_id, booking_id, recurring_booking_id in desks:
+        # A booked desk breaks the run of adjacent desks
+        if booking_id is None and recurring_booking_id is None:
+            run.append(desk_id)
+        else:
+            run = []
+        if len(run) == count:
+            logger.debug("%s - Exiting find adjacent free desks function", current_uuid)
+            return run
+    logger.info(
+        "%s - ROOM(ID=%s) has no %s adjacent free desks on %s",
+        current_uuid,
+        room_id,
+        count,
+        date,
+    )
+    return None
+
+
+def get_room_availability(
+    current_uuid: UUID,
+    db: Session,
+    room_id: int,
+    from_date: datetime.date,
+    to_date: datetime.date,
+):
+    """
+    Gets the status of every desk in a room for each day in a date range, using one aggregated query
+
+    Parameters:
+            db (Session): A session of a database
+            room_id (int): An integer representing the rooms ID in the database
+            from_date (datetime.date): The first day of the range
+            to_date (datetime.date): The last day of the range (inclusive)
+
+    Returns:
+        availability (List[dict] or None): Each desk with a status of free, booked or pending per day, or None if the room is not found
+    """
+    logger.debug("%s - Entered get room availability function", current_uuid)
+    # Rooms are outer joined to desks and bookings so an empty room, or a missing room, is known from the same query
+    # A desk with several bookings on one day counts as booked if any of them are approved
+    booked_days = (
+        select(
+            models.Desk.id,
+            models.Desk.number,
+            models.Booking.date,
+            func.max(cast(models.Booking.approved_status, Integer)),
+            cast(null(), Date),
+            cast(null(), Date),
+            cast(null(), Integer),
+        )
+        .select_from(models.Room)
+        .outerjoin(models.Desk, models.Desk.room_id == models.Room.id)
+        .outerjoin(
+            models.Booking,
+            and_(
+                models.Booking.desk_id == models.Desk.id,
+                models.Booking.date >= from_date,
+                models.Booking.date <= to_date,
+            ),
+        )
+        .where(models.Room.id == room_id)
+        .group_by(models.Desk.id, models.Desk.number, models.Booking.date)
+    )
+    # Recurring bookings overlapping the range come back in the same query as rules, expanded into days below
+    recurring_bookings = (
+        select(
+            models.Desk.id,
+            models.Desk.number,
+            cast(null(), Date),
+            cast(models.RecurringBooking.approved_status, Integer),
+            models.RecurringBooking.start_date,
+            models.RecurringBooking.end_date,
+            models.RecurringBooking.weekdays,
+        )
+        .join(models.Desk, models.RecurringBooking.desk_id == models.Desk.id)
+        .where(
+            models.Desk.room_id == room_id,
+            models.RecurringBooking.start_date <= to_date,
+            models.RecurringBooking.end_date >= from_date,
+        )
+    )
+    rows = db.execute(union_all(booked_days, recurring_bookings)).all()
+    if not rows:
+        logger.info("%s - ROOM(ID=%s) does not exist", current_uuid, room_id)
+        return None
+    days = [
+        from_date + timedelta(days=offset)
+        for offset in range((to_date - from_date).days + 1)
+    ]
+    desks = {}
+    for desk_id, number, date, approved, start_date, end_date, mask in rows:
+        if desk_id is None:
+            continue
+        if desk_id not in desks:
+            desks[desk_id] = {
+                "desk_id": desk_id,
+                "number": number,
+                "days": {day: "free" for day in days},
+            }
+        desk_days = desks[desk_id]["days"]
+        if mask is not None:
+            dates = recurrence.occurrences(
+                start_date, end_date, mask, from_date, to_date
+            )
+        else:
+            dates = [] if date is None else [date]
+        for date in dates:
+            desk_days[date] = (
+                "booked" if approved or desk_days[date] == "booked" else "pending"
+            )
+    logger.info(
+        "%s - Successfully retrived availability for ROOM(ID=%s)", current_uuid, room_id
+    )
+    logger.debug("%s - Exiting get room availability function", current_uuid)
+    return sorted(desks.values(), key=lambda desk: desk["number"])
+
+
+def create_recurring_booking(
+    current_uuid: UUID, db: Session, recurring_booking: schemas.RecurringBookingCreate
+):
+    """
+    Creates a recurring booking if none of its occurrences clash with a booking or another recurring booking of the desk.
+    Clashes are found with two queries over the whole date range rather than checking each occurrence.
+
+    Parameters:
+            db (Session): A session of a database
+            recurring_booking (schemas.RecurringBookingCreate): An object with the properties required to make a recurring booking
+
+    Returns:
+        result (tuple): The created recurring booking (None if there are clashes) and a sorted list of the clashing dates,
+                        for another recurring booking only the first date they share is listed
+    """
+    logger.debug("%s - Entered create recurring booking function", current_uuid)
+    mask = recurrence.weekdays_to_mask(recurring_booking.weekdays)
+    start_date = recurring_booking.start_date
+    end_date = recurring_booking.end_date
+    # Held until the commit, so no booking or recurring booking of the desk is created between the checks and
+    # the insert (see lock_desks)
+    lock_desks(db, [recurring_booking.desk_id])
+    booked_dates = (
+        db.query(models.Booking.date)
+        .filter(
+            models.Booking.desk_id == recurring_booking.desk_id,
+            models.Booking.date >= start_date,
+            models.Booking.date <= end_date,
+        )
+        .all()
+    )
+    conflicts = {
+        date for (date,) in booked_dates if mask & recurrence.weekday_bit(date)
+    }
+    # Only recurring bookings sharing a day of the week and overlapping the range can clash
+    overlapping_rules = (
+        db.query(
+            models.RecurringBooking.start_date,
+            models.RecurringBooking.end_date,
+            models.RecurringBooking.weekdays,
+        )
+        .filter(
+            models.RecurringBooking.desk_id == recurring_booking.desk_id,
+            models.RecurringBooking.start_date <= end_date,
+            models.RecurringBooking.end_date >= start_date,
+            models.RecurringBooking.weekdays.op("&")(mask) != 0,
+        )
+        .all()
+    )
+    for rule_start_date, rule_end_date, rule_mask in overlapping_rules:
+        shared_date = recurrence.first_shared_date(
+            start_date, end_date, mask, rule_start_date, rule_end_date, rule_mask
+        )
+        if shared_date is not None:
+            conflicts.add(shared_date)
+    if conflicts:
+        logger.info(
+            "%s - Recurring booking of DESK(ID=%s) clashes on %s dates",
+            current_uuid,
+            recurring_booking.desk_id,
+            len(conflicts),
+        )
+        return None, sorted(conflicts)
+    db_recurring_booking = models.RecurringBooking(
+        user_id=recurring_booking.user_id,
+        desk_id=recurring_booking.desk_id,
+        weekdays=mask,
+        start_date=start_date,
+        end_date=end_date,
+        approved_status=recurring_booking.approved_status,
+    )
+    db.add(db_recurring_booking)
+    room_id = (
+        db.query(models.Desk.room_id)
+        .filter(models.Desk.id == recurring_booking.desk_id)
+        .scalar()
+    )
+    if room_id is not None:
+        bump_versions(db, {room_recurring_bookings_version(room_id)})
+    db.commit()
+    db.refresh(db_recurring_booking)
+    availability.index.add_rule(
+        db_recurring_booking.id,
+        db_recurring_booking.desk_id,
+        start_date,
+        end_date,
+        mask,
+    )
+    logger.info(
+        "%s - RECURRING_BOOKING(ID=%s, USER_ID=%s) successfully created",
+        current_uuid,
+        db_recurring_booking.id,
+        db_recurring_booking.user_id,
+    )
+    logger.debug("%s - Exiting create recurring booking function", current_uuid)
+    return db_recurring_booking, []
+
+
+# The desk, room and user of each booking are many-to-one, so they are joined into the bookings query
+# This also lets an async session serialise the entities, as it can't lazy load
+USERS_BOOKINGS_LOAD_OPTIONS = loading.eager_load_options(
+    models.Booking, schemas.BookingSummary, strategy="joined"
+)
+
+
+def get_users_bookings(
+    current_uuid: UUID,
+    db: Session,
+    user_id: int,
+    schema: Union[BaseModel, None] = None,
+):
     """
     Gets all the bookings of a user, using their user id
 
     Parameters:
             db (Session): A session of a database
             user_id (int): An integer representing an users ID in the database
+            schema (BaseModel or None): If given only its columns are retrived, joined to those of its nested schemas,
+                                        as dictionaries instead of entities. Otherwise the desk, room and user of each
+                                        entity are eager loaded.
 
     Returns:
             bookings (List[models.booking] or None): A list of the retrived bookings or None if not found
     """
-    logger.debug(f"{current_uuid} - Running get users bookings function")
+    logger.debug("%s - Running get users bookings function", current_uuid)
     bookings_order = getattr(models.Booking, "date").desc()
-    return (
-        db.query(models.Booking)
-        .filter(models.Booking.user_id == user_id)
-        .order_by(bookings_order)
-        .all()
+    query, build = query_entities(db, models.Booking, schema)
+    if schema is None:
+        query = query.options(*USERS_BOOKINGS_LOAD_OPTIONS)
+    bookings = (
+        query.filter(models.Booking.user_id == user_id).order_by(bookings_order).all()
     )
+    if build is not None:
+        bookings = [build(row) for row in bookings]
+    return bookings
@@ -0,0 +1,249 @@
+import csv
+import io
+import json
+import logging
+from typing import BinaryIO, Iterator
+
+from sqlalchemy import Column, Integer, MetaData, Table, func, select, true
+from sqlalchemy.orm import Session
+
+from app import availability, counting, models, response_cache
+from app.crud import bump_versions, dialect_insert
+
+logger = logging.getLogger(__name__)
+
+# Bulk import of desks from a CSV or NDJSON upload
+# The rows are streamed into a temporary staging table (with COPY on PostgreSQL) and merged into desks with one
+# INSERT ... SELECT ... ON CONFLICT DO NOTHING, so an import is a handful of statements and one commit
+# however many desks it has, instead of a lookup, insert, commit and refresh per desk
+
+FORMATS = ("csv", "ndjson")
+# Most rows a single upload can have
+MAX_IMPORT_ROWS = 10000
+# Rows sent per executemany on databases without COPY
+INSERT_CHUNK_SIZE = 500
+
+staging_table = Table(
+    "desk_import",
+    MetaData(),
+    Column("line", Integer, nullable=False),
+    Column("number", Integer, nullable=False),
+    Column("room_id", Integer, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+
+
+def parse_rows(file: BinaryIO, format: str) -> Iterator[tuple]:
+    """
+    Reads the desks in an upload one row at a time
+
+    Parameters:
+            file (BinaryIO): The uploaded file
+            format (str): csv (with a number,room_id header) or ndjson (an object with number and room_id per line)
+
+    Returns:
+        rows (Iterator[tuple]): The line number, desk number and room ID of each row
+
+    Raises:
+        ValueError: If a row is malformed or there are more than MAX_IMPORT_ROWS rows
+    """
+    text = decode_lines(file)
+    if format == "csv":
+        records = csv.DictReader(text)
+        missing = {"number", "room_id"} - set(records.fieldnames or ())
+        if missing:
+            raise ValueError(f"CSV header is missing {', '.join(sorted(missing))}")
+        # The header is line 1
+        lines = ((records.line_num, record) for record in records)
+    else:
+        lines = (
+            (line_number, parse_json_line(line_number, line))
+            for line_number, line in enumerate(text, start=1)
+            if line.strip()
+        )
+    for count, (line_number, record) in enumerate(lines, start=1):
+        if count > MAX_IMPORT_ROWS:
+            raise ValueError(f"An import can not have more than {MAX_IMPORT_ROWS} rows")
+        try:
+            yield line_number, int(record["number"]), int(record["room_id"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(
+                f"Line {line_number} must have an integer number and room_id"
+            )
+
+
+def decode_lines(file: BinaryIO) -> Iterator[str]:
+    """
+    Decodes an upload as UTF-8 one line at a time, without a leading byte order mark.
+    io.TextIOWrapper isn't used as it needs readable(), which the SpooledTemporaryFile of an UploadFile only has
+    from Python 3.11. Lines are split on \n alone and keep their line endings, as the csv module expects.
+    """
+    for line_number, line in enumerate(file):
+        yield line.decode("utf-8-sig" if line_number == 0 else "utf-8")
+
+
+def parse_json_line(line_number: int, line: str):
+    try:
+        record = json.loads(line)
+    except ValueError:
+        raise ValueError(f"Line {line_number} is not valid JSON")
+    if not isinstance(record, dict):
+        raise ValueError(f"Line {line_number} must be a JSON object")
+    return record
+
+
+class CopyStream(io.RawIOBase):
+    """
+    A read-only file of the rows as CSV, so COPY can stream them without the whole upload being converted first
+    """
+
+    def __init__(self, rows: Iterator[tuple]):
+        self._rows = rows
+        self._buffer = b""
+        self.rows_read = 0
+        # The error which ended the rows early, as the driver reports it as COPY being cancelled
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def read(self, size: int = -1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                row = next(self._rows, None)
+            except ValueError as error:
+                self.error = error
+                raise
+            if row is None:
+                break
+            self.rows_read += 1
+            self._buffer += ("%d,%d,%d\n" % row).encode("ascii")
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def load_staging_table(db: Session, rows: Iterator[tuple]):
+    """
+    Loads the rows into the staging table, with COPY on PostgreSQL and batched inserts on other databases
+
+    Returns:
+        count (int): The number of rows loaded
+    """
+    connection = db.connection()
+    # A staging table left behind by a failed import on a pooled connection is replaced
+    staging_table.drop(connection, checkfirst=True)
+    staging_table.create(connection)
+    if connection.dialect.name == "postgresql":
+        stream = CopyStream(rows)
+        cursor = connection.connection.driver_connection.cursor()
+        try:
+            cursor.copy_expert(
+                "COPY desk_import (line, number, room_id) FROM STDIN WITH (FORMAT csv)",
+                stream,
+            )
+        except Exception:
+            if stream.error is not None:
+                raise stream.error
+            raise
+        finally:
+            cursor.close()
+        return stream.rows_read
+    count = 0
+    chunk = []
+    for line, number, room_id in rows:
+        chunk.append({"line": line, "number": number, "room_id": room_id})
+        if len(chunk) == INSERT_CHUNK_SIZE:
+            connection.execute(staging_table.insert(), chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        connection.execute(staging_table.insert(), chunk)
+        count += len(chunk)
+    return count
+
+
+def import_desks(current_uuid, db: Session, file: BinaryIO, format: str):
+    """
+    Creates every desk in an upload which doesn't already exist, in one transaction
+
+    Parameters:
+            db (Session): A session of a (synchronous) database, COPY is only available through psycopg2
+            file (BinaryIO): The uploaded file
+            format (str): csv or ndjson
+
+    Returns:
+        result (dict): The number of rows and created desks, and each row which was skipped with the reason why.
+                       A row is skipped as a duplicate (of an earlier row), exists (the desk is already in the room)
+                       or unknown_room
+
+    Raises:
+        ValueError: If the upload is malformed, in which case nothing is imported
+    """
+    logger.debug("%s - Entered import desks function", current_uuid)
+    try:
+        rows = load_staging_table(db, parse_rows(file, format))
+        key = (staging_table.c.number, staging_table.c.room_id)
+        # Desks repeated in the upload are grouped so each is inserted once, rows for missing rooms are left out
+        # The WHERE is needed by SQLite to parse ON CONFLICT after a SELECT with a join
+        new_desks = (
+            select(*key)
+            .join(models.Room, models.Room.id == staging_table.c.room_id)
+            .where(true())
+            .group_by(*key)
+        )
+        statement = (
+            dialect_insert(db)(models.Desk)
+            .from_select(["number", "room_id"], new_desks)
+            .on_conflict_do_nothing()
+            .returning(models.Desk.id, models.Desk.number, models.Desk.room_id)
+        )
+        created = {
+            (number, room_id): desk_id
+            for desk_id, number, room_id in db.execute(statement).all()
+        }
+        if created:
+            bump_versions(db, {models.Desk.__tablename__})
+        report = db.execute(
+            select(
+                staging_table.c.line,
+                *key,
+                func.min(staging_table.c.line).over(partition_by=key),
+                models.Room.id,
+            )
+            .outerjoin(models.Room, models.Room.id == staging_table.c.room_id)
+            .order_by(staging_table.c.line)
+        ).all()
+        staging_table.drop(db.connection())
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    skipped = []
+    for line, number, room_id, first_line, existing_room_id in report:
+        if line != first_line:
+            reason = "duplicate"
+        elif existing_room_id is None:
+            reason = "unknown_room"
+        elif (number, room_id) not in created:
+            reason = "exists"
+        else:
+            continue
+        skipped.append(
+            {"line": line, "number": number, "room_id": room_id, "reason": reason}
+        )
+    counting.cache.adjust(models.Desk, len(created))
+    for (number, room_id), desk_id in created.items():
+        availability.index.add_desk(desk_id, room_id, number)
+    if created:
+        response_cache.cache.invalidate_model(models.Desk)
+    logger.info(
+        "%s - Imported %s DESKS from %s rows, skipped %s",
+        current_uuid,
+        len(created),
+        rows,
+        len(skipped),
+    )
+    logger.debug("%s - Exiting import desks function", current_uuid)
+    return {"rows": rows, "created": len(created), "skipped": skipped}
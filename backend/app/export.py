@@ -0,0 +1,66 @@
+import csv
+import io
+import json
+from typing import Iterator
+
+# Formats bookings for export as they are streamed from the database
+# Each batch of rows fetched from the server-side cursor becomes one chunk of the response, so memory use stays
+# constant however many bookings are exported
+
+FORMATS = ("csv", "ndjson")
+MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+BOOKING_COLUMNS = ("id", "date", "desk_id", "user_id", "approved_status")
+
+
+def booking_csv_chunks(batches: Iterator[list]) -> Iterator[str]:
+    """
+    Converts batches of booking rows into CSV, starting with a header
+
+    Parameters:
+            batches (Iterator[List[tuple]]): Rows with the values of BOOKING_COLUMNS
+
+    Returns:
+        chunks (Iterator[str]): The CSV text of each batch
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(BOOKING_COLUMNS)
+    yield buffer.getvalue()
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(
+            (id, date.isoformat(), desk_id, user_id, "true" if approved else "false")
+            for id, date, desk_id, user_id, approved in batch
+        )
+        yield buffer.getvalue()
+
+
+def booking_ndjson_chunks(batches: Iterator[list]) -> Iterator[str]:
+    """
+    Converts batches of booking rows into newline delimited JSON, one object per booking
+
+    Parameters:
+            batches (Iterator[List[tuple]]): Rows with the values of BOOKING_COLUMNS
+
+    Returns:
+        chunks (Iterator[str]): The NDJSON text of each batch
+    """
+    for batch in batches:
+        yield "".join(
+            json.dumps(
+                {
+                    "id": id,
+                    "date": date.isoformat(),
+                    "desk_id": desk_id,
+                    "user_id": user_id,
+                    "approved_status": approved,
+                },
+                separators=(",", ":"),
+            )
+            + "\n"
+            for id, date, desk_id, user_id, approved in batch
+        )
+
+
+CHUNK_WRITERS = {"csv": booking_csv_chunks, "ndjson": booking_ndjson_chunks}
@@ -0,0 +1,128 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from app import metrics, security
+
+logger = logging.getLogger(__name__)
+
+# Runs bcrypt hashing and verification on a small dedicated process pool
+# Each bcrypt call takes hundreds of milliseconds of CPU, so running them on the request threadpool lets a burst
+# of logins starve every other endpoint. Here at most BCRYPT_POOL_SIZE hashes run at once, in other processes,
+# and at most BCRYPT_QUEUE_LIMIT more wait for a worker. Beyond that PasswordHashingBusy is raised straight away,
+# which the API returns as a 503, rather than requests queueing behind each other.
+
+# Processes hashing passwords, 0 hashes on the calling thread instead
+BCRYPT_POOL_SIZE = int(os.environ.get("BCRYPT_POOL_SIZE", 2))
+# Hashes that can wait for a free process before new ones are rejected
+BCRYPT_QUEUE_LIMIT = int(os.environ.get("BCRYPT_QUEUE_LIMIT", 16))
+
+
+class PasswordHashingBusy(Exception):
+    """
+    Raised when the password hashing pool and its queue are full
+    """
+
+
+class PasswordHashingPool:
+    def __init__(self, size: int, queue_limit: int):
+        self.size = size
+        self.queue_limit = queue_limit
+        self._lock = threading.Lock()
+        self._executor = None
+        # Hashes submitted and not yet finished, running or queued
+        self._in_flight = 0
+        self.rejected = 0
+
+    def _get_executor(self):
+        # Created on first use, with spawn so the workers don't inherit database connections or locks
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.size,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def submit(self, function, *args) -> Future:
+        """
+        Runs a function of security.py on the pool
+
+        Raises:
+            PasswordHashingBusy: If there are already size + queue_limit hashes running or waiting
+        """
+        start_time = time.perf_counter()
+        if self.size <= 0:
+            future = Future()
+            future.set_result(function(*args))
+            metrics.PASSWORD_HASH_DURATION.observe(
+                time.perf_counter() - start_time, (function.__name__,)
+            )
+            return future
+        executor = self._get_executor()
+        with self._lock:
+            if self._in_flight >= self.size + self.queue_limit:
+                self.rejected += 1
+                raise PasswordHashingBusy()
+            self._in_flight += 1
+        future = executor.submit(function, *args)
+        future.add_done_callback(
+            functools.partial(self._finished, function.__name__, start_time)
+        )
+        return future
+
+    def _finished(self, function_name: str, start_time: float, future: Future):
+        metrics.PASSWORD_HASH_DURATION.observe(
+            time.perf_counter() - start_time, (function_name,)
+        )
+        with self._lock:
+            self._in_flight -= 1
+
+    def statistics(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "queue_limit": self.queue_limit,
+                "in_flight": self._in_flight,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+pool = PasswordHashingPool(size=BCRYPT_POOL_SIZE, queue_limit=BCRYPT_QUEUE_LIMIT)
+
+
+def hash_password(password: str):
+    """
+    Hashes a password on the pool, waiting for the result
+    """
+    return pool.submit(security.get_hashed_password, password).result()
+
+
+def hash_passwords(passwords: list[str]):
+    """
+    Hashes several passwords on the pool at once, so they are hashed in parallel
+    """
+    futures = [
+        pool.submit(security.get_hashed_password, password) for password in passwords
+    ]
+    return [future.result() for future in futures]
+
+
+async def verify_password(plain_password: str, hashed_password: str):
+    """
+    Verifies a password on the pool, awaiting the result so no thread is held while it waits
+    """
+    return await asyncio.wrap_future(
+        pool.submit(security.verify_password, plain_password, hashed_password)
+    )
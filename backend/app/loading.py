@@ -0,0 +1,105 @@
+from pydantic import BaseModel
+from sqlalchemy.orm import aliased, joinedload, selectinload
+
+# Loads the nested schemas of a response schema with the query, instead of pydantic triggering a lazy load per row
+# (and per nested row) while serialising. Read only endpoints project the schema, selecting only its columns (joined
+# to those of its nested schemas) as plain rows, which also skip the identity map and change tracking of ORM entities.
+# Queries that return entities use the eager loading options instead.
+
+STRATEGIES = {"joined": joinedload, "selectin": selectinload}
+
+
+def eager_load_options(model, schema: BaseModel, strategy: str = "selectin"):
+    """
+    Creates loader options for every relationship of a model that is included as a nested schema
+
+    Parameters:
+            model (models): The table, represented as a model, being queried
+            schema (BaseModel): The response schema the entities are serialised with
+            strategy (str): joined loads relationships in the same query (suits many-to-one relationships),
+                            selectin loads each relationship with one extra query (suits collections)
+
+    Returns:
+        options (List[Load]): Options to pass to Query.options()
+    """
+    options = []
+    relationships = model.__mapper__.relationships
+    for field in schema.__fields__.values():
+        if field.name not in relationships or not (
+            isinstance(field.type_, type) and issubclass(field.type_, BaseModel)
+        ):
+            continue
+        option = STRATEGIES[strategy](getattr(model, field.name))
+        nested_options = eager_load_options(
+            relationships[field.name].mapper.class_, field.type_, strategy
+        )
+        options.append(option.options(*nested_options) if nested_options else option)
+    return options
+
+
+def _nested_schema(model, field):
+    relationships = model.__mapper__.relationships
+    if field.name not in relationships or not (
+        isinstance(field.type_, type) and issubclass(field.type_, BaseModel)
+    ):
+        return None
+    relationship = relationships[field.name]
+    if relationship.uselist:
+        raise ValueError(f"{field.name} is a collection, which can't be projected")
+    return relationship
+
+
+def _project(model, entity, schema: BaseModel, prefix: str, columns: list, joins: list):
+    # Returns the fields of the schema, each either the label of its column or the fields of a nested schema
+    # Nested columns are labelled <field>__<column>, so they can't clash with a column such as desk_id
+    fields = {}
+    for field in schema.__fields__.values():
+        relationship = _nested_schema(model, field)
+        if relationship is not None:
+            target = aliased(relationship.mapper.class_)
+            joins.append(getattr(entity, field.name).of_type(target))
+            fields[field.name] = _project(
+                relationship.mapper.class_,
+                target,
+                field.type_,
+                f"{prefix}{field.name}__",
+                columns,
+                joins,
+            )
+        elif field.name in model.__mapper__.column_attrs:
+            label = f"{prefix}{field.name}"
+            columns.append(getattr(entity, field.name).label(label))
+            fields[field.name] = label
+        # Other fields aren't stored in the table, so are left to their default
+    return fields
+
+
+def _build(fields: dict, row):
+    return {
+        name: row[label] if isinstance(label, str) else _build(label, row)
+        for name, label in fields.items()
+    }
+
+
+def projection(model, schema: BaseModel):
+    """
+    Selects only the columns of a response schema, joining the tables of its nested schemas
+
+    Parameters:
+            model (models): The table, represented as a model, being queried
+            schema (BaseModel): The response schema the rows are serialised with
+
+    Returns:
+        projection (tuple): The labelled columns to query, the relationships to join to and a function which converts
+                            each row into a dictionary for the schema. The function is None if nothing is nested,
+                            as the rows can be serialised as they are.
+
+    Raises:
+        ValueError: If the schema nests a collection
+    """
+    columns = []
+    joins = []
+    fields = _project(model, model, schema, "", columns, joins)
+    if not joins:
+        return columns, joins, None
+    return columns, joins, lambda row: _build(fields, row._mapping)
@@ -0,0 +1,101 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+
+# Handlers for logging.conf.json which keep writing logs off the request threads. A QueueListenerHandler only puts
+# each record on a queue, which a listener thread drains into the handlers it names (the console and rotating files),
+# so a request never waits on stdout or the disk. Records are dropped and counted rather than blocking when a bounded
+# queue is full. RequestUUIDFilter tags records with the UUID of the request they were logged during, and
+# JSONFormatter writes them as one JSON object per line keyed by that UUID, for log shippers.
+# Handlers are configured in name order, so the handlers a QueueListenerHandler names must sort before it.
+
+request_uuid = contextvars.ContextVar("request_uuid", default=None)
+
+# Attributes every LogRecord has, anything else was passed with extra= and is added to JSON output
+RECORD_ATTRIBUTES = frozenset(
+    vars(logging.LogRecord("", logging.INFO, "", 0, "", None, None))
+) | {"message", "asctime", "uuid"}
+
+
+def _handler_by_name(name: str):
+    if hasattr(logging, "getHandlerByName"):
+        return logging.getHandlerByName(name)
+    return logging._handlers.get(name)
+
+
+class QueueListenerHandler(logging.handlers.QueueHandler):
+    """
+    Queues records for the named handlers, which a background thread writes them to.
+    Configured in logging.conf.json with "()" rather than "class", for example:
+        "queue": {"()": "app.log_pipeline.QueueListenerHandler", "handlers": ["console", "file_handler"]}
+
+    Parameters:
+            handlers (List[str]): Names of the handlers to write records to, configured before this one
+            queue_size (int): Records that can wait to be written before new ones are dropped, 0 is unbounded
+            respect_handler_level (bool): Whether the level of each handler is applied to the records it is given
+    """
+
+    def __init__(self, handlers, queue_size: int = 0, respect_handler_level=True):
+        super().__init__(queue.Queue(queue_size))
+        targets = []
+        for name in handlers:
+            handler = _handler_by_name(name)
+            if handler is None:
+                raise ValueError(
+                    f"Handler {name} must be configured before the queue handler writing to it"
+                )
+            targets.append(handler)
+        self.dropped = 0
+        self.listener = logging.handlers.QueueListener(
+            self.queue, *targets, respect_handler_level=respect_handler_level
+        )
+        self.listener.start()
+        self._listening = True
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # Writes the records still queued, logging.shutdown closes handlers newest first so the targets are open
+        if self._listening:
+            self._listening = False
+            self.listener.stop()
+        super().close()
+
+
+class RequestUUIDFilter(logging.Filter):
+    """
+    Adds the UUID of the request being handled to each record as record.uuid, or None outside of a request.
+    Attach it to the queue handler, so it runs on the thread that logged the record.
+    """
+
+    def filter(self, record: logging.LogRecord):
+        if not hasattr(record, "uuid"):
+            record.uuid = request_uuid.get()
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as JSON objects with their time, level, logger, request UUID, message and any extra fields
+    """
+
+    def format(self, record: logging.LogRecord):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "uuid": getattr(record, "uuid", None),
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
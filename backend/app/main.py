@@ -1,28 +1,49 @@
 import logging
-import uuid
-import time
 
-from typing import Union
-from urllib.parse import urlencode
-from fastapi import Depends, FastAPI, HTTPException, status, Response, Request, Query
-from fastapi.responses import RedirectResponse
+from typing import Literal, Union
+from fastapi import (
+    Depends,
+    FastAPI,
+    HTTPException,
+    status,
+    Response,
+    Request,
+    Query,
+    UploadFile,
+)
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 import datetime
 
-from app import crud, security, schemas, auth, models
+from app import crud, schemas, auth, models, pool_statistics, availability
+from app import principal_cache, hashing, rate_limiting, response_cache
+from app import pagination, counting, desk_import, export, fast_json, middleware
+from app import metrics
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.database import SessionLocal
+from app import database
+from app.database import SessionLocal, AsyncSessionLocal, AnySession
 
 from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
 
 logger = logging.getLogger(__name__)
 
-limiter = Limiter(key_func=get_remote_address, default_limits=["35/minute"])
+# The storage and strategy are configured by enviroment variables, see rate_limiting.py
+# If shared storage can't be reached each worker falls back to limiting in its own memory
+# Requests are counted per user, or per IP address without a token. Expensive endpoints are decorated with
+# limiter.shared_limit to draw a weighted cost from one budget instead of the per endpoint default limit
+limiter = Limiter(
+    key_func=rate_limiting.rate_limit_key,
+    default_limits=[rate_limiting.DEFAULT_RATE_LIMIT],
+    storage_uri=rate_limiting.RATE_LIMIT_STORAGE_URI,
+    strategy=rate_limiting.RATE_LIMIT_STRATEGY,
+    in_memory_fallback=[rate_limiting.DEFAULT_RATE_LIMIT],
+)
 
 app = FastAPI(
     title="Desk Booking API",
@@ -35,6 +56,21 @@ app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 app.add_middleware(SlowAPIMiddleware)
 
+
+def password_hashing_busy_handler(request: Request, exc: hashing.PasswordHashingBusy):
+    """
+    Fails fast when too many passwords are already being hashed, instead of queueing more requests behind them
+    """
+    logger.warning("%s - Password hashing pool is full", request.state.uuid)
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many login attempts in progress, try again shortly"},
+        headers={"Retry-After": "1"},
+    )
+
+
+app.add_exception_handler(hashing.PasswordHashingBusy, password_hashing_busy_handler)
+
 # Allowing for CORS, so frontend can call on API endpoints
 
 origins = ["http://localhost:3000"]
@@ -57,55 +93,204 @@ def get_db():
         db.close()
 
 
-@app.middleware("http")
-def flatten_query_string_lists(request: Request, call_next):
-    """
-    Middleware to convert query strings into the correct format for fastAPI.
-    Correctly formatted strings will be unaffected.
-    Example input: http://localhost:8000/users?&range=[0,9]&sort=["id","ASC"]
-    Converted to : http://localhost:8000/users?&range=0&range=9&sort=id&sort=ASC
+# Dependency for retriving an async database session, only available when DATABASE_MODE is async
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
 
-    Parameters:
-            request (Request):
-            call_next (function):
 
-    Returns:
-        callback_func (function or None):
-    """
+# Session used by the database bound endpoints, selected by DATABASE_MODE
+# Registering is dominated by bcrypt, so it always uses a sync session on the threadpool
+get_session = get_async_db if database.DATABASE_MODE == "async" else get_db
+
+
+# Added last so they run first, every request is given its UUID before any other middleware runs
+# Metrics are recorded inside FlattenQueryStringListsMiddleware, as it replaces the scope the route is read from
+app.add_middleware(middleware.MetricsMiddleware)
+app.add_middleware(middleware.FlattenQueryStringListsMiddleware)
+app.add_middleware(middleware.RequestLoggingMiddleware)
+
+
+@app.on_event("shutdown")
+def shutdown_password_hashing_pool():
+    hashing.pool.shutdown()
+
+
+@app.on_event("startup")
+def start_metrics_flusher():
+    # Only needed to share this workers metrics with the others, see metrics.py
+    if metrics.METRICS_DIR:
+        metrics.flusher.start()
+
+
+@app.on_event("shutdown")
+def stop_metrics_flusher():
+    metrics.flusher.stop()
+
+
+@app.on_event("startup")
+def bootstrap_database():
+    # Off by default, the database is created by "python -m app.bootstrap" before the workers start
+    if database.DATABASE_BOOTSTRAP:
+        database.bootstrap_database()
 
-    flattened = []
 
-    for key, value in request.query_params.multi_items():
-        value = value.strip("[]")
-        for entry in value.split(","):
-            entry = entry.strip('""')
-            if entry.isdigit():
-                flattened.append((key, int(entry)))
-            else:
-                flattened.append((key, entry))
-    request.scope["query_string"] = urlencode(flattened, doseq=True).encode("utf-8")
+@app.on_event("startup")
+def build_availability_index():
+    db = SessionLocal()
+    try:
+        availability.index.rebuild(db)
+    finally:
+        db.close()
+
 
-    return call_next(request)
+async def set_content_range(
+    request: Request,
+    response: Response,
+    db: AnySession,
+    model: Union[models.User, models.Room, models.Desk, models.Booking],
+    range: Union[list[int], None],
+    count: Union[int, None],
+    filters: tuple = (),
+):
+    """
+    Sets the Content-Range header of a list endpoint in the format "<table> <start>-<end>/<total>", as used by react-admin.
+    The total comes from the count strategy of the table (see counting.py).
+    """
+    total = await database.run_in_session(
+        db,
+        counting.count_entities,
+        current_uuid=request.state.uuid,
+        model=model,
+        filters=filters,
+    )
+    start = range[0] if range is not None else 0
+    if count:
+        # Estimated totals can lag behind, but never report fewer entities than were returned
+        total = max(total, start + count)
+        content_range = f"{start}-{start + count - 1}/{total}"
+    else:
+        content_range = f"*/{total}"
+    response.headers["Content-Range"] = f"{model.__tablename__} {content_range}"
+    response.headers["Access-Control-Expose-Headers"] = "Content-Range"
 
 
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    generated_uuid = str(uuid.uuid4())
-    logger.info(
-        f"{generated_uuid} - Start of {request.method} request to path {request.url.path[1:]}"
+async def check_etag(
+    request: Request, response: Response, db: AnySession, versions: tuple
+):
+    """
+    Sets a strong ETag from the versions of the tables or rows a response is read from (see crud.get_versions).
+    If the client already has that version a 304 is raised, before the response is queried or serialized.
+    """
+    current_uuid = request.state.uuid
+    etag = '"%s"' % "-".join(
+        str(version)
+        for version in await database.run_in_session(
+            db, crud.get_versions, current_uuid=current_uuid, names=versions
+        )
     )
-    start_time = time.time()
-    request.state.uuid = generated_uuid
+    response.headers["ETag"] = etag
+    # Also keys the response cache, see response_cache.py
+    request.state.etag = etag
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        client_etags = {
+            tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+        }
+        if etag in client_etags or "*" in client_etags:
+            logger.info("%s - Client already has the current version", current_uuid)
+            raise HTTPException(status_code=304, headers={"ETag": etag})
+
+
+def list_response(response: Response, entities: list, schema):
+    """
+    Returns the entities of a list endpoint, encoded straight to JSON when FAST_JSON_RESPONSES is set (see fast_json.py)
+    """
+    if fast_json.FAST_JSON_RESPONSES:
+        return fast_json.list_response(entities, schema, response)
+    return entities
+
+
+def read_cached_list(request: Request, response: Response, route: str):
+    """
+    Returns the entities of a list endpoint from the response cache, setting the Content-Range header they were
+    returned with, or None if they aren't cached (see response_cache.py)
+    """
+    cached = response_cache.cache.get(route, response_cache.cache_key(request))
+    if cached is None:
+        return None
+    entities, content_range = cached
+    response.headers["Content-Range"] = content_range
+    response.headers["Access-Control-Expose-Headers"] = "Content-Range"
+    logger.debug("%s - Returning %s from the response cache", request.state.uuid, route)
+    return entities
 
-    response = await call_next(request)
 
-    process_time = (time.time() - start_time) * 1000
-    formatted_process_time = "{0:.2f}".format(process_time)
-    logger.info(
-        f"{generated_uuid} - Response sent, completed in {formatted_process_time}ms with status code {response.status_code}"
+def cache_list(
+    request: Request,
+    response: Response,
+    route: str,
+    entities: list,
+    schema: Union[schemas.Room, schemas.Desk],
+    tables: tuple,
+):
+    """
+    Caches the entities of a list endpoint along with its Content-Range header, returning them as schemas
+    """
+    entities = [schema.from_orm(entity) for entity in entities]
+    response_cache.cache.put(
+        route,
+        response_cache.cache_key(request),
+        (entities, response.headers["Content-Range"]),
+        tables=tables,
     )
+    return entities
+
 
-    return response
+async def read_page_by_cursor(
+    request: Request,
+    response: Response,
+    db: AnySession,
+    model: Union[models.User, models.Room, models.Desk, models.Booking],
+    schema: Union[schemas.User, schemas.Room, schemas.Desk, schemas.Booking],
+    sort: Union[list[str], None],
+    cursor: Union[str, None],
+    limit: Union[int, None],
+    filters: tuple = (),
+):
+    """
+    Cursor mode of the list endpoints, used instead of range when a cursor or limit is passed in.
+    The cursor for the following page is returned in the X-Next-Cursor header, which is left out on the last page.
+    """
+    current_uuid = request.state.uuid
+    try:
+        entities, next_cursor = await database.run_in_session(
+            db,
+            crud.get_entities_by_cursor,
+            current_uuid=current_uuid,
+            cursor=cursor,
+            limit=limit or pagination.DEFAULT_PAGE_SIZE,
+            sort=sort,
+            model=model,
+            filters=filters,
+        )
+    except ValueError as error:
+        logger.info("%s - Invalid cursor or sort requested", current_uuid)
+        raise HTTPException(status_code=400, detail=str(error))
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    # The position of a cursor page is unknown, so only the total is given
+    await set_content_range(
+        request=request,
+        response=response,
+        db=db,
+        model=model,
+        range=None,
+        count=None,
+        filters=filters,
+    )
+    response.headers["Access-Control-Expose-Headers"] = "Content-Range, X-Next-Cursor"
+    return list_response(response=response, entities=entities, schema=schema)
 
 
 # Start of request mapping, majority of functions only perform a call to crud.py with some error handling
@@ -117,7 +302,7 @@ async def log_requests(request: Request, call_next):
 @app.get("/", response_class=RedirectResponse, include_in_schema=False)
 def docs(request: Request):
     current_uuid = request.state.uuid
-    logger.info(f"{current_uuid} - Redirecting request to /docs")
+    logger.info("%s - Redirecting request to /docs", current_uuid)
     return RedirectResponse(url="/docs")
 
 
@@ -126,10 +311,10 @@ def docs(request: Request):
 
 
 @app.post("/login", response_model=schemas.Token)
-def login_and_get_token(
+async def login_and_get_token(
     request: Request,
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_session),
 ):
     """
     Checks if a user exists using the authenticate user function. If they don't they are unautherised.
@@ -143,8 +328,9 @@ def login_and_get_token(
         JWT (dictionary): A dictionary containing the JWTs access and refresh token as well as the token type
     """
     current_uuid = request.state.uuid
-    logger.debug(f"{current_uuid} - Entered login and get token function")
-    user = auth.authenticate_user(
+    logger.debug("%s - Entered login and get token function", current_uuid)
+    # Awaits the password check on the hashing pool, rather than holding a threadpool thread while it runs
+    user = await auth.authenticate_user(
         current_uuid, db, form_data.username, form_data.password
     )
     if not user:
@@ -153,31 +339,71 @@ def login_and_get_token(
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = datetime.timedelta(
-        minutes=security.ACCESS_TOKEN_EXPIRE_MINUTES
+    refresh_token_id, family_id = await database.run_in_session(
+        db,
+        crud.create_refresh_token,
+        current_uuid=current_uuid,
+        user_id=user.id,
+        expires_at=auth.refresh_token_expiry(),
     )
-    refresh_token_expires = datetime.timedelta(
-        minutes=security.REFRESH_TOKEN_EXPIRE_MINUTES
+
+    logger.info("%s - Generated JWTs", current_uuid)
+    logger.debug("%s - Exiting login and get token function", current_uuid)
+
+    return auth.create_token_pair(
+        current_uuid=current_uuid,
+        username=user.username,
+        user_id=user.id,
+        refresh_token_id=refresh_token_id,
+        family_id=family_id,
     )
 
-    logger.info(f"{current_uuid} - Generated JWTs")
-    logger.debug(f"{current_uuid} - Exiting login and get token function")
 
-    return {
-        "access_token": auth.generic_token_creation(
-            current_uuid=current_uuid,
-            data={"sub": user.username},
-            expires_delta=access_token_expires,
-            token_type="access",
-        ),
-        "refresh_token": auth.generic_token_creation(
-            current_uuid=current_uuid,
-            data={"sub": user.username},
-            expires_delta=refresh_token_expires,
-            token_type="refresh",
-        ),
-        "token_type": "bearer",
-    }
+@app.post("/token/refresh", response_model=schemas.Token)
+async def refresh_token(
+    request: Request,
+    token: schemas.TokenRefresh,
+    db: AnySession = Depends(get_session),
+):
+    """
+    Exchanges a refresh token for a new access token and refresh token, without checking the password again.
+    Each refresh token can only be used once. If a used one is sent again, it has leaked, so every token
+    descended from the same login is revoked and the user has to log in again.
+
+    Parameters:
+            db (Session): A session of a database (from dependancy)
+            token (schemas.TokenRefresh): Contains the refresh token returned by login or a previous refresh
+
+    Returns:
+        JWT (dictionary): A dictionary containing the JWTs access and refresh token as well as the token type
+    """
+    current_uuid = request.state.uuid
+    logger.debug("%s - Entered refresh token function", current_uuid)
+    token_id, family_id = auth.decode_refresh_token(current_uuid, token.refresh_token)
+    rotation = await database.run_in_session(
+        db,
+        crud.rotate_refresh_token,
+        current_uuid=current_uuid,
+        token_id=token_id,
+        family_id=family_id,
+        expires_at=auth.refresh_token_expiry(),
+    )
+    if rotation is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Refresh token is no longer valid",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    user, new_token_id = rotation
+    logger.info("%s - Generated JWTs from refresh token", current_uuid)
+    logger.debug("%s - Exiting refresh token function", current_uuid)
+    return auth.create_token_pair(
+        current_uuid=current_uuid,
+        username=user.username,
+        user_id=user.id,
+        refresh_token_id=new_token_id,
+        family_id=family_id,
+    )
 
 
 # Registers both endpoints to keep to REST standards
@@ -189,15 +415,17 @@ def create_user(
     request: Request, user: schemas.UserCreate, db: Session = Depends(get_db)
 ):
     current_uuid = request.state.uuid
-    logger.debug(f"{current_uuid} - Entered create user function")
+    logger.debug("%s - Entered create user function", current_uuid)
     db_user = crud.get_user_by_username(
         current_uuid=current_uuid, db=db, username=user.username
     )
     if db_user:
-        logger.info(f"{current_uuid} - Email alreadys exists, user will not be created")
+        logger.info(
+            "%s - Email alreadys exists, user will not be created", current_uuid
+        )
         raise HTTPException(status_code=400, detail="Email already registered")
-    logger.debug(f"{current_uuid} - Exiting create user function")
-    logger.info(f"{current_uuid} - Creating user")
+    logger.debug("%s - Exiting create user function", current_uuid)
+    logger.info("%s - Creating user", current_uuid)
     return crud.create_user(current_uuid=current_uuid, db=db, user=user)
 
 
@@ -206,50 +434,81 @@ def create_user(
     response_model=list[schemas.User],
     dependencies=[Depends(auth.is_admin)],
 )
-def read_users(
+@limiter.shared_limit(
+    rate_limiting.EXPENSIVE_RATE_LIMIT, scope="expensive", cost=rate_limiting.list_cost
+)
+async def read_users(
     request: Request,
     response: Response,
     range: Union[list[int], None] = Query(default=None),
     sort: Union[list[str], None] = Query(default=["id", "ASC"]),
-    db: Session = Depends(get_db),
+    cursor: Union[str, None] = Query(default=None),
+    limit: Union[int, None] = Query(default=None, ge=1, le=pagination.MAX_PAGE_SIZE),
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    logger.debug(f"{current_uuid} - Entered read users function")
-    users = crud.get_all_entities(
-        current_uuid=current_uuid, db=db, range=range, sort=sort, model=models.User
+    if cursor is not None or limit is not None:
+        return await read_page_by_cursor(
+            request=request,
+            response=response,
+            db=db,
+            model=models.User,
+            schema=schemas.User,
+            sort=sort,
+            cursor=cursor,
+            limit=limit,
+        )
+    logger.debug("%s - Entered read users function", current_uuid)
+    users = await database.run_in_session(
+        db,
+        crud.get_all_entities,
+        current_uuid=current_uuid,
+        range=range,
+        sort=sort,
+        model=models.User,
+        schema=schemas.User,
     )
-    logger.info(f"{current_uuid} - Retrived users")
-    response.headers["Content-Range"] = str(len(users))
-    response.headers["Access-Control-Expose-Headers"] = "Content-Range"
-    logger.debug(f"{current_uuid} - Exiting read users function")
-    return users
+    logger.info("%s - Retrived users", current_uuid)
+    await set_content_range(
+        request=request,
+        response=response,
+        db=db,
+        model=models.User,
+        range=range,
+        count=len(users),
+    )
+    logger.debug("%s - Exiting read users function", current_uuid)
+    return list_response(response=response, entities=users, schema=schemas.User)
 
 
 @app.get("/users/{user_id}", response_model=schemas.User)
-def read_user(
+async def read_user(
     request: Request,
     user_id: int,
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_session),
     current_user: schemas.User = Depends(auth.get_current_active_user),
 ):
     current_uuid = request.state.uuid
-    logger.debug(f"{current_uuid} - Entered read users function")
-    db_user: schemas.User = crud.get_entity(
-        current_uuid=current_uuid, db=db, id=user_id, model=models.User
+    logger.debug("%s - Entered read users function", current_uuid)
+    db_user: schemas.User = await database.run_in_session(
+        db, crud.get_entity, current_uuid=current_uuid, id=user_id, model=models.User
     )
     if db_user is None:
-        logger.info(f"{request.state.uuid} - Requested user ID does not exist")
+        logger.info("%s - Requested user ID does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="User not found")
     elif db_user.id != current_user.id and current_user.admin == False:
         logger.info(
-            f"{request.state.uuid} - USER(ID={current_user.id} USERNAME={current_user.username}) attempted to get another users resource"
+            "%s - USER(ID=%s USERNAME=%s) attempted to get another users resource",
+            request.state.uuid,
+            current_user.id,
+            current_user.username,
         )
         raise HTTPException(status_code=403, detail="Operation not permitted")
     return db_user
 
 
 @app.get("/users/me/", response_model=schemas.User)
-def read_own_details(
+async def read_own_details(
     request: Request,
     current_user: schemas.User = Depends(auth.get_current_active_user),
 ):
@@ -258,28 +517,32 @@ def read_own_details(
 
 
 @app.patch("/users/{user_id}")
-def update_user(
+async def update_user(
     request: Request,
     user_id: int,
     user: schemas.UserUpdate,
     current_user: schemas.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    existing_user: schemas.User = crud.get_entity(
-        current_uuid=current_uuid, db=db, id=user_id, model=models.User
+    existing_user: schemas.User = await database.run_in_session(
+        db, crud.get_entity, current_uuid=current_uuid, id=user_id, model=models.User
     )
     if existing_user is None:
-        logger.info(f"{request.state.uuid} - Requested user ID does not exist")
+        logger.info("%s - Requested user ID does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="User not found")
     elif existing_user.id != current_user.id and current_user.admin == False:
         logger.info(
-            f"{request.state.uuid} - USER(ID={current_user.id} USERNAME={current_user.username}) attempted to get another users resource"
+            "%s - USER(ID=%s USERNAME=%s) attempted to get another users resource",
+            request.state.uuid,
+            current_user.id,
+            current_user.username,
         )
         raise HTTPException(status_code=403, detail="Operation not permitted")
-    updated_user = crud.update_entity(
+    updated_user = await database.run_in_session(
+        db,
+        crud.update_entity,
         current_uuid=current_uuid,
-        db=db,
         entity_to_update=existing_user,
         updates=user,
         model=models.User,
@@ -288,15 +551,19 @@ def update_user(
 
 
 @app.delete("/users/{user_id}", status_code=204, dependencies=[Depends(auth.is_admin)])
-def delete_user(request: Request, user_id: int, db: Session = Depends(get_db)):
+async def delete_user(
+    request: Request, user_id: int, db: AnySession = Depends(get_session)
+):
     current_uuid = request.state.uuid
-    user_to_delete = crud.get_entity(
-        current_uuid=current_uuid, db=db, id=user_id, model=models.User
+    user_to_delete = await database.run_in_session(
+        db, crud.get_entity, current_uuid=current_uuid, id=user_id, model=models.User
     )
     if user_to_delete is None:
-        logger.info(f"{request.state.uuid} - Requested ID for deletion does not exist")
+        logger.info("%s - Requested ID for deletion does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="User not found")
-    crud.delete_entity(current_uuid=current_uuid, db=db, id=user_id, model=models.User)
+    await database.run_in_session(
+        db, crud.delete_entity, current_uuid=current_uuid, id=user_id, model=models.User
+    )
 
 
 # Room Endpoints
@@ -307,17 +574,19 @@ def delete_user(request: Request, user_id: int, db: Session = Depends(get_db)):
     response_model=schemas.Room,
     dependencies=[Depends(auth.get_current_active_user)],
 )
-def create_room(
-    request: Request, room: schemas.RoomCreate, db: Session = Depends(get_db)
+async def create_room(
+    request: Request, room: schemas.RoomCreate, db: AnySession = Depends(get_session)
 ):
     current_uuid = request.state.uuid
-    db_room = crud.get_room_by_name(
-        current_uuid=current_uuid, db=db, room_name=room.name
+    db_room = await database.run_in_session(
+        db, crud.get_room_by_name, current_uuid=current_uuid, room_name=room.name
     )
     if db_room:
-        logger.info(f"{request.state.uuid} - Room already exists")
+        logger.info("%s - Room already exists", request.state.uuid)
         raise HTTPException(status_code=400, detail="Room already exists")
-    return crud.create_room(current_uuid=current_uuid, db=db, room=room)
+    return await database.run_in_session(
+        db, crud.create_room, current_uuid=current_uuid, room=room
+    )
 
 
 @app.get(
@@ -325,20 +594,60 @@ def create_room(
     response_model=list[schemas.Room],
     dependencies=[Depends(auth.get_current_active_user)],
 )
-def read_rooms(
+@limiter.shared_limit(
+    rate_limiting.EXPENSIVE_RATE_LIMIT, scope="expensive", cost=rate_limiting.list_cost
+)
+async def read_rooms(
     request: Request,
     response: Response,
     range: Union[list[int], None] = Query(default=None),
     sort: Union[list[str], None] = Query(default=["id", "ASC"]),
-    db: Session = Depends(get_db),
+    cursor: Union[str, None] = Query(default=None),
+    limit: Union[int, None] = Query(default=None, ge=1, le=pagination.MAX_PAGE_SIZE),
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    rooms = crud.get_all_entities(
-        current_uuid=current_uuid, db=db, range=range, sort=sort, model=models.Room
+    await check_etag(request=request, response=response, db=db, versions=("rooms",))
+    if cursor is not None or limit is not None:
+        return await read_page_by_cursor(
+            request=request,
+            response=response,
+            db=db,
+            model=models.Room,
+            schema=schemas.Room,
+            sort=sort,
+            cursor=cursor,
+            limit=limit,
+        )
+    rooms = read_cached_list(request=request, response=response, route="/rooms")
+    if rooms is not None:
+        return list_response(response=response, entities=rooms, schema=schemas.Room)
+    rooms = await database.run_in_session(
+        db,
+        crud.get_all_entities,
+        current_uuid=current_uuid,
+        range=range,
+        sort=sort,
+        model=models.Room,
+        schema=schemas.Room,
     )
-    response.headers["Content-Range"] = str(len(rooms))
-    response.headers["Access-Control-Expose-Headers"] = "Content-Range"
-    return rooms
+    await set_content_range(
+        request=request,
+        response=response,
+        db=db,
+        model=models.Room,
+        range=range,
+        count=len(rooms),
+    )
+    rooms = cache_list(
+        request=request,
+        response=response,
+        route="/rooms",
+        entities=rooms,
+        schema=schemas.Room,
+        tables=(models.Room,),
+    )
+    return list_response(response=response, entities=rooms, schema=schemas.Room)
 
 
 @app.get(
@@ -346,34 +655,49 @@ def read_rooms(
     response_model=schemas.Room,
     dependencies=[Depends(auth.get_current_active_user)],
 )
-def read_room(request: Request, room_id: int, db: Session = Depends(get_db)):
+async def read_room(
+    request: Request,
+    response: Response,
+    room_id: int,
+    db: AnySession = Depends(get_session),
+):
     current_uuid = request.state.uuid
-    db_room = crud.get_entity(
-        current_uuid=current_uuid, db=db, id=room_id, model=models.Room
+    await check_etag(request=request, response=response, db=db, versions=("rooms",))
+    cache_key = response_cache.cache_key(request)
+    db_room = response_cache.cache.get("/rooms/{room_id}", cache_key)
+    if db_room is not None:
+        return db_room
+    db_room = await database.run_in_session(
+        db, crud.get_entity, current_uuid=current_uuid, id=room_id, model=models.Room
     )
     if db_room is None:
-        logger.info(f"{request.state.uuid} - Requested room does not exist")
+        logger.info("%s - Requested room does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="Room not found")
+    db_room = schemas.Room.from_orm(db_room)
+    response_cache.cache.put(
+        "/rooms/{room_id}", cache_key, db_room, tables=(models.Room,)
+    )
     return db_room
 
 
 @app.patch("/rooms/{room_id}", dependencies=[Depends(auth.is_admin)])
-def update_room(
+async def update_room(
     request: Request,
     room_id: int,
     room: schemas.RoomUpdate,
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    existing_room = crud.get_entity(
-        current_uuid=current_uuid, db=db, id=room_id, model=models.Room
+    existing_room = await database.run_in_session(
+        db, crud.get_entity, current_uuid=current_uuid, id=room_id, model=models.Room
     )
     if existing_room is None:
-        logger.info(f"{request.state.uuid} - Requested room does not exist")
+        logger.info("%s - Requested room does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="Room not found")
-    updated_room = crud.update_entity(
+    updated_room = await database.run_in_session(
+        db,
+        crud.update_entity,
         current_uuid=current_uuid,
-        db=db,
         entity_to_update=existing_room,
         updates=room,
         model=models.Room,
@@ -382,32 +706,73 @@ def update_room(
 
 
 @app.delete("/rooms/{room_id}", status_code=204, dependencies=[Depends(auth.is_admin)])
-def delete_room(request: Request, room_id: int, db: Session = Depends(get_db)):
+async def delete_room(
+    request: Request, room_id: int, db: AnySession = Depends(get_session)
+):
     current_uuid = request.state.uuid
-    room_to_delete = crud.get_entity(
-        current_uuid=current_uuid, db=db, id=room_id, model=models.Room
+    room_to_delete = await database.run_in_session(
+        db, crud.get_entity, current_uuid=current_uuid, id=room_id, model=models.Room
     )
     if room_to_delete is None:
-        logger.info(f"{request.state.uuid} - Requested ID for deletion does not exist")
+        logger.info("%s - Requested ID for deletion does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="Room not found")
-    crud.delete_entity(current_uuid=current_uuid, db=db, id=room_id, model=models.Room)
+    await database.run_in_session(
+        db, crud.delete_entity, current_uuid=current_uuid, id=room_id, model=models.Room
+    )
 
 
 # Desk Endpoints
 
 
 @app.post("/desks", response_model=schemas.Desk, dependencies=[Depends(auth.is_admin)])
-def create_desk(
-    request: Request, desk: schemas.DeskCreate, db: Session = Depends(get_db)
+async def create_desk(
+    request: Request, desk: schemas.DeskCreate, db: AnySession = Depends(get_session)
 ):
     current_uuid = request.state.uuid
-    db_desk = crud.get_desk_by_room_and_number(
-        current_uuid=current_uuid, db=db, room_id=desk.room_id, desk_number=desk.number
+    db_desk = await database.run_in_session(
+        db,
+        crud.get_desk_by_room_and_number,
+        current_uuid=current_uuid,
+        room_id=desk.room_id,
+        desk_number=desk.number,
     )
     if db_desk:
-        logger.info(f"{request.state.uuid} - Desk already exists")
+        logger.info("%s - Desk already exists", request.state.uuid)
         raise HTTPException(status_code=400, detail="Desk already exists")
-    return crud.create_desk(current_uuid=current_uuid, db=db, desk=desk)
+    return await database.run_in_session(
+        db, crud.create_desk, current_uuid=current_uuid, desk=desk
+    )
+
+
+@app.post(
+    "/desks/import",
+    response_model=schemas.DeskImportResult,
+    dependencies=[Depends(auth.is_admin)],
+)
+@limiter.shared_limit(
+    rate_limiting.EXPENSIVE_RATE_LIMIT,
+    scope="expensive",
+    cost=rate_limiting.fixed_cost(20),
+)
+def import_desks(
+    request: Request,
+    file: UploadFile,
+    format: Literal[desk_import.FORMATS] = Query(default="csv"),
+    db: Session = Depends(get_db),
+):
+    """
+    Creates many desks from an uploaded CSV (with a number,room_id header) or NDJSON file in one transaction.
+    Desks which already exist, are repeated in the file or are in a room that doesn't exist are skipped and listed.
+    Always uses a synchronous session, as the rows are streamed to PostgreSQL with psycopg2's COPY support.
+    """
+    current_uuid = request.state.uuid
+    try:
+        return desk_import.import_desks(
+            current_uuid=current_uuid, db=db, file=file.file, format=format
+        )
+    except ValueError as error:
+        logger.info("%s - Desk import is malformed", current_uuid)
+        raise HTTPException(status_code=400, detail=str(error))
 
 
 @app.get(
@@ -415,20 +780,49 @@ def create_desk(
     response_model=list[schemas.Desk],
     dependencies=[Depends(auth.is_admin)],
 )
-def read_desks(
+@limiter.shared_limit(
+    rate_limiting.EXPENSIVE_RATE_LIMIT, scope="expensive", cost=rate_limiting.list_cost
+)
+async def read_desks(
     request: Request,
     response: Response,
     range: Union[list[int], None] = Query(default=None),
     sort: Union[list[str], None] = Query(default=None),
-    db: Session = Depends(get_db),
+    cursor: Union[str, None] = Query(default=None),
+    limit: Union[int, None] = Query(default=None, ge=1, le=pagination.MAX_PAGE_SIZE),
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    desks = crud.get_all_entities(
-        current_uuid=current_uuid, db=db, range=range, sort=sort, model=models.Desk
+    await check_etag(request=request, response=response, db=db, versions=("desks",))
+    if cursor is not None or limit is not None:
+        return await read_page_by_cursor(
+            request=request,
+            response=response,
+            db=db,
+            model=models.Desk,
+            schema=schemas.Desk,
+            sort=sort,
+            cursor=cursor,
+            limit=limit,
+        )
+    desks = await database.run_in_session(
+        db,
+        crud.get_all_entities,
+        current_uuid=current_uuid,
+        range=range,
+        sort=sort,
+        model=models.Desk,
+        schema=schemas.Desk,
     )
-    response.headers["Content-Range"] = str(len(desks))
-    response.headers["Access-Control-Expose-Headers"] = "Content-Range"
-    return desks
+    await set_content_range(
+        request=request,
+        response=response,
+        db=db,
+        model=models.Desk,
+        range=range,
+        count=len(desks),
+    )
+    return list_response(response=response, entities=desks, schema=schemas.Desk)
 
 
 @app.get(
@@ -436,24 +830,70 @@ def read_desks(
     response_model=list[schemas.Desk],
     dependencies=[Depends(auth.get_current_active_user)],
 )
-def read_desks_in_room(
+@limiter.shared_limit(
+    rate_limiting.EXPENSIVE_RATE_LIMIT, scope="expensive", cost=rate_limiting.list_cost
+)
+async def read_desks_in_room(
     request: Request,
     response: Response,
     room_id: int,
     range: Union[list[int], None] = Query(default=None),
     sort: Union[list[str], None] = Query(default=["id", "ASC"]),
-    db: Session = Depends(get_db),
+    cursor: Union[str, None] = Query(default=None),
+    limit: Union[int, None] = Query(default=None, ge=1, le=pagination.MAX_PAGE_SIZE),
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    desks = crud.get_desks_in_room(
-        current_uuid=current_uuid, db=db, room_id=room_id, range=range, sort=sort
+    await check_etag(
+        request=request, response=response, db=db, versions=("rooms", "desks")
+    )
+    if cursor is not None or limit is not None:
+        return await read_page_by_cursor(
+            request=request,
+            response=response,
+            db=db,
+            model=models.Desk,
+            schema=schemas.Desk,
+            sort=sort,
+            cursor=cursor,
+            limit=limit,
+            filters=(models.Desk.room_id == room_id,),
+        )
+    desks = read_cached_list(
+        request=request, response=response, route="/rooms/{room_id}/desks"
+    )
+    if desks is not None:
+        return list_response(response=response, entities=desks, schema=schemas.Desk)
+    desks = await database.run_in_session(
+        db,
+        crud.get_desks_in_room,
+        current_uuid=current_uuid,
+        room_id=room_id,
+        range=range,
+        sort=sort,
+        schema=schemas.Desk,
     )
-    response.headers["Content-Range"] = str(len(desks))
-    response.headers["Access-Control-Expose-Headers"] = "Content-Range"
     if desks is None:
-        logger.info(f"{request.state.uuid} - Requested room does not exist")
+        logger.info("%s - Requested room does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="Room not found")
-    return desks
+    await set_content_range(
+        request=request,
+        response=response,
+        db=db,
+        model=models.Desk,
+        range=range,
+        count=len(desks),
+        filters=(models.Desk.room_id == room_id,),
+    )
+    desks = cache_list(
+        request=request,
+        response=response,
+        route="/rooms/{room_id}/desks",
+        entities=desks,
+        schema=schemas.Desk,
+        tables=(models.Room, models.Desk),
+    )
+    return list_response(response=response, entities=desks, schema=schemas.Desk)
 
 
 @app.get(
@@ -461,34 +901,49 @@ def read_desks_in_room(
     response_model=schemas.Desk,
     dependencies=[Depends(auth.get_current_active_user)],
 )
-def read_desk(request: Request, desk_id: int, db: Session = Depends(get_db)):
+async def read_desk(
+    request: Request,
+    response: Response,
+    desk_id: int,
+    db: AnySession = Depends(get_session),
+):
     current_uuid = request.state.uuid
-    db_desk = crud.get_entity(
-        current_uuid=current_uuid, db=db, id=desk_id, model=models.Desk
+    await check_etag(request=request, response=response, db=db, versions=("desks",))
+    cache_key = response_cache.cache_key(request)
+    db_desk = response_cache.cache.get("/desks/{desk_id}", cache_key)
+    if db_desk is not None:
+        return db_desk
+    db_desk = await database.run_in_session(
+        db, crud.get_entity, current_uuid=current_uuid, id=desk_id, model=models.Desk
     )
     if db_desk is None:
-        logger.info(f"{request.state.uuid} - Requested desk does not exist")
+        logger.info("%s - Requested desk does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="Desk not found")
+    db_desk = schemas.Desk.from_orm(db_desk)
+    response_cache.cache.put(
+        "/desks/{desk_id}", cache_key, db_desk, tables=(models.Desk,)
+    )
     return db_desk
 
 
 @app.patch("/desks/{desk_id}", dependencies=[Depends(auth.is_admin)])
-def update_desk(
+async def update_desk(
     request: Request,
     desk_id: int,
     desk: schemas.DeskUpdate,
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    existing_desk = crud.get_entity(
-        current_uuid=current_uuid, db=db, id=desk_id, model=models.Desk
+    existing_desk = await database.run_in_session(
+        db, crud.get_entity, current_uuid=current_uuid, id=desk_id, model=models.Desk
     )
     if existing_desk is None:
-        logger.info(f"{request.state.uuid} - Requested desk does not exist")
+        logger.info("%s - Requested desk does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="Desk not found")
-    updated_desk = crud.update_entity(
+    updated_desk = await database.run_in_session(
+        db,
+        crud.update_entity,
         current_uuid=current_uuid,
-        db=db,
         entity_to_update=existing_desk,
         updates=desk,
         model=models.Desk,
@@ -497,15 +952,19 @@ def update_desk(
 
 
 @app.delete("/desks/{desk_id}", status_code=204, dependencies=[Depends(auth.is_admin)])
-def delete_desk(request: Request, desk_id: int, db: Session = Depends(get_db)):
+async def delete_desk(
+    request: Request, desk_id: int, db: AnySession = Depends(get_session)
+):
     current_uuid = request.state.uuid
-    desk_to_delete = crud.get_entity(
-        current_uuid=current_uuid, db=db, id=desk_id, model=models.Desk
+    desk_to_delete = await database.run_in_session(
+        db, crud.get_entity, current_uuid=current_uuid, id=desk_id, model=models.Desk
     )
     if desk_to_delete is None:
-        logger.info(f"{request.state.uuid} - Requested ID for deletion does not exist")
+        logger.info("%s - Requested ID for deletion does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="Desk not found")
-    crud.delete_entity(current_uuid=current_uuid, db=db, id=desk_id, model=models.Desk)
+    await database.run_in_session(
+        db, crud.delete_entity, current_uuid=current_uuid, id=desk_id, model=models.Desk
+    )
 
 
 # Booking Endpoints
@@ -514,17 +973,215 @@ def delete_desk(request: Request, desk_id: int, db: Session = Depends(get_db)):
 @app.post(
     "/bookings", response_model=schemas.Booking, dependencies=[Depends(auth.is_admin)]
 )
-def create_booking(
-    request: Request, booking: schemas.BookingCreate, db: Session = Depends(get_db)
+async def create_booking(
+    request: Request,
+    booking: schemas.BookingCreate,
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    db_booking = crud.get_booking_by_desk_and_date(
-        current_uuid=current_uuid, db=db, desk_id=booking.desk_id, date=booking.date
+    db_booking = await database.run_in_session(
+        db, crud.create_booking, current_uuid=current_uuid, booking=booking
+    )
+    if db_booking is None:
+        logger.info("%s - Booking already exists", request.state.uuid)
+        raise HTTPException(status_code=409, detail="Booking already exists")
+    return db_booking
+
+
+# Most bookings that can be made in one batch
+MAX_BATCH_BOOKINGS = 100
+
+
+@app.post(
+    "/bookings/batch",
+    response_model=schemas.BookingBatchResult,
+    dependencies=[Depends(auth.is_admin)],
+)
+@limiter.shared_limit(
+    rate_limiting.EXPENSIVE_RATE_LIMIT,
+    scope="expensive",
+    cost=rate_limiting.fixed_cost(10),
+)
+async def create_bookings(
+    request: Request,
+    response: Response,
+    batch: schemas.BookingBatchCreate,
+    db: AnySession = Depends(get_session),
+):
+    """
+    Books several desks at once, such as for a team, in one statement and transaction.
+    Takes either a list of bookings, or a block of adjacent desks in a room to find and book on a date.
+    Either every booking is created, or none are and a 409 is returned, with the result of each booking in both cases.
+    """
+    current_uuid = request.state.uuid
+    if bool(batch.bookings) == (batch.block is not None):
+        logger.info("%s - Batch has both or neither bookings and a block", current_uuid)
+        raise HTTPException(
+            status_code=400, detail="Provide either a list of bookings or a block"
+        )
+    if batch.block is not None:
+        block = batch.block
+        if not 1 <= block.count <= MAX_BATCH_BOOKINGS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Block must be between 1 and {MAX_BATCH_BOOKINGS} desks",
+            )
+        desk_ids = await database.run_in_session(
+            db,
+            crud.find_adjacent_free_desks,
+            current_uuid=current_uuid,
+            room_id=block.room_id,
+            date=block.date,
+            count=block.count,
+        )
+        if desk_ids is None:
+            raise HTTPException(
+                status_code=409,
+                detail=f"There are not {block.count} adjacent free desks in the room on that date",
+            )
+        bookings = [
+            schemas.BookingCreate(
+                desk_id=desk_id,
+                date=block.date,
+                user_id=block.user_id,
+                approved_status=block.approved_status,
+            )
+            for desk_id in desk_ids
+        ]
+    else:
+        bookings = batch.bookings
+        if len(bookings) > MAX_BATCH_BOOKINGS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"A batch can not have more than {MAX_BATCH_BOOKINGS} bookings",
+            )
+    try:
+        items = await database.run_in_session(
+            db, crud.create_bookings, current_uuid=current_uuid, bookings=bookings
+        )
+    except IntegrityError:
+        logger.info(
+            "%s - Batch references a desk or user that does not exist", current_uuid
+        )
+        raise HTTPException(
+            status_code=400, detail="A desk or user in the batch does not exist"
+        )
+    created = all(item["status"] == "created" for item in items)
+    if not created:
+        response.status_code = status.HTTP_409_CONFLICT
+    return {"created": created, "items": items}
+
+
+@app.post(
+    "/bookings/recurring",
+    response_model=schemas.RecurringBooking,
+    dependencies=[Depends(auth.is_admin)],
+)
+async def create_recurring_booking(
+    request: Request,
+    recurring_booking: schemas.RecurringBookingCreate,
+    db: AnySession = Depends(get_session),
+):
+    """
+    Books a desk on the same days of every week between two dates, stored as one rule instead of a booking per day.
+    Returns a 409 with the clashing dates if the desk is already booked on any of them.
+    """
+    current_uuid = request.state.uuid
+    if recurring_booking.end_date < recurring_booking.start_date:
+        logger.info("%s - Recurring booking ends before it starts", current_uuid)
+        raise HTTPException(status_code=400, detail="Invalid date range")
+    try:
+        db_recurring_booking, conflicts = await database.run_in_session(
+            db,
+            crud.create_recurring_booking,
+            current_uuid=current_uuid,
+            recurring_booking=recurring_booking,
+        )
+    except IntegrityError:
+        logger.info("%s - Recurring booking references a missing entity", current_uuid)
+        raise HTTPException(status_code=400, detail="Desk or user does not exist")
+    if db_recurring_booking is None:
+        raise HTTPException(
+            status_code=409,
+            detail={
+                "message": "Desk is already booked on some of these dates",
+                "dates": [date.isoformat() for date in conflicts],
+            },
+        )
+    return db_recurring_booking
+
+
+async def get_own_recurring_booking(
+    request: Request,
+    recurring_booking_id: int,
+    current_user: schemas.User,
+    db: AnySession,
+):
+    """
+    Gets a recurring booking, only if it belongs to the current user or they are an admin
+    """
+    current_uuid = request.state.uuid
+    db_recurring_booking = await database.run_in_session(
+        db,
+        crud.get_entity,
+        current_uuid=current_uuid,
+        id=recurring_booking_id,
+        model=models.RecurringBooking,
+    )
+    if db_recurring_booking is None:
+        logger.info("%s - Requested recurring booking does not exist", current_uuid)
+        raise HTTPException(status_code=404, detail="Recurring booking not found")
+    elif (
+        db_recurring_booking.user_id != current_user.id and current_user.admin == False
+    ):
+        logger.info(
+            "%s - USER(ID=%s USERNAME=%s) attempted to get another users resource",
+            current_uuid,
+            current_user.id,
+            current_user.username,
+        )
+        raise HTTPException(status_code=403, detail="Operation not permitted")
+    return db_recurring_booking
+
+
+@app.get(
+    "/bookings/recurring/{recurring_booking_id}",
+    response_model=schemas.RecurringBooking,
+)
+async def read_recurring_booking(
+    request: Request,
+    recurring_booking_id: int,
+    current_user: schemas.User = Depends(auth.get_current_active_user),
+    db: AnySession = Depends(get_session),
+):
+    return await get_own_recurring_booking(
+        request=request,
+        recurring_booking_id=recurring_booking_id,
+        current_user=current_user,
+        db=db,
+    )
+
+
+@app.delete("/bookings/recurring/{recurring_booking_id}", status_code=204)
+async def delete_recurring_booking(
+    request: Request,
+    recurring_booking_id: int,
+    current_user: schemas.User = Depends(auth.get_current_active_user),
+    db: AnySession = Depends(get_session),
+):
+    await get_own_recurring_booking(
+        request=request,
+        recurring_booking_id=recurring_booking_id,
+        current_user=current_user,
+        db=db,
+    )
+    await database.run_in_session(
+        db,
+        crud.delete_entity,
+        current_uuid=request.state.uuid,
+        id=recurring_booking_id,
+        model=models.RecurringBooking,
     )
-    if db_booking:
-        logger.info(f"{request.state.uuid} - Booking already exists")
-        raise HTTPException(status_code=400, detail="Booking already exists")
-    return crud.create_booking(current_uuid=current_uuid, db=db, booking=booking)
 
 
 @app.get(
@@ -532,20 +1189,85 @@ def create_booking(
     response_model=list[schemas.Booking],
     dependencies=[Depends(auth.is_admin)],
 )
-def read_bookings(
+@limiter.shared_limit(
+    rate_limiting.EXPENSIVE_RATE_LIMIT, scope="expensive", cost=rate_limiting.list_cost
+)
+async def read_bookings(
     request: Request,
     response: Response,
     range: Union[list[int], None] = Query(default=None),
     sort: Union[list[str], None] = Query(default=["id", "ASC"]),
+    cursor: Union[str, None] = Query(default=None),
+    limit: Union[int, None] = Query(default=None, ge=1, le=pagination.MAX_PAGE_SIZE),
+    db: AnySession = Depends(get_session),
+):
+    current_uuid = request.state.uuid
+    if cursor is not None or limit is not None:
+        return await read_page_by_cursor(
+            request=request,
+            response=response,
+            db=db,
+            model=models.Booking,
+            schema=schemas.Booking,
+            sort=sort,
+            cursor=cursor,
+            limit=limit,
+        )
+    bookings = await database.run_in_session(
+        db,
+        crud.get_all_entities,
+        current_uuid=current_uuid,
+        range=range,
+        sort=sort,
+        model=models.Booking,
+        schema=schemas.Booking,
+    )
+    await set_content_range(
+        request=request,
+        response=response,
+        db=db,
+        model=models.Booking,
+        range=range,
+        count=len(bookings),
+    )
+    return list_response(response=response, entities=bookings, schema=schemas.Booking)
+
+
+@app.get(
+    "/bookings/export",
+    response_class=StreamingResponse,
+    responses={
+        200: {"content": {media_type: {} for media_type in export.MEDIA_TYPES.values()}}
+    },
+    dependencies=[Depends(auth.is_admin)],
+)
+@limiter.shared_limit(
+    rate_limiting.EXPENSIVE_RATE_LIMIT,
+    scope="expensive",
+    cost=rate_limiting.fixed_cost(20),
+)
+def export_bookings(
+    request: Request,
+    format: Literal[export.FORMATS] = Query(default="csv"),
+    from_date: Union[datetime.date, None] = Query(default=None, alias="from"),
+    to_date: Union[datetime.date, None] = Query(default=None, alias="to"),
     db: Session = Depends(get_db),
 ):
+    """
+    Streams every booking, or those in a date range, as CSV or NDJSON.
+    Rows are read from the database and sent in batches, so exporting every booking doesn't hold them all in memory.
+    Always uses a synchronous session, which stays open until the response has been sent.
+    """
     current_uuid = request.state.uuid
-    bookings = crud.get_all_entities(
-        current_uuid=current_uuid, db=db, range=range, sort=sort, model=models.Booking
+    logger.info("%s - Exporting bookings as %s", current_uuid, format)
+    batches = crud.stream_bookings(
+        current_uuid=current_uuid, db=db, from_date=from_date, to_date=to_date
+    )
+    return StreamingResponse(
+        export.CHUNK_WRITERS[format](batches),
+        media_type=export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="bookings.{format}"'},
     )
-    response.headers["Content-Range"] = str(len(bookings))
-    response.headers["Access-Control-Expose-Headers"] = "Content-Range"
-    return bookings
 
 
 @app.get(
@@ -553,12 +1275,19 @@ def read_bookings(
     response_model=schemas.Booking,
     dependencies=[Depends(auth.get_current_active_user)],
 )
-def read_bookings(
-    request: Request, booking_id: int, response: Response, db: Session = Depends(get_db)
+async def read_booking(
+    request: Request,
+    booking_id: int,
+    response: Response,
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    db_booking = crud.get_entity(
-        current_uuid=current_uuid, db=db, id=booking_id, model=models.Booking
+    db_booking = await database.run_in_session(
+        db,
+        crud.get_entity,
+        current_uuid=current_uuid,
+        id=booking_id,
+        model=models.Booking,
     )
     if db_booking is None:
         raise HTTPException(status_code=404, detail="Booking not found")
@@ -567,79 +1296,212 @@ def read_bookings(
 
 @app.get(
     "/rooms/{room_id}/bookings/{date}",
-    response_model=list[schemas.Booking],
+    response_model=list[schemas.RoomBooking],
+    response_model_exclude_none=True,
     dependencies=[Depends(auth.get_current_active_user)],
 )
-def read_bookings_by_room(
+async def read_bookings_by_room(
     request: Request,
     response: Response,
     date: datetime.date,
     room_id: int,
     range: Union[list[int], None] = Query(default=None),
     sort: Union[list[str], None] = Query(default=["id", "ASC"]),
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    db_booking = crud.get_bookings_by_room(
-        current_uuid=current_uuid, db=db, date=date, room_id=room_id
+    # Moving a desk to another room also changes the bookings of both rooms
+    await check_etag(
+        request=request,
+        response=response,
+        db=db,
+        versions=(
+            "desks",
+            crud.room_bookings_version(room_id, date),
+            crud.room_recurring_bookings_version(room_id),
+        ),
+    )
+    db_booking = await database.run_in_session(
+        db,
+        crud.get_bookings_by_room,
+        current_uuid=current_uuid,
+        date=date,
+        room_id=room_id,
+        schema=schemas.RoomBooking,
     )
     if db_booking is None:
-        logger.info(f"{request.state.uuid} - Requested booking does not exist")
+        logger.info("%s - Requested booking does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="Booking not found")
     return db_booking
 
 
+# Longest date range the availability of a room can be requested for
+MAX_AVAILABILITY_DAYS = 62
+
+
+@app.get(
+    "/rooms/{room_id}/availability",
+    response_model=schemas.RoomAvailability,
+    dependencies=[Depends(auth.get_current_active_user)],
+)
+@limiter.shared_limit(
+    rate_limiting.EXPENSIVE_RATE_LIMIT,
+    scope="expensive",
+    cost=rate_limiting.fixed_cost(5),
+)
+async def read_room_availability(
+    request: Request,
+    room_id: int,
+    from_date: datetime.date = Query(alias="from"),
+    to_date: datetime.date = Query(alias="to"),
+    db: AnySession = Depends(get_session),
+):
+    """
+    Returns whether each desk in a room is free, booked or pending approval for every day in a range.
+    Replaces fetching the desks and bookings of a room separately and comparing them in the frontend.
+    """
+    current_uuid = request.state.uuid
+    if to_date < from_date:
+        logger.info("%s - Availability range ends before it starts", current_uuid)
+        raise HTTPException(status_code=400, detail="Invalid date range")
+    if (to_date - from_date).days >= MAX_AVAILABILITY_DAYS:
+        logger.info("%s - Availability range is too long", current_uuid)
+        raise HTTPException(
+            status_code=400,
+            detail=f"Date range can not exceed {MAX_AVAILABILITY_DAYS} days",
+        )
+    desks = await database.run_in_session(
+        db,
+        crud.get_room_availability,
+        current_uuid=current_uuid,
+        room_id=room_id,
+        from_date=from_date,
+        to_date=to_date,
+    )
+    if desks is None:
+        logger.info("%s - Requested room does not exist", current_uuid)
+        raise HTTPException(status_code=404, detail="Room not found")
+    return {
+        "room_id": room_id,
+        "from_date": from_date,
+        "to_date": to_date,
+        "desks": desks,
+    }
+
+
+@app.get(
+    "/availability/search",
+    response_model=list[schemas.Desk],
+    dependencies=[Depends(auth.get_current_active_user)],
+)
+@limiter.shared_limit(
+    rate_limiting.EXPENSIVE_RATE_LIMIT,
+    scope="expensive",
+    cost=rate_limiting.fixed_cost(5),
+)
+async def search_availability(
+    request: Request,
+    dates: list[datetime.date] = Query(),
+    room_ids: Union[list[int], None] = Query(default=None),
+    db: AnySession = Depends(get_session),
+):
+    """
+    Finds the desks, in any of the given rooms (or all rooms), which are free on every one of the given days.
+    Answered from the in-memory availability index instead of joining bookings to desks per room and date.
+    """
+    current_uuid = request.state.uuid
+    await availability.ensure_index_built(current_uuid, db)
+    try:
+        # On the threadpool, as the search waits for the index lock while a rebuild is swapped in
+        return await run_in_threadpool(
+            availability.search_free_desks,
+            current_uuid=current_uuid,
+            dates=dates,
+            room_ids=room_ids,
+        )
+    except ValueError as error:
+        logger.info("%s - Searched dates are outside of the index", current_uuid)
+        raise HTTPException(status_code=400, detail=str(error))
+
+
 @app.patch("/bookings/{booking_id}")
-def update_booking(
+async def update_booking(
     request: Request,
     booking_id: int,
     booking: schemas.BookingUpdate,
     current_user: schemas.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    existing_booking: schemas.Booking = crud.get_entity(
-        current_uuid=current_uuid, db=db, id=booking_id, model=models.Booking
+    existing_booking: schemas.Booking = await database.run_in_session(
+        db,
+        crud.get_entity,
+        current_uuid=current_uuid,
+        id=booking_id,
+        model=models.Booking,
     )
     if existing_booking is None:
-        logger.info(f"{request.state.uuid} - Requested booking does not exist")
+        logger.info("%s - Requested booking does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="Booking not found")
     elif existing_booking.user_id != current_user.id and current_user.admin == False:
         logger.info(
-            f"{request.state.uuid} - USER(ID={current_user.id} USERNAME={current_user.username}) attempted to get another users resource"
+            "%s - USER(ID=%s USERNAME=%s) attempted to get another users resource",
+            request.state.uuid,
+            current_user.id,
+            current_user.username,
         )
         raise HTTPException(status_code=403, detail="Operation not permitted")
-    updated_booking = crud.update_entity(
-        current_uuid=current_uuid,
-        db=db,
-        entity_to_update=existing_booking,
-        updates=booking,
-        model=models.Booking,
-    )
+    try:
+        updated_booking = await database.run_in_session(
+            db,
+            crud.update_entity,
+            current_uuid=current_uuid,
+            entity_to_update=existing_booking,
+            updates=booking,
+            model=models.Booking,
+        )
+    except IntegrityError:
+        logger.info("%s - Desk is already booked on that date", request.state.uuid)
+        raise HTTPException(status_code=409, detail="Booking already exists")
+    if updated_booking is None:
+        raise HTTPException(
+            status_code=409, detail="Desk is held by a recurring booking on that date"
+        )
     return updated_booking
 
 
 @app.delete("/bookings/{booking_id}", status_code=204)
-def delete_booking(
+async def delete_booking(
     request: Request,
     booking_id: int,
     current_user: schemas.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    booking_to_delete: models.Booking = crud.get_entity(
-        current_uuid=current_uuid, db=db, id=booking_id, model=models.Booking
+    booking_to_delete: models.Booking = await database.run_in_session(
+        db,
+        crud.get_entity,
+        current_uuid=current_uuid,
+        id=booking_id,
+        model=models.Booking,
     )
     if booking_to_delete is None:
-        logger.info(f"{request.state.uuid} - Requested ID for deletion does not exist")
+        logger.info("%s - Requested ID for deletion does not exist", request.state.uuid)
         raise HTTPException(status_code=404, detail="Booking not found")
     elif booking_to_delete.user_id != current_user.id and current_user.admin == False:
         logger.info(
-            f"{request.state.uuid} - USER(ID={current_user.id} USERNAME={current_user.username}) attempted to get another users resource"
+            "%s - USER(ID=%s USERNAME=%s) attempted to get another users resource",
+            request.state.uuid,
+            current_user.id,
+            current_user.username,
         )
         raise HTTPException(status_code=403, detail="Operation not permitted")
-    crud.delete_entity(
-        current_uuid=current_uuid, db=db, id=booking_id, model=models.Booking
+    await database.run_in_session(
+        db,
+        crud.delete_entity,
+        current_uuid=current_uuid,
+        id=booking_id,
+        model=models.Booking,
     )
 
 
@@ -647,9 +1509,180 @@ def delete_booking(
 async def read_own_items(
     request: Request,
     current_user: schemas.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_session),
 ):
     current_uuid = request.state.uuid
-    return crud.get_users_bookings(
-        current_uuid=current_uuid, db=db, user_id=current_user.id
+    return await database.run_in_session(
+        db,
+        crud.get_users_bookings,
+        current_uuid=current_uuid,
+        user_id=current_user.id,
+        # The desk, room and user of each booking are many-to-one, so their columns are joined into one query
+        # This also lets an async session serialise the response, as rows never lazy load
+        schema=schemas.BookingSummary,
     )
+
+
+# Metrics
+
+
+def collect_worker_metrics():
+    """
+    Reports the connection pools, password hashing pool and caches of this worker as metric families
+    """
+    engines = {"sync": database.engine}
+    if database.async_engine is not None:
+        engines["async"] = database.async_engine
+    pool_sizes, connections, waits, timeouts = {}, {}, {}, {}
+    for name, engine in engines.items():
+        status = pool_statistics.get_pool_status(engine.pool)
+        pool_sizes[(name,)] = [status["pool_size"]]
+        for state in ("checked_out", "idle", "overflow"):
+            connections[(name, state)] = [status[state]]
+        wait_statistics = engine.pool.wait_statistics
+        waits[(name,)] = list(wait_statistics.bucket_counts) + [
+            wait_statistics.sum_ms / 1000
+        ]
+        timeouts[(name,)] = [status["timeouts"]]
+    hashing_status = hashing.pool.statistics()
+    principal_cache_status = principal_cache.cache.statistics()
+    response_cache_status = response_cache.cache.statistics()
+    response_cache_lookups = {}
+    for route, lookups in response_cache_status["routes"].items():
+        response_cache_lookups[(route, "hit")] = [lookups["hits"]]
+        response_cache_lookups[(route, "miss")] = [lookups["misses"]]
+    return [
+        metrics.family(
+            "db_pool_size",
+            "gauge",
+            "Connections kept open by the pool",
+            ("engine",),
+            pool_sizes,
+        ),
+        metrics.family(
+            "db_pool_connections",
+            "gauge",
+            "Connections of the pool by state",
+            ("engine", "state"),
+            connections,
+        ),
+        metrics.family(
+            "db_pool_checkout_wait_seconds",
+            "histogram",
+            "Time spent waiting to check out a connection",
+            ("engine",),
+            waits,
+            [bound / 1000 for bound in pool_statistics.WAIT_BUCKETS_MS],
+        ),
+        metrics.family(
+            "db_pool_checkout_timeouts_total",
+            "counter",
+            "Checkouts which timed out waiting for a connection",
+            ("engine",),
+            timeouts,
+        ),
+        metrics.family(
+            "password_hashes_in_flight",
+            "gauge",
+            "Password hashes running or waiting for the hashing pool",
+            series={(): [hashing_status["in_flight"]]},
+        ),
+        metrics.family(
+            "password_hashes_rejected_total",
+            "counter",
+            "Password hashes rejected as the hashing pool was full",
+            series={(): [hashing_status["rejected"]]},
+        ),
+        metrics.family(
+            "principal_cache_lookups_total",
+            "counter",
+            "Access tokens looked up in the principal cache",
+            ("result",),
+            {
+                ("hit",): [principal_cache_status["hits"]],
+                ("miss",): [principal_cache_status["misses"]],
+            },
+        ),
+        metrics.family(
+            "principal_cache_entries",
+            "gauge",
+            "Access tokens in the principal cache",
+            series={(): [principal_cache_status["size"]]},
+        ),
+        metrics.family(
+            "response_cache_lookups_total",
+            "counter",
+            "Requests looked up in the response cache, by route",
+            ("route", "result"),
+            response_cache_lookups,
+        ),
+        metrics.family(
+            "response_cache_entries",
+            "gauge",
+            "Responses in the response cache",
+            series={(): [response_cache_status["size"]]},
+        ),
+    ]
+
+
+metrics.add_collector(collect_worker_metrics)
+
+
+@app.get("/metrics", include_in_schema=False)
+@limiter.exempt
+def read_metrics():
+    """
+    Reports the metrics of every worker in the Prometheus text format, to be scraped by Prometheus
+    """
+    return Response(
+        content=metrics.render(metrics.collect_all()),
+        media_type=metrics.CONTENT_TYPE,
+    )
+
+
+# Admin Endpoints
+
+
+@app.get(
+    "/admin/pool",
+    response_model=dict[str, schemas.PoolStatus],
+    dependencies=[Depends(auth.is_admin)],
+)
+def read_pool_status(request: Request):
+    """
+    Reports the connection pool usage and checkout wait times of this worker, so pools can be sized per worker
+    """
+    current_uuid = request.state.uuid
+    logger.debug("%s - Entered read pool status function", current_uuid)
+    pools = {"sync": pool_statistics.get_pool_status(database.engine.pool)}
+    if database.async_engine is not None:
+        pools["async"] = pool_statistics.get_pool_status(database.async_engine.pool)
+    return pools
+
+
+@app.get(
+    "/admin/auth-cache",
+    response_model=schemas.PrincipalCacheStatus,
+    dependencies=[Depends(auth.is_admin)],
+)
+def read_principal_cache_status(request: Request):
+    """
+    Reports how often this worker authenticates requests from its cache of validated tokens
+    """
+    logger.debug(
+        "%s - Entered read principal cache status function", request.state.uuid
+    )
+    return principal_cache.cache.statistics()
+
+
+@app.get(
+    "/admin/response-cache",
+    response_model=schemas.ResponseCacheStatus,
+    dependencies=[Depends(auth.is_admin)],
+)
+def read_response_cache_status(request: Request):
+    """
+    Reports how often each cached endpoint of this worker is answered from the response cache
+    """
+    logger.debug("%s - Entered read response cache status function", request.state.uuid)
+    return response_cache.cache.statistics()
@@ -0,0 +1,415 @@
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event
+
+# Metrics in the Prometheus text format, served at /metrics
+# Each thread updates its own shard of every metric, so recording a request or query never takes a lock; shards
+# are only summed when the metrics are collected. Callbacks added with add_collector report values kept elsewhere,
+# such as the connection pools and caches, at collection time.
+# With several uvicorn workers, set METRICS_DIR to a directory shared by them (ideally under /dev/shm, cleared
+# before the workers start). Each worker then writes its metrics there every METRICS_FLUSH_INTERVAL seconds and
+# whichever worker is scraped adds up every workers file. Counters and histograms of workers which have exited are
+# kept so they never go backwards, gauges are only added up over the workers still running.
+
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+
+# Starlette adds "; charset=utf-8"
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# Upper bounds (in seconds) of the histogram buckets
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+PASSWORD_HASH_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# SQL statements are labelled by their first keyword, anything else is counted as OTHER
+STATEMENT_TYPES = frozenset(("SELECT", "INSERT", "UPDATE", "DELETE"))
+
+
+def family(
+    name: str,
+    metric_type: str,
+    documentation: str,
+    labelnames: tuple = (),
+    series: dict = None,
+    buckets: tuple = None,
+):
+    """
+    Builds a metric family as collected from a metric or a collector, and written to other workers
+
+    Parameters:
+            name (str): The name of the metric
+            metric_type (str): counter, gauge or histogram
+            documentation (str): The HELP text of the metric
+            labelnames (tuple): The names of its labels
+            series (dict): Label values (tuple) -> values, [value] for counters and gauges, or the count in each
+                           bucket (not cumulative, +Inf last) then the sum for histograms
+            buckets (tuple): The upper bounds of a histograms buckets, excluding +Inf
+
+    Returns:
+        family (dict): The metric family
+    """
+    return {
+        "name": name,
+        "type": metric_type,
+        "help": documentation,
+        "labelnames": list(labelnames),
+        "buckets": list(buckets) if buckets is not None else None,
+        "series": [[list(labels), values] for labels, values in (series or {}).items()],
+    }
+
+
+class Metric:
+    """
+    A metric whose series are split into a shard per thread, so only the thread owning a shard writes to it
+    """
+
+    metric_type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        # (THREAD, {LABEL VALUES -> VALUES}), appending and removing from a list is atomic
+        self._shards = []
+        # The totals of threads which have exited
+        self._retired = {}
+        self._collect_lock = threading.Lock()
+
+    def _width(self):
+        return 1
+
+    def _values(self, labels: tuple):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            self._shards.append((threading.current_thread(), shard))
+        values = shard.get(labels)
+        if values is None:
+            values = shard[labels] = [0] * self._width()
+        return values
+
+    def _add(self, totals: dict, series: dict):
+        for labels, values in list(series.items()):
+            total = totals.setdefault(labels, [0] * self._width())
+            for position, value in enumerate(list(values)):
+                total[position] += value
+
+    def collect(self):
+        with self._collect_lock:
+            totals = {}
+            self._add(totals, self._retired)
+            for entry in list(self._shards):
+                thread, shard = entry
+                # A shard is final once its thread has exited, so it is folded into the retired totals
+                if not thread.is_alive():
+                    self._add(self._retired, shard)
+                    self._shards.remove(entry)
+                self._add(totals, shard)
+        if not self.labelnames and not totals:
+            totals[()] = [0] * self._width()
+        return family(
+            self.name,
+            self.metric_type,
+            self.documentation,
+            self.labelnames,
+            totals,
+            getattr(self, "buckets", None),
+        )
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self._values(labels)[0] += amount
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self._values(labels)[0] += amount
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self._values(labels)[0] -= amount
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple = (), buckets=()
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _width(self):
+        # A count per bucket, +Inf, then the sum
+        return len(self.buckets) + 2
+
+    def observe(self, value: float, labels: tuple = ()):
+        values = self._values(labels)
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time taken to respond to requests, by route template",
+    ("method", "route", "status"),
+    REQUEST_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Requests currently being handled"
+)
+STATEMENT_DURATION = Histogram(
+    "db_statement_duration_seconds",
+    "Time taken to execute SQL statements, by their type",
+    ("statement",),
+    STATEMENT_BUCKETS,
+)
+PASSWORD_HASH_DURATION = Histogram(
+    "password_hash_duration_seconds",
+    "Time taken to hash or verify a password, including waiting for the hashing pool",
+    ("function",),
+    PASSWORD_HASH_BUCKETS,
+)
+
+METRICS = [
+    REQUEST_DURATION,
+    REQUESTS_IN_FLIGHT,
+    STATEMENT_DURATION,
+    PASSWORD_HASH_DURATION,
+]
+COLLECTORS = []
+
+
+def add_collector(collector):
+    """
+    Adds a function returning a list of metric families (see family) to be reported with every collection
+    """
+    COLLECTORS.append(collector)
+
+
+def collect():
+    """
+    Collects the metric families of this worker
+    """
+    families = [metric.collect() for metric in METRICS]
+    for collector in COLLECTORS:
+        families.extend(collector())
+    return families
+
+
+# SQL statement timing, from the cursor execute events of each engine
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_start_time = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_time = getattr(context, "metrics_start_time", None)
+    if start_time is None:
+        return
+    keyword = statement.lstrip()[:6].upper()
+    STATEMENT_DURATION.observe(
+        time.perf_counter() - start_time,
+        (keyword if keyword in STATEMENT_TYPES else "OTHER",),
+    )
+
+
+def instrument_engine(engine):
+    """
+    Times every statement executed by a (sync) engine, for an AsyncEngine pass its sync_engine
+    """
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+# Aggregation across workers
+
+
+def _worker_path(pid: int):
+    return os.path.join(METRICS_DIR, f"worker-{pid}.json")
+
+
+def write_worker_metrics():
+    """
+    Writes the metrics of this worker to METRICS_DIR, replacing its previous file
+    """
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    content = json.dumps({"pid": os.getpid(), "families": collect()})
+    file, temporary_path = tempfile.mkstemp(dir=METRICS_DIR, suffix=".tmp")
+    with os.fdopen(file, "w") as temporary_file:
+        temporary_file.write(content)
+    # Renamed into place, so other workers never read a partly written file
+    os.replace(temporary_path, _worker_path(os.getpid()))
+
+
+def _is_running(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_worker_metrics():
+    """
+    Reads the metrics of every other worker which has written to METRICS_DIR
+
+    Returns:
+        workers (List[tuple]): (running (bool), families (list)) of each worker
+    """
+    workers = []
+    for filename in os.listdir(METRICS_DIR):
+        if not (filename.startswith("worker-") and filename.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename)) as file:
+                content = json.load(file)
+        except (OSError, ValueError):
+            continue
+        if content["pid"] != os.getpid():
+            workers.append((_is_running(content["pid"]), content["families"]))
+    return workers
+
+
+def merge(workers):
+    """
+    Adds up the metric families of several workers, label by label
+
+    Parameters:
+            workers (List[tuple]): (running (bool), families (list)) of each worker
+
+    Returns:
+        families (List[dict]): The combined metric families, in the order they were first seen
+    """
+    merged = {}
+    for running, families in workers:
+        for metric_family in families:
+            if metric_family["type"] == "gauge" and not running:
+                continue
+            name = metric_family["name"]
+            if name not in merged:
+                merged[name] = dict(metric_family, series={})
+            series = merged[name]["series"]
+            for labels, values in metric_family["series"]:
+                total = series.setdefault(tuple(labels), [0] * len(values))
+                for position, value in enumerate(values):
+                    total[position] += value
+    for metric_family in merged.values():
+        metric_family["series"] = [
+            [list(labels), values] for labels, values in metric_family["series"].items()
+        ]
+    return list(merged.values())
+
+
+def collect_all():
+    """
+    Collects the metric families of this worker, combined with those of the other workers if METRICS_DIR is set
+    """
+    workers = [(True, collect())]
+    if METRICS_DIR:
+        workers.extend(read_worker_metrics())
+    return merge(workers)
+
+
+class MetricsFlusher:
+    """
+    Writes this workers metrics to METRICS_DIR every METRICS_FLUSH_INTERVAL seconds on a background thread
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        write_worker_metrics()
+        self._thread = threading.Thread(
+            target=self._run, name="metrics-flusher", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            write_worker_metrics()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+            # The final counts are kept for the other workers to report
+            write_worker_metrics()
+
+
+flusher = MetricsFlusher(interval=METRICS_FLUSH_INTERVAL)
+
+
+# Prometheus text format
+
+
+def _format_value(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    labels = ",".join(
+        '%s="%s"'
+        % (
+            name,
+            str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'),
+        )
+        for name, value in zip(names, values)
+    )
+    return "{" + labels + "}"
+
+
+def render(families: list) -> str:
+    """
+    Formats metric families in the Prometheus text exposition format
+    """
+    lines = []
+    for metric_family in families:
+        name = metric_family["name"]
+        names = metric_family["labelnames"]
+        lines.append(f"# HELP {name} {metric_family['help']}")
+        lines.append(f"# TYPE {name} {metric_family['type']}")
+        for labels, values in sorted(metric_family["series"]):
+            if metric_family["type"] != "histogram":
+                lines.append(
+                    f"{name}{_format_labels(names, labels)} {_format_value(values[0])}"
+                )
+                continue
+            count = 0
+            bounds = metric_family["buckets"] + [float("inf")]
+            for bound, bucket_count in zip(bounds, values):
+                count += bucket_count
+                bucket_labels = _format_labels(
+                    names + ["le"], labels + [_format_value(bound)]
+                )
+                lines.append(f"{name}_bucket{bucket_labels} {_format_value(count)}")
+            labels = _format_labels(names, labels)
+            lines.append(f"{name}_sum{labels} {_format_value(values[-1])}")
+            lines.append(f"{name}_count{labels} {_format_value(count)}")
+    return "\n".join(lines) + "\n"
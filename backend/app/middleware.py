@@ -0,0 +1,145 @@
+import logging
+import time
+import uuid
+from urllib.parse import parse_qsl, urlencode
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import log_pipeline, metrics
+
+logger = logging.getLogger(__name__)
+
+# Middleware written directly against ASGI rather than with @app.middleware("http"), which runs every request
+# through BaseHTTPMiddleware and so an extra task and memory stream per request and response
+
+
+def flatten_query_string(query_string: bytes):
+    """
+    Converts lists in a query string into repeated parameters, the format fastAPI expects.
+    Correctly formatted strings will be unaffected.
+    Example input: range=[0,9]&sort=["id","ASC"]
+    Converted to : range=0&range=9&sort=id&sort=ASC
+
+    Parameters:
+            query_string (bytes): The raw query string of the request
+
+    Returns:
+        query_string (bytes): The flattened query string
+    """
+    flattened = []
+    for key, value in parse_qsl(query_string.decode("latin-1"), keep_blank_values=True):
+        value = value.strip("[]")
+        for entry in value.split(","):
+            flattened.append((key, entry.strip('""')))
+    return urlencode(flattened, doseq=True).encode("utf-8")
+
+
+class FlattenQueryStringListsMiddleware:
+    """
+    Flattens lists in the query string of each request (see flatten_query_string).
+    Query strings without a [, encoded or not, have no lists so are passed on untouched.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            query_string = scope.get("query_string", b"")
+            if b"[" in query_string or b"%5b" in query_string.lower():
+                scope = dict(scope, query_string=flatten_query_string(query_string))
+        await self.app(scope, receive, send)
+
+
+class RequestLoggingMiddleware:
+    """
+    Gives each request a UUID, available to endpoints as request.state.uuid and to log filters as
+    log_pipeline.request_uuid, and logs when the request starts and when its response is sent
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        generated_uuid = str(uuid.uuid4())
+        path = scope.get("root_path", "") + scope["path"]
+        token = log_pipeline.request_uuid.set(generated_uuid)
+        logger.info(
+            "%s - Start of %s request to path %s",
+            generated_uuid,
+            scope["method"],
+            path[1:],
+        )
+        start_time = time.time()
+        scope.setdefault("state", {})["uuid"] = generated_uuid
+        status_code = None
+
+        async def send_with_logging(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_logging)
+            process_time = (time.time() - start_time) * 1000
+            logger.info(
+                "%s - Response sent, completed in %.2fms with status code %s",
+                generated_uuid,
+                process_time,
+                status_code,
+            )
+        finally:
+            log_pipeline.request_uuid.reset(token)
+
+
+def route_template(scope: Scope):
+    """
+    Returns the path of the route which handled a request, such as /rooms/{room_id}.
+    Unmatched paths share one label, so scanning for URLs can't create a series per path.
+    """
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    # Plain starlette routes (the docs) aren't added to the scope, but none of them have parameters
+    if "endpoint" in scope and not scope.get("path_params"):
+        return scope["path"]
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Records how long each request takes by method, route template and status code, and how many are in flight.
+    The route is read from the scope after the request is handled, so this must be added inside any middleware
+    which replaces the scope (FlattenQueryStringListsMiddleware)
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        # Reported if the app raises before starting a response
+        status_code = 500
+
+        async def send_with_status(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        metrics.REQUESTS_IN_FLIGHT.inc()
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.REQUESTS_IN_FLIGHT.dec()
+            metrics.REQUEST_DURATION.observe(
+                time.perf_counter() - start_time,
+                (scope["method"], route_template(scope), str(status_code)),
+            )
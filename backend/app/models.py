@@ -1,7 +1,9 @@
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
     Date,
+    DateTime,
     ForeignKey,
     Integer,
     String,
@@ -61,5 +63,55 @@ class Booking(Base):
     date = Column(Date, unique=False, nullable=False)
     approved_status = Column(Boolean, unique=False, nullable=False)
 
+    # A desk can only be booked once per day, enforced by the database so concurrent requests can't double book
+    __table_args__ = (
+        UniqueConstraint("desk_id", "date", name="_booking_desk_date_uc"),
+    )
+
     desk = relationship("Desk")
     user = relationship("User")
+
+
+class RecurringBooking(Base):
+    __tablename__ = "recurring_bookings"
+
+    id = Column(Integer, primary_key=True, index=True)
+
+    user_id = Column(Integer, ForeignKey("users.id"), unique=False, nullable=False)
+    desk_id = Column(
+        Integer, ForeignKey("desks.id"), unique=False, nullable=False, index=True
+    )
+
+    # Stored as a rule rather than a booking per day, it is only expanded into dates for the range being viewed
+    # The days of the week it repeats on are a bitmask, bit 0 is Monday through to bit 6 for Sunday
+    weekdays = Column(Integer, nullable=False)
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=False)
+    approved_status = Column(Boolean, unique=False, nullable=False)
+
+    desk = relationship("Desk")
+    user = relationship("User")
+
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+
+    # The jti claim of the refresh token
+    id = Column(String(32), primary_key=True)
+    # Every token rotated from the same login shares a family, so they can all be revoked if one is reused
+    family_id = Column(String(32), nullable=False, index=True)
+    user_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True
+    )
+    expires_at = Column(DateTime, nullable=False)
+    used = Column(Boolean, nullable=False, default=False)
+    revoked = Column(Boolean, nullable=False, default=False)
+
+
+class Version(Base):
+    __tablename__ = "versions"
+
+    # A table ("rooms") or group of rows ("bookings:<room_id>:<date>") that responses are read from
+    name = Column(String(64), primary_key=True)
+    # Incremented in the same transaction as every write to the table or rows, used for ETags
+    version = Column(BigInteger, nullable=False, default=0)
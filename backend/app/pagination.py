@@ -0,0 +1,122 @@
+import base64
+import datetime
+import json
+from typing import Union
+
+from sqlalchemy import tuple_
+
+# Keyset (cursor) pagination, so fetching a deep page costs the same as the first page
+# A cursor is opaque to clients, it holds the sort, and the sort value and ID of the last entity on the page
+# The next page continues after that (sort value, ID) pair using an index range scan instead of an OFFSET
+
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(sort_field: str, direction: str, sort_value, id: int):
+    """
+    Encodes the position after an entity into an opaque cursor
+
+    Parameters:
+            sort_field (str): The property the entities are sorted by
+            direction (str): ASC or DESC
+            sort_value: The value of the sort property for the last entity on the page
+            id (int): The ID of the last entity on the page
+
+    Returns:
+        cursor (str): A URL safe cursor
+    """
+    if isinstance(sort_value, datetime.date):
+        sort_value = sort_value.isoformat()
+    payload = json.dumps([sort_field, direction, sort_value, id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, model):
+    """
+    Decodes a cursor made by encode_cursor for a model
+
+    Parameters:
+            cursor (str): The cursor sent by a client
+            model (models): The table, represented as a model, the cursor is for
+
+    Returns:
+        position (tuple): The sort field, direction, sort value and ID held in the cursor
+
+    Raises:
+        ValueError: If the cursor is malformed or doesn't match the model
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_field, direction, sort_value, id = json.loads(
+            base64.urlsafe_b64decode(padded.encode("ascii"))
+        )
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    column = get_sort_column(model, sort_field)
+    if direction not in ("ASC", "DESC") or not isinstance(id, int):
+        raise ValueError("Invalid cursor")
+    if sort_value is not None and column.type.python_type is datetime.date:
+        sort_value = datetime.date.fromisoformat(sort_value)
+    return sort_field, direction, sort_value, id
+
+
+def get_sort_column(model, sort_field: str):
+    """
+    Returns the column of a model to sort by, only real columns can be used for keyset pagination
+
+    Raises:
+        ValueError: If the model has no column with that name
+    """
+    if sort_field not in model.__table__.columns:
+        raise ValueError(f"Can not sort by {sort_field}")
+    return getattr(model, sort_field)
+
+
+def paginate_by_cursor(
+    query,
+    model,
+    sort: Union[list[str], None],
+    cursor: Union[str, None],
+    limit: int,
+):
+    """
+    Applies keyset pagination to a query of a model
+
+    Parameters:
+            query (Query): A query selecting entities of the model, with any filters already applied
+            model (models): The table, represented as a model, being queried
+            sort (List[str] or None): The property and ASC/DESC to sort by, ignored when a cursor is given
+            cursor (str or None): The cursor returned with the previous page, if none the first page is returned
+            limit (int): The number of entities per page
+
+    Returns:
+        page (tuple): The entities on the page and the cursor for the next page (None if this is the last page)
+
+    Raises:
+        ValueError: If the sort or cursor are invalid
+    """
+    if cursor is not None:
+        sort_field, direction, sort_value, last_id = decode_cursor(cursor, model)
+    else:
+        sort_field, direction = sort if sort is not None else ["id", "ASC"]
+        direction = "ASC" if direction.upper() == "ASC" else "DESC"
+    column = get_sort_column(model, sort_field)
+    # The ID breaks ties so entities sharing a sort value are neither skipped nor repeated
+    if direction == "ASC":
+        query = query.order_by(column.asc(), model.id.asc())
+        if cursor is not None:
+            query = query.filter(tuple_(column, model.id) > tuple_(sort_value, last_id))
+    else:
+        query = query.order_by(column.desc(), model.id.desc())
+        if cursor is not None:
+            query = query.filter(tuple_(column, model.id) < tuple_(sort_value, last_id))
+    # One extra entity is fetched to know whether there is a next page
+    entities = query.limit(limit + 1).all()
+    if len(entities) <= limit:
+        return entities, None
+    entities = entities[:limit]
+    last = entities[-1]
+    return entities, encode_cursor(
+        sort_field, direction, getattr(last, sort_field), last.id
+    )
@@ -0,0 +1,110 @@
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Connection pool instrumentation, so the pool can be sized per worker from live data
+# The pool classes below are passed to the engines in database.py as their poolclass
+
+# Upper bounds (in milliseconds) of the buckets used for the connection wait time histogram
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class PoolWaitStatistics:
+    """
+    Collects how long requests wait to check out a connection and how often they time out
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bucket_counts = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+        self.timeouts = 0
+
+    def observe(self, wait_ms: float):
+        index = len(WAIT_BUCKETS_MS)
+        for position, bound in enumerate(WAIT_BUCKETS_MS):
+            if wait_ms <= bound:
+                index = position
+                break
+        with self._lock:
+            self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum_ms += wait_ms
+            self.max_ms = max(self.max_ms, wait_ms)
+
+    def observe_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def histogram(self):
+        """
+        Returns the cumulative wait time histogram, keyed by the buckets upper bound in milliseconds
+        """
+        with self._lock:
+            counts = list(self.bucket_counts)
+        histogram = {}
+        total = 0
+        for bound, count in zip(list(WAIT_BUCKETS_MS) + ["+Inf"], counts):
+            total += count
+            histogram[str(bound)] = total
+        return histogram
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool which records the time spent waiting for a connection on every checkout
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_statistics = PoolWaitStatistics()
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.wait_statistics = self.wait_statistics
+        return pool
+
+    def _do_get(self):
+        start_time = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.wait_statistics.observe_timeout()
+            raise
+        self.wait_statistics.observe((time.perf_counter() - start_time) * 1000)
+        return connection
+
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    pass
+
+
+def get_pool_status(pool):
+    """
+    Builds a snapshot of a connection pools current usage and wait times
+
+    Parameters:
+            pool (InstrumentedQueuePool): The pool of an engine
+
+    Returns:
+        status (dict): The pool sizing, connection counts and wait time statistics
+    """
+    wait_statistics = pool.wait_statistics
+    return {
+        "pool_size": pool.size(),
+        "max_overflow": pool._max_overflow,
+        "timeout": pool.timeout(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        # The pool reports a negative overflow while it is still below pool_size
+        "overflow": max(pool.overflow(), 0),
+        "wait_count": wait_statistics.count,
+        "wait_sum_ms": round(wait_statistics.sum_ms, 3),
+        "wait_max_ms": round(wait_statistics.max_ms, 3),
+        "wait_histogram_ms": wait_statistics.histogram(),
+        "timeouts": wait_statistics.timeouts,
+    }
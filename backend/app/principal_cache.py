@@ -0,0 +1,94 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Union
+
+from app import schemas
+
+# Cache of validated access tokens to the user they belong to, so an authenticated request doesn't have to decode
+# the JWT and query the user every time. Entries expire after PRINCIPAL_CACHE_TTL seconds (or when the token
+# expires if sooner) and the least recently used are evicted beyond PRINCIPAL_CACHE_SIZE entries.
+# A users entries are dropped as soon as crud.py updates or deletes them, other workers pick the change up
+# once their entries expire.
+
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", 1024))
+PRINCIPAL_CACHE_TTL = float(os.environ.get("PRINCIPAL_CACHE_TTL", 30))
+
+
+class PrincipalCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # SHA-256 OF TOKEN -> (USER, MONOTONIC EXPIRY TIME), the raw tokens are never kept
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token: str):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str) -> Union[schemas.User, None]:
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token: str, user: schemas.User, token_expires_at: float = None):
+        """
+        Caches the user of a validated token
+
+        Parameters:
+                token (str): The access token
+                user (schemas.User): The user the token belongs to
+                token_expires_at (float or None): The exp claim of the token, as a UNIX timestamp
+        """
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl
+        if token_expires_at is not None:
+            ttl = min(ttl, token_expires_at - time.time())
+        if ttl <= 0:
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (user, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for key in [
+                key for key, (user, _) in self._entries.items() if user.id == user_id
+            ]:
+                del self._entries[key]
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def statistics(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+cache = PrincipalCache(max_size=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
@@ -0,0 +1,428 @@
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import re
+import socket
+import struct
+import tempfile
+import time
+import urllib.parse
+from typing import Optional, Tuple
+
+from jose import JWTError, jwt
+from limits.storage import MovingWindowSupport, Storage
+from slowapi.util import get_remote_address
+from starlette.requests import Request
+
+from app import security
+
+logger = logging.getLogger(__name__)
+
+# Storage backends for the slowapi rate limiter, so every worker on a host (shm://) or every host (resp://)
+# shares one count per client instead of each worker allowing the full limit
+# Both keep a sliding window counter per key: the count of the current fixed window plus the count of the
+# previous window weighted by how much of it still overlaps the sliding window. This needs two integers per key
+# however high the limit is, and is used through the limiter's moving-window strategy.
+#
+#   memory://                          - Per worker, the slowapi default
+#   shm:///dev/shm/desk-booking-limits - A memory mapped file shared by the workers on one host
+#   resp://localhost:6379/0            - Any server speaking the Redis protocol (Redis, Valkey, KeyDB, ...)
+
+RATE_LIMIT_STORAGE_URI = os.environ.get("RATE_LIMIT_STORAGE_URI", "memory://")
+RATE_LIMIT_STRATEGY = os.environ.get("RATE_LIMIT_STRATEGY", "moving-window")
+
+# Requests are limited per user when they send a valid access token, otherwise per IP address
+# Light requests share DEFAULT_RATE_LIMIT per endpoint. Expensive endpoints (lists, exports, imports, batches and
+# availability) instead draw from one EXPENSIVE_RATE_LIMIT budget shared between them, each request costing a
+# weight for its endpoint, and for lists a weight for how many rows are asked for
+DEFAULT_RATE_LIMIT = os.environ.get("RATE_LIMIT_DEFAULT", "35/minute")
+EXPENSIVE_RATE_LIMIT = os.environ.get("RATE_LIMIT_EXPENSIVE", "120/minute")
+# Rows of a list page covered by each unit of cost
+LIST_COST_ROWS = 100
+# Cost of a list requested without a range or limit, which returns every row
+UNBOUNDED_LIST_COST = 20
+
+
+def rate_limit_key(request: Request):
+    """
+    Returns the user ID from a valid access token, or the clients IP address when there isn't one.
+    Only the signature and expiry are checked, the token is fully validated by the endpoint.
+    """
+    key = getattr(request.state, "rate_limit_key", None)
+    if key is not None:
+        return key
+    key = f"ip:{get_remote_address(request)}"
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            payload = jwt.decode(
+                token, security.SECRET_KEY, algorithms=[security.ALGORITHM]
+            )
+            # Tokens issued before the uid claim was added are keyed by username
+            user = payload.get("uid") or payload.get("sub")
+            if user is not None:
+                key = f"user:{user}"
+        except JWTError:
+            pass
+    request.state.rate_limit_key = key
+    return key
+
+
+def fixed_cost(weight: int):
+    """
+    Creates a cost function for an endpoint where every request costs the same
+    """
+    return lambda request: weight
+
+
+def list_cost(request: Request):
+    """
+    The cost of a request to a list endpoint, from the number of rows asked for by its range or limit
+    """
+    range = request.query_params.getlist("range")
+    limit = request.query_params.get("limit")
+    try:
+        if len(range) == 2:
+            # An offset and a limit, as applied by crud.py, so the offset costs nothing
+            rows = int(range[1])
+        elif limit is not None:
+            rows = int(limit)
+        else:
+            return UNBOUNDED_LIST_COST
+    except ValueError:
+        # Rejected by the endpoint anyway
+        return 1
+    return min(1 + max(rows - 1, 0) // LIST_COST_ROWS, UNBOUNDED_LIST_COST)
+
+
+def sliding_window_count(current: int, previous: int, expiry: int, now: float) -> float:
+    """
+    Estimates the hits in the last expiry seconds from the counts of the current and previous fixed windows
+    """
+    elapsed = (now % expiry) / expiry
+    return previous * (1 - elapsed) + current
+
+
+class SharedMemoryStorage(Storage, MovingWindowSupport):
+    """
+    Rate limit storage in a memory mapped file, shared by every process which opens the same path.
+
+    The file is a hash table of fixed size slots. A key can be in any of PROBES slots from its hash, which are
+    locked together with one fcntl byte range lock (and a thread lock, since fcntl locks are per process), read,
+    updated and unlocked. Slots of keys which haven't been hit for two windows are reused.
+    """
+
+    STORAGE_SCHEME = ["shm"]
+    # KEY HASH, WINDOW NUMBER, WINDOW LENGTH, CURRENT COUNT, PREVIOUS COUNT
+    SLOT = struct.Struct("<QqIII4x")
+    PROBES = 8
+
+    def __init__(self, uri: Optional[str] = None, slots: int = 65536, **options):
+        super().__init__(uri, **options)
+        path = urllib.parse.urlparse(uri).path if uri else ""
+        if not path:
+            directory = (
+                "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            )
+            path = os.path.join(directory, "desk-booking-rate-limits")
+        self.path = path
+        self.slots = int(slots)
+        size = (self.slots + self.PROBES) * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Every worker sizes the file the same, the first to open it creates it full of empty slots
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+
+    def _key_hash(self, key: str):
+        # Never 0, which marks an empty slot
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") | 1
+
+    def _update(self, key: str, expiry: int, function):
+        """
+        Runs function(current, previous, window) on the counts of a key, with them rolled forward to the current
+        window, while the slots of the key are locked. It returns the new counts and a result to return.
+        """
+        key_hash = self._key_hash(key)
+        now = time.time()
+        window = int(now // expiry)
+        first_slot = key_hash % self.slots
+        start = first_slot * self.SLOT.size
+        length = self.PROBES * self.SLOT.size
+        with self.lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+            try:
+                slots = [
+                    self.SLOT.unpack_from(self._map, start + probe * self.SLOT.size)
+                    for probe in range(self.PROBES)
+                ]
+                match = next(
+                    (probe for probe, slot in enumerate(slots) if slot[0] == key_hash),
+                    None,
+                )
+                if match is None:
+                    # An empty or expired slot, or failing that the one hit least recently
+                    match = min(
+                        range(self.PROBES),
+                        key=lambda probe: (slots[probe][1] + 2) * slots[probe][2],
+                    )
+                    current, previous = 0, 0
+                else:
+                    _, slot_window, _, current, previous = slots[match]
+                    if slot_window == window - 1:
+                        current, previous = 0, current
+                    elif slot_window != window:
+                        current, previous = 0, 0
+                (current, previous), result = function(current, previous, window)
+                self.SLOT.pack_into(
+                    self._map,
+                    start + match * self.SLOT.size,
+                    key_hash,
+                    window,
+                    expiry,
+                    current,
+                    previous,
+                )
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+        return result
+
+    def acquire_entry(self, key: str, limit: int, expiry: int, amount: int = 1) -> bool:
+        now = time.time()
+
+        def acquire(current, previous, window):
+            if sliding_window_count(current, previous, expiry, now) + amount > limit:
+                return (current, previous), False
+            return (current + amount, previous), True
+
+        return self._update(key, expiry, acquire)
+
+    def get_moving_window(self, key: str, limit: int, expiry: int) -> Tuple[int, int]:
+        now = time.time()
+        return self._update(
+            key,
+            expiry,
+            lambda current, previous, window: (
+                (current, previous),
+                (
+                    window * expiry,
+                    int(sliding_window_count(current, previous, expiry, now)),
+                ),
+            ),
+        )
+
+    def incr(
+        self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1
+    ) -> int:
+        return self._update(
+            key,
+            expiry,
+            lambda current, previous, window: (
+                (current + amount, previous),
+                current + amount,
+            ),
+        )
+
+    def get(self, key: str) -> int:
+        # The fixed window strategies only call get for keys they have just incremented with the same expiry
+        key_hash = self._key_hash(key)
+        start = (key_hash % self.slots) * self.SLOT.size
+        for probe in range(self.PROBES):
+            slot = self.SLOT.unpack_from(self._map, start + probe * self.SLOT.size)
+            if slot[0] == key_hash:
+                return slot[3] if slot[1] == int(time.time() // slot[2]) else 0
+        return 0
+
+    def get_expiry(self, key: str) -> int:
+        key_hash = self._key_hash(key)
+        start = (key_hash % self.slots) * self.SLOT.size
+        for probe in range(self.PROBES):
+            slot = self.SLOT.unpack_from(self._map, start + probe * self.SLOT.size)
+            if slot[0] == key_hash:
+                return (slot[1] + 1) * slot[2]
+        return int(time.time())
+
+    def check(self) -> bool:
+        return not self._map.closed
+
+    def clear(self, key: str) -> None:
+        self._update(key, 1, lambda current, previous, window: ((0, 0), None))
+
+    def reset(self) -> Optional[int]:
+        with self.lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                self._map[:] = bytes(len(self._map))
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        return None
+
+
+class RespError(Exception):
+    """
+    An error reply from a Redis protocol server
+    """
+
+
+class RespStorage(Storage, MovingWindowSupport):
+    """
+    Rate limit storage on a server speaking the Redis protocol (RESP), through a minimal built in client.
+
+    Each fixed window of a key is its own counter, which expires after two windows. A hit increments the current
+    window and reads the previous one in a single round trip. Increments are atomic on the server, so when a
+    hit would go over the limit it is taken back with DECRBY. Concurrent hits can be rejected early at the limit,
+    but never allowed beyond it.
+    """
+
+    STORAGE_SCHEME = ["resp"]
+
+    def __init__(self, uri: Optional[str] = None, timeout: float = 0.25, **options):
+        super().__init__(uri, **options)
+        parsed = urllib.parse.urlparse(uri or "resp://localhost:6379")
+        self.address = (parsed.hostname or "localhost", parsed.port or 6379)
+        self.password = parsed.password
+        self.database = int(parsed.path.strip("/") or 0)
+        self.timeout = float(timeout)
+        self._socket = None
+        self._reader = None
+
+    def _connect(self):
+        self._socket = socket.create_connection(self.address, timeout=self.timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._socket.makefile("rb")
+        if self.password:
+            self._send([("AUTH", self.password)])
+        if self.database:
+            self._send([("SELECT", self.database)])
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._reader.close()
+            self._socket.close()
+        self._socket = None
+        self._reader = None
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the rate limit storage")
+        prefix, value = line[:1], line[1:-2]
+        if prefix == b"+":
+            return value.decode("utf-8")
+        if prefix == b"-":
+            raise RespError(value.decode("utf-8"))
+        if prefix == b":":
+            return int(value)
+        if prefix == b"$":
+            length = int(value)
+            if length < 0:
+                return None
+            return self._reader.read(length + 2)[:-2].decode("utf-8")
+        if prefix == b"*":
+            length = int(value)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise ConnectionError(f"Invalid reply from the rate limit storage: {line!r}")
+
+    def _send(self, commands):
+        payload = bytearray()
+        for command in commands:
+            payload += b"*%d\r\n" % len(command)
+            for argument in command:
+                argument = str(argument).encode("utf-8")
+                payload += b"$%d\r\n%s\r\n" % (len(argument), argument)
+        self._socket.sendall(payload)
+        return [self._read_reply() for _ in commands]
+
+    def execute(self, *commands):
+        """
+        Sends commands in one pipeline and returns their replies, reconnecting once if the connection was lost
+        """
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self._socket is None:
+                        self._connect()
+                    return self._send(commands)
+                except (OSError, ConnectionError):
+                    self._disconnect()
+                    if attempt:
+                        raise
+
+    def _window_keys(self, key: str, expiry: int, now: float):
+        window = int(now // expiry)
+        return window, f"{key}/{window}", f"{key}/{window - 1}"
+
+    def acquire_entry(self, key: str, limit: int, expiry: int, amount: int = 1) -> bool:
+        now = time.time()
+        window, current_key, previous_key = self._window_keys(key, expiry, now)
+        current, _, previous = self.execute(
+            ("INCRBY", current_key, amount),
+            ("PEXPIRE", current_key, expiry * 2000),
+            ("GET", previous_key),
+        )
+        if sliding_window_count(current, int(previous or 0), expiry, now) > limit:
+            self.execute(("DECRBY", current_key, amount))
+            return False
+        return True
+
+    def get_moving_window(self, key: str, limit: int, expiry: int) -> Tuple[int, int]:
+        now = time.time()
+        window, current_key, previous_key = self._window_keys(key, expiry, now)
+        [[current, previous]] = self.execute(("MGET", current_key, previous_key))
+        count = sliding_window_count(int(current or 0), int(previous or 0), expiry, now)
+        return window * expiry, int(count)
+
+    def incr(
+        self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1
+    ) -> int:
+        count, ttl = self.execute(("INCRBY", key, amount), ("PTTL", key))
+        if elastic_expiry or ttl < 0:
+            self.execute(("EXPIRE", key, expiry))
+        return count
+
+    def get(self, key: str) -> int:
+        [count] = self.execute(("GET", key))
+        return int(count or 0)
+
+    def get_expiry(self, key: str) -> int:
+        [ttl] = self.execute(("PTTL", key))
+        return int(time.time() + max(ttl, 0) / 1000)
+
+    def check(self) -> bool:
+        try:
+            return self.execute(("PING",)) == ["PONG"]
+        except (OSError, ConnectionError, RespError):
+            return False
+
+    def clear(self, key: str) -> None:
+        # Sliding window counts are kept under a key per window (see _window_keys), which depends on the expiry
+        # clear isn't given, so every window of the key is removed along with the count used by incr
+        pattern = re.sub(r"([\\*?\[\]])", r"\\\1", key) + "/*"
+        keys = [key]
+        cursor = "0"
+        while True:
+            [[cursor, window_keys]] = self.execute(("SCAN", cursor, "MATCH", pattern))
+            keys.extend(window_keys)
+            if cursor == "0":
+                break
+        self.execute(("DEL", *keys))
+
+    def reset(self) -> Optional[int]:
+        # Only the limiters keys are removed, in case the server is shared
+        cleared = 0
+        cursor = "0"
+        while True:
+            [[cursor, keys]] = self.execute(("SCAN", cursor, "MATCH", "LIMITER*"))
+            if keys:
+                cleared += self.execute(("DEL", *keys))[0]
+            if cursor == "0":
+                return cleared
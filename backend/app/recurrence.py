@@ -0,0 +1,71 @@
+import datetime
+from typing import Iterator
+
+# Helpers for recurring bookings, which store the days of the week they repeat on as a bitmask
+# Bit 0 is Monday through to bit 6 for Sunday, matching datetime.date.weekday()
+
+ALL_WEEKDAYS = 0b1111111
+
+
+def weekdays_to_mask(weekdays: list[int]):
+    mask = 0
+    for weekday in weekdays:
+        mask |= 1 << weekday
+    return mask
+
+
+def mask_to_weekdays(mask: int):
+    return [weekday for weekday in range(7) if mask & (1 << weekday)]
+
+
+def weekday_bit(date: datetime.date):
+    return 1 << date.weekday()
+
+
+def occurrences(
+    start_date: datetime.date,
+    end_date: datetime.date,
+    mask: int,
+    from_date: datetime.date,
+    to_date: datetime.date,
+) -> Iterator[datetime.date]:
+    """
+    Expands a recurring booking into the dates it occurs on, only within the requested window
+
+    Parameters:
+            start_date (datetime.date): The first day the recurring booking applies
+            end_date (datetime.date): The last day the recurring booking applies
+            mask (int): The days of the week it repeats on
+            from_date (datetime.date): The first day of the window
+            to_date (datetime.date): The last day of the window
+
+    Returns:
+        dates (Iterator[datetime.date]): Each date the recurring booking occurs on in the window
+    """
+    day = max(start_date, from_date)
+    last_day = min(end_date, to_date)
+    while day <= last_day:
+        if mask & weekday_bit(day):
+            yield day
+        day += datetime.timedelta(days=1)
+
+
+def first_shared_date(
+    start_date: datetime.date,
+    end_date: datetime.date,
+    mask: int,
+    other_start_date: datetime.date,
+    other_end_date: datetime.date,
+    other_mask: int,
+):
+    """
+    Finds the first date two recurring bookings both occur on, at most a week is checked since patterns repeat weekly
+
+    Returns:
+        date (datetime.date or None): The first shared date, or None if they never coincide
+    """
+    from_date = max(start_date, other_start_date)
+    to_date = min(end_date, other_end_date, from_date + datetime.timedelta(days=6))
+    return next(
+        occurrences(from_date, to_date, mask & other_mask, from_date, to_date), None
+    )
@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from starlette.requests import Request
+
+# Read-through cache of the responses of the room and desk read endpoints, which are read constantly but rarely
+# change. Entries are keyed by route and query string, and are tagged with the tables their response was read from.
+# crud.py drops every entry tagged with a table as soon as it writes to it. Responses with an ETag are also keyed
+# by it, so they miss as soon as another worker writes, otherwise other workers pick the change up once their
+# entries expire after RESPONSE_CACHE_TTL seconds. The least recently used are evicted beyond
+# RESPONSE_CACHE_SIZE entries.
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 512))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 60))
+
+
+def cache_key(request: Request):
+    """
+    Returns the key of a request, from its path, its query parameters in a consistent order and the ETag of the
+    versions it is read from. As the versions are read from the database, writes through other workers are seen
+    straight away too.
+    """
+    return (
+        request.url.path,
+        tuple(sorted(request.query_params.multi_items())),
+        getattr(request.state, "etag", None),
+    )
+
+
+class ResponseCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (ROUTE, KEY) -> (VALUE, TABLES, MONOTONIC EXPIRY TIME)
+        self._entries = OrderedDict()
+        # ROUTE -> [HITS, MISSES]
+        self._lookups = defaultdict(lambda: [0, 0])
+
+    def get(self, route: str, key):
+        """
+        Returns the cached value of a request to a route, or None if it isn't cached
+
+        Parameters:
+                route (str): The name of the endpoint
+                key (tuple): The key of the request, from cache_key
+
+        Returns:
+            value (any or None): The value given to put
+        """
+        with self._lock:
+            entry = self._entries.get((route, key))
+            if entry is None or entry[2] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[(route, key)]
+                self._lookups[route][1] += 1
+                return None
+            self._entries.move_to_end((route, key))
+            self._lookups[route][0] += 1
+            return entry[0]
+
+    def put(self, route: str, key, value, tables: tuple):
+        """
+        Caches the value of a request to a route
+
+        Parameters:
+                route (str): The name of the endpoint
+                key (tuple): The key of the request, from cache_key
+                value (any): What to return for later requests, it must not be modified afterwards
+                tables (tuple): The models the value was read from, writing to any of them drops the entry
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[(route, key)] = (
+                value,
+                frozenset(model.__tablename__ for model in tables),
+                time.monotonic() + self.ttl,
+            )
+            self._entries.move_to_end((route, key))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_model(self, model):
+        with self._lock:
+            for entry_key in [
+                entry_key
+                for entry_key, (_, tables, _) in self._entries.items()
+                if model.__tablename__ in tables
+            ]:
+                del self._entries[entry_key]
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def statistics(self):
+        with self._lock:
+            routes = {}
+            for route, (hits, misses) in self._lookups.items():
+                routes[route] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+                }
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "routes": routes,
+            }
+
+
+cache = ResponseCache(max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
@@ -1,7 +1,9 @@
-from typing import List, Tuple, Union
+from typing import Dict, List, Literal, Tuple, Union
 
 import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, conint, conlist, validator
+
+from app import recurrence
 
 # Used for pydantic to define custom types
 # The majority are mapped to database tables
@@ -79,6 +81,17 @@ class DeskUpdate(BaseModel):
         orm_mode = True
 
 
+class DeskImportSkippedRow(DeskBase):
+    line: int
+    reason: Literal["duplicate", "exists", "unknown_room"]
+
+
+class DeskImportResult(BaseModel):
+    rows: int
+    created: int
+    skipped: List[DeskImportSkippedRow]
+
+
 class DeskSummary(DeskBase):
     id: int
     room: Room
@@ -114,6 +127,85 @@ class BookingSummary(BookingBase):
         orm_mode = True
 
 
+class RoomBooking(BookingBase):
+    # Bookings of a room on a day include occurrences of recurring bookings, which have no booking ID
+    id: Union[int, None] = None
+    recurring_booking_id: Union[int, None] = None
+
+    class Config:
+        orm_mode = True
+
+
+class RecurringBookingBase(BaseModel):
+    desk_id: int
+    user_id: int
+    # Days of the week the booking repeats on, 0 is Monday through to 6 for Sunday
+    weekdays: conlist(conint(ge=0, le=6), min_items=1)
+    start_date: datetime.date
+    end_date: datetime.date
+    approved_status: bool = False
+
+
+class RecurringBookingCreate(RecurringBookingBase):
+    pass
+
+
+class RecurringBooking(RecurringBookingBase):
+    id: int
+    weekdays: List[int]
+
+    class Config:
+        orm_mode = True
+
+    @validator("weekdays", pre=True)
+    def expand_weekday_mask(cls, weekdays):
+        # The database stores the weekdays as a bitmask
+        if isinstance(weekdays, int):
+            return recurrence.mask_to_weekdays(weekdays)
+        return weekdays
+
+
+class DeskBlock(BaseModel):
+    room_id: int
+    date: datetime.date
+    count: int
+    user_id: int
+    approved_status: bool = False
+
+
+class BookingBatchCreate(BaseModel):
+    bookings: List[BookingCreate] = []
+    block: Union[DeskBlock, None] = None
+
+
+class BookingBatchItem(BaseModel):
+    desk_id: int
+    date: datetime.date
+    status: Literal["created", "conflict", "duplicate", "not_created"]
+    booking: Union[Booking, None] = None
+
+    class Config:
+        orm_mode = True
+
+
+class BookingBatchResult(BaseModel):
+    created: bool
+    items: List[BookingBatchItem]
+
+
+class DeskAvailability(BaseModel):
+    desk_id: int
+    number: int
+    days: Dict[datetime.date, Literal["free", "booked", "pending"]]
+
+
+class RoomAvailability(BaseModel):
+    room_id: int
+    from_date: datetime.date
+    to_date: datetime.date
+    desks: List[DeskAvailability]
+
+
 class BookingUpdate(BaseModel):
     desk_id: Union[int, None] = None
     user_id: Union[int, None] = None
@@ -130,6 +222,10 @@ class Token(BaseModel):
     token_type: str
 
 
+class TokenRefresh(BaseModel):
+    refresh_token: str
+
+
 class TokenData(BaseModel):
     username: Union[str, None] = None
 
@@ -143,3 +239,39 @@ class JoinResult(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+class PoolStatus(BaseModel):
+    pool_size: int
+    max_overflow: int
+    timeout: float
+    checked_out: int
+    idle: int
+    overflow: int
+    wait_count: int
+    wait_sum_ms: float
+    wait_max_ms: float
+    wait_histogram_ms: Dict[str, int]
+    timeouts: int
+
+
+class PrincipalCacheStatus(BaseModel):
+    size: int
+    max_size: int
+    ttl: float
+    hits: int
+    misses: int
+    hit_ratio: float
+
+
+class RouteCacheStatus(BaseModel):
+    hits: int
+    misses: int
+    hit_ratio: float
+
+
+class ResponseCacheStatus(BaseModel):
+    size: int
+    max_size: int
+    ttl: float
+    routes: dict[str, RouteCacheStatus]
@@ -1,11 +1,20 @@
+import contextlib
 import datetime
+import fnmatch
 import os
+import socketserver
+import threading
+import time
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
 from app.models import Base
-from app.main import app, get_db, auth, models
+from app.main import app, get_db, auth, models, availability, counting
+from app.main import response_cache, metrics
 from sqlalchemy_utils import create_database, drop_database, database_exists
 
 SQLALCHEMY_DATABASE_URL = os.environ.get(
@@ -14,6 +23,8 @@ SQLALCHEMY_DATABASE_URL = os.environ.get(
 )
 
 engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_pre_ping=True)
+# Statements are timed as they are on the engine in database.py
+metrics.instrument_engine(engine)
 
 
 def get_test_db():  # pragma: no cover
@@ -47,9 +58,13 @@ def create_test_database():  # pragma: no cover
 @pytest.fixture(scope="class", autouse=True)
 def test_db():  # pragma: no cover
     """
-    Recreate tables (remove data) after every test class
+    Recreate tables (remove data) and reset rate limits after every test class
     """
     Base.metadata.create_all(bind=engine)
+    availability.index.invalidate()
+    counting.cache.invalidate()
+    response_cache.cache.invalidate()
+    app.state.limiter.reset()
     yield
     Base.metadata.drop_all(bind=engine)
 
@@ -81,6 +96,134 @@ def client_authenticated():  # pragma: no cover
     return TestClient(app)
 
 
+@pytest.fixture()
+def postgres():  # pragma: no cover
+    """
+    Skips tests of code which only runs on PostgreSQL when the suite is run against another database
+    """
+    if engine.dialect.name != "postgresql":
+        pytest.skip("Requires PostgreSQL")
+
+
+@pytest.fixture()
+def async_session(postgres):  # pragma: no cover
+    """
+    Provides a factory of asyncpg sessions of the test database, configured as in DATABASE_MODE=async.
+    Connections aren't pooled, as each asyncio.run() has its own event loop.
+    """
+    async_engine = create_async_engine(
+        make_url(SQLALCHEMY_DATABASE_URL).set(drivername="postgresql+asyncpg"),
+        poolclass=NullPool,
+    )
+    metrics.instrument_engine(async_engine.sync_engine)
+    return async_sessionmaker(
+        bind=async_engine, autoflush=False, expire_on_commit=False
+    )
+
+
+@pytest.fixture()
+def db_session():  # pragma: no cover
+    """
+    Provides a session of the test database, for calling crud.py directly
+    """
+    yield from get_test_db()
+
+
+@pytest.fixture()
+def query_budget():  # pragma: no cover
+    """
+    Fails a test when the requests inside the block execute more SQL statements than the declared budget,
+    catching N+1 lazy loads. Usage: with query_budget(1): client.get(...)
+    """
+
+    @contextlib.contextmanager
+    def budget(max_statements):
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", count_statement)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, "before_cursor_execute", count_statement)
+        assert len(statements) <= max_statements, (
+            f"{len(statements)} statements executed, budget is {max_statements}:\n"
+            + "\n".join(statements)
+        )
+
+    return budget
+
+
+class RespStandIn(socketserver.StreamRequestHandler):  # pragma: no cover
+    """
+    A tiny in-process server speaking enough of the Redis protocol to test the resp:// rate limit storage
+    """
+
+    def handle(self):
+        data, expiries = self.server.data, self.server.expiries
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                command.append(self.rfile.read(length + 2)[:-2].decode())
+            name, args = command[0].upper(), command[1:]
+            with self.server.lock:
+                for key in [key for key, at in expiries.items() if at <= time.time()]:
+                    data.pop(key, None)
+                    expiries.pop(key)
+                if name == "PING":
+                    reply = b"+PONG\r\n"
+                elif name in ("INCRBY", "DECRBY"):
+                    sign = 1 if name == "INCRBY" else -1
+                    data[args[0]] = int(data.get(args[0], 0)) + sign * int(args[1])
+                    reply = b":%d\r\n" % data[args[0]]
+                elif name == "PEXPIRE":
+                    expiries[args[0]] = time.time() + int(args[1]) / 1000
+                    reply = b":1\r\n"
+                elif name in ("GET", "MGET"):
+                    values = [data.get(key) for key in args]
+                    reply = b"".join(
+                        b"$-1\r\n"
+                        if value is None
+                        else b"$%d\r\n%d\r\n" % (len(str(value)), value)
+                        for value in values
+                    )
+                    if name == "MGET":
+                        reply = b"*%d\r\n" % len(values) + reply
+                elif name == "SCAN":
+                    keys = [key for key in data if fnmatch.fnmatch(key, args[2])]
+                    reply = b"*2\r\n$1\r\n0\r\n*%d\r\n" % len(keys) + b"".join(
+                        b"$%d\r\n%s\r\n" % (len(key), key.encode()) for key in keys
+                    )
+                elif name == "DEL":
+                    reply = b":%d\r\n" % sum(
+                        data.pop(key, None) is not None for key in args
+                    )
+                else:
+                    reply = b"-ERR unknown command\r\n"
+            self.wfile.write(reply)
+
+
+@pytest.fixture()
+def resp_server():  # pragma: no cover
+    """
+    Starts a Redis protocol stand-in on a free local port, yielding its address
+    """
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), RespStandIn)
+    server.daemon_threads = True
+    server.data, server.expiries, server.lock = {}, {}, threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address
+    server.shutdown()
+    server.server_close()
+
+
 @pytest.fixture()
 def request_data():  # pragma: no cover
     """
@@ -1,3 +1,26 @@
+import asyncio
+import datetime
+import io
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+from jose import jwt
+from limits import parse, strategies
+from limits.storage import storage_from_string
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from starlette.requests import Request
+
+from app import availability, crud, database, desk_import, fast_json, hashing
+from app import loading, log_pipeline, metrics, middleware, models
+from app import principal_cache, rate_limiting, response_cache, schemas, security
+
+
 class TestPostAndGetEndpoints:
     def test_create_and_get_user(
         self, client_authenticated, request_data, response_data
@@ -63,6 +86,13 @@ class TestPostAndGetEndpoints:
         data = response.json()
         assert data == response_data["booking_response"]
 
+    def test_create_duplicate_booking(self, client_authenticated, request_data):
+        response = client_authenticated.post(
+            "/bookings",
+            json=request_data["booking_request"],
+        )
+        assert response.status_code == 409, response.text
+
     def test_get_all_desks_in_room(
         self, client_authenticated, request_data, response_data
     ):
@@ -78,6 +108,36 @@ class TestPostAndGetEndpoints:
 
         assert data == response_data["room_response_multiple"]
 
+    def test_content_range_total(self, client_authenticated):
+        response = client_authenticated.get(f"/rooms/{1}/desks")
+        assert response.headers["Content-Range"] == "desks 0-3/4"
+
+        response = client_authenticated.get("/desks?range=[1,2]")
+        assert response.headers["Content-Range"] == "desks 1-2/4"
+
+        response = client_authenticated.get("/desks?range=[10,2]")
+        assert response.headers["Content-Range"] == "desks */4"
+
+    def test_get_desks_in_room_by_cursor(self, client_authenticated, response_data):
+        response = client_authenticated.get(f"/rooms/{1}/desks?limit=3")
+        assert response.status_code == 200, response.text
+        assert response.json() == response_data["room_response_multiple"][:3]
+
+        cursor = response.headers["X-Next-Cursor"]
+        response = client_authenticated.get(f"/rooms/{1}/desks?limit=3&cursor={cursor}")
+        assert response.status_code == 200, response.text
+        assert response.json() == response_data["room_response_multiple"][3:]
+        assert "X-Next-Cursor" not in response.headers
+
+        response = client_authenticated.get('/desks?limit=2&sort=["number","DESC"]')
+        assert [desk["number"] for desk in response.json()] == [14, 12]
+        cursor = response.headers["X-Next-Cursor"]
+        response = client_authenticated.get(f"/desks?cursor={cursor}")
+        assert [desk["number"] for desk in response.json()] == [10, 4]
+
+        response = client_authenticated.get("/desks?cursor=invalid")
+        assert response.status_code == 400, response.text
+
     def test_get_all_booking_in_room(
         self, client_authenticated, request_data, response_data
     ):
@@ -92,11 +152,52 @@ class TestPostAndGetEndpoints:
             json=request_data["booking_request_2"],
         )
         assert response.status_code == 200, response.text
+        # The rejected duplicate booking still used up an ID on PostgreSQL
+        first_booking, second_booking = response_data["booking_response_multiple"]
+        second_booking = dict(second_booking, id=response.json()["id"])
 
         response = client_authenticated.get(f"/rooms/{1}/bookings/2020-05-17")
         data = response.json()
 
-        assert data == response_data["booking_response_multiple"]
+        assert data == [first_booking, second_booking]
+
+        response = client_authenticated.get("/bookings?range=[0,1]")
+        assert response.headers["Content-Range"] == "bookings 0-0/2"
+
+    def test_patch_booking_onto_booked_desk(self, client_authenticated):
+        response = client_authenticated.get(f"/rooms/{1}/bookings/2020-05-17")
+        booking_id = response.json()[1]["id"]
+
+        response = client_authenticated.patch(
+            f"/bookings/{booking_id}", json={"desk_id": 1}
+        )
+        assert response.status_code == 409, response.text
+
+        response = client_authenticated.get(f"/bookings/{booking_id}")
+        assert response.json()["desk_id"] == 3
+
+    def test_get_room_availability(self, client_authenticated):
+        response = client_authenticated.get(
+            f"/rooms/{1}/availability?from=2020-05-17&to=2020-05-18"
+        )
+        assert response.status_code == 200, response.text
+        desks = response.json()["desks"]
+
+        assert [desk["number"] for desk in desks] == [4, 10, 12, 14]
+        assert desks[0]["days"] == {"2020-05-17": "pending", "2020-05-18": "free"}
+        assert desks[1]["days"] == {"2020-05-17": "free", "2020-05-18": "free"}
+        assert desks[2]["days"] == {"2020-05-17": "booked", "2020-05-18": "free"}
+
+    def test_get_room_availability_with_error(self, client_authenticated):
+        response = client_authenticated.get(
+            f"/rooms/{100}/availability?from=2020-05-17&to=2020-05-18"
+        )
+        assert response.status_code == 404, response.text
+
+        response = client_authenticated.get(
+            f"/rooms/{1}/availability?from=2020-05-18&to=2020-05-17"
+        )
+        assert response.status_code == 400, response.text
 
 
 class TestDeleteEndpointsAndGetErrors:
@@ -316,3 +417,1132 @@ class TestUserAuth:
         )
 
         assert response.status_code == 401, response.text
+
+    def test_refresh_token_rotation(self, client, headers, request_data):
+        response = client.post(
+            "/login", data=request_data["user_request_3"], headers=headers
+        )
+        first_refresh_token = response.json()["refresh_token"]
+
+        response = client.post(
+            "/token/refresh", json={"refresh_token": first_refresh_token}
+        )
+        assert response.status_code == 200, response.text
+        second_refresh_token = response.json()["refresh_token"]
+        assert second_refresh_token != first_refresh_token
+        assert response.json()["access_token"]
+
+        # Reusing a refresh token revokes every token from the same login
+        response = client.post(
+            "/token/refresh", json={"refresh_token": first_refresh_token}
+        )
+        assert response.status_code == 401, response.text
+        response = client.post(
+            "/token/refresh", json={"refresh_token": second_refresh_token}
+        )
+        assert response.status_code == 401, response.text
+
+        response = client.post("/token/refresh", json={"refresh_token": "invalid"})
+        assert response.status_code == 401, response.text
+
+
+class TestBatchBookings:
+    def test_book_block_of_adjacent_desks(self, client_authenticated, request_data):
+        client_authenticated.post("/register", json=request_data["user_request"])
+        client_authenticated.post("/rooms", json=request_data["room_request"])
+        client_authenticated.post("/desks", json=request_data["desk_request"])
+        for desk in request_data["desk_request_multiple"]:
+            client_authenticated.post("/desks", json=desk)
+
+        block = {"room_id": 1, "date": "2020-05-17", "count": 2, "user_id": 1}
+        response = client_authenticated.post("/bookings/batch", json={"block": block})
+        assert response.status_code == 200, response.text
+        data = response.json()
+        assert data["created"] is True
+        assert [item["desk_id"] for item in data["items"]] == [1, 2]
+        assert [item["booking"]["id"] for item in data["items"]] == [1, 2]
+
+        response = client_authenticated.post(
+            "/bookings", json={**request_data["booking_request"], "desk_id": 3}
+        )
+        assert response.status_code == 200, response.text
+
+        response = client_authenticated.post("/bookings/batch", json={"block": block})
+        assert response.status_code == 409, response.text
+
+    def test_batch_is_all_or_nothing(self, client_authenticated, request_data):
+        bookings = [
+            {**request_data["booking_request"], "desk_id": 4},
+            {**request_data["booking_request"], "desk_id": 1},
+        ]
+        response = client_authenticated.post(
+            "/bookings/batch", json={"bookings": bookings}
+        )
+        assert response.status_code == 409, response.text
+        data = response.json()
+        assert data["created"] is False
+        assert [item["status"] for item in data["items"]] == ["not_created", "conflict"]
+
+        response = client_authenticated.get(f"/rooms/{1}/bookings/2020-05-17")
+        assert [booking["desk_id"] for booking in response.json()] == [1, 2, 3]
+
+        response = client_authenticated.post(
+            "/bookings/batch", json={"bookings": [bookings[0], bookings[0]]}
+        )
+        assert response.status_code == 409, response.text
+        assert response.json()["items"][0]["status"] == "duplicate"
+
+        response = client_authenticated.post(
+            "/bookings/batch", json={"bookings": bookings[:1]}
+        )
+        assert response.status_code == 200, response.text
+        assert response.json()["items"][0]["status"] == "created"
+
+
+class TestAvailabilitySearch:
+    def test_search_free_desks(self, client_authenticated, request_data):
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        day_after = tomorrow + datetime.timedelta(days=1)
+        client_authenticated.post("/register", json=request_data["user_request"])
+        client_authenticated.post("/rooms", json=request_data["room_request"])
+        for desk in request_data["desk_request_multiple"]:
+            client_authenticated.post("/desks", json=desk)
+
+        response = client_authenticated.get(
+            f"/availability/search?dates={tomorrow}&room_ids=1"
+        )
+        assert response.status_code == 200, response.text
+        assert [desk["id"] for desk in response.json()] == [1, 2, 3]
+
+        response = client_authenticated.post(
+            "/bookings",
+            json={**request_data["booking_request"], "date": str(day_after)},
+        )
+        assert response.status_code == 200, response.text
+
+        response = client_authenticated.get(
+            f"/availability/search?dates={tomorrow}&dates={day_after}"
+        )
+        assert response.status_code == 200, response.text
+        assert [desk["id"] for desk in response.json()] == [2, 3]
+
+        response = client_authenticated.delete(f"/bookings/{1}")
+        assert response.status_code == 204, response.text
+
+        response = client_authenticated.get(f"/availability/search?dates={day_after}")
+        assert [desk["id"] for desk in response.json()] == [1, 2, 3]
+
+    def test_search_outside_window(self, client_authenticated):
+        response = client_authenticated.get("/availability/search?dates=2020-05-17")
+        assert response.status_code == 400, response.text
+
+    def test_build_waits_off_the_event_loop(self, db_session, monkeypatch):
+        index = availability.AvailabilityIndex(window_days=30, max_age=60)
+        monkeypatch.setattr(availability, "index", index)
+        # As if another request were building the index
+        index._rebuild_lock.acquire()
+
+        async def build():
+            building = asyncio.ensure_future(
+                availability.ensure_index_built("test", db_session)
+            )
+            # The event loop keeps running while the build waits for the lock
+            ticks = 0
+            while not building.done():
+                ticks += 1
+                if ticks == 10:
+                    index._rebuild_lock.release()
+                await asyncio.sleep(0.01)
+            await building
+            return ticks
+
+        assert asyncio.run(build()) >= 10
+        assert index.is_built()
+
+    def test_changes_during_rebuild_are_kept(
+        self, client_authenticated, request_data, db_session
+    ):
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        client_authenticated.post("/rooms", json=request_data["room_request"])
+        client_authenticated.post("/desks", json=request_data["desk_request"])
+        index = availability.AvailabilityIndex(window_days=30, max_age=60)
+        querying = threading.Event()
+        resume = threading.Event()
+
+        def pause_rebuild(*args):
+            if threading.current_thread().name == "availability-rebuild":
+                querying.set()
+                resume.wait(5)
+
+        bind = db_session.get_bind()
+        event.listen(bind, "before_cursor_execute", pause_rebuild)
+        try:
+            index.refresh_in_background(lambda: Session(bind))
+            assert querying.wait(5)
+            # Only one rebuild runs at a time
+            index.refresh_in_background(lambda: Session(bind))
+            rebuilds = [
+                thread
+                for thread in threading.enumerate()
+                if thread.name == "availability-rebuild"
+            ]
+            assert len(rebuilds) == 1
+            # Made after the rebuild started querying, so only kept if applied again once it finishes
+            index.add_booking(1, tomorrow)
+            index.add_desk(99, 1, 99)
+            resume.set()
+            rebuilds[0].join(5)
+        finally:
+            resume.set()
+            event.remove(bind, "before_cursor_execute", pause_rebuild)
+        assert index.is_built()
+        free_desks = index.search([tomorrow])
+        assert 1 not in [desk_id for desk_id, _, _ in free_desks]
+        assert (99, 1, 99) in free_desks
+
+
+class TestRecurringBookings:
+    def test_create_recurring_booking(self, client_authenticated, request_data):
+        client_authenticated.post("/register", json=request_data["user_request"])
+        client_authenticated.post("/rooms", json=request_data["room_request"])
+        for desk in request_data["desk_request_multiple"]:
+            client_authenticated.post("/desks", json=desk)
+        # 2020-05-19 is a Tuesday
+        client_authenticated.post(
+            "/bookings", json={**request_data["booking_request"], "date": "2020-05-19"}
+        )
+
+        recurring_booking = {
+            "desk_id": 1,
+            "user_id": 1,
+            "weekdays": [1, 3],
+            "start_date": "2020-05-01",
+            "end_date": "2020-05-31",
+        }
+        response = client_authenticated.post(
+            "/bookings/recurring", json=recurring_booking
+        )
+        assert response.status_code == 409, response.text
+        assert response.json()["detail"]["dates"] == ["2020-05-19"]
+
+        response = client_authenticated.post(
+            "/bookings/recurring", json={**recurring_booking, "desk_id": 2}
+        )
+        assert response.status_code == 200, response.text
+        assert response.json()["weekdays"] == [1, 3]
+
+        response = client_authenticated.post(
+            "/bookings/recurring",
+            json={
+                **recurring_booking,
+                "desk_id": 2,
+                "weekdays": [3, 4],
+                "start_date": "2020-05-20",
+                "end_date": "2020-06-30",
+            },
+        )
+        assert response.status_code == 409, response.text
+        assert response.json()["detail"]["dates"] == ["2020-05-21"]
+
+    def test_recurring_booking_occupies_desk(self, client_authenticated, request_data):
+        response = client_authenticated.get(f"/rooms/{1}/bookings/2020-05-21")
+        assert response.status_code == 200, response.text
+        assert response.json() == [
+            {
+                "desk_id": 2,
+                "user_id": 1,
+                "date": "2020-05-21",
+                "approved_status": False,
+                "recurring_booking_id": 1,
+            }
+        ]
+
+        response = client_authenticated.get(
+            f"/rooms/{1}/availability?from=2020-05-18&to=2020-05-21"
+        )
+        assert response.json()["desks"][1]["days"] == {
+            "2020-05-18": "free",
+            "2020-05-19": "pending",
+            "2020-05-20": "free",
+            "2020-05-21": "pending",
+        }
+
+        booking = {
+            **request_data["booking_request"],
+            "desk_id": 2,
+            "date": "2020-05-21",
+        }
+        response = client_authenticated.post("/bookings", json=booking)
+        assert response.status_code == 409, response.text
+
+        # Nor can a booking be moved onto it
+        response = client_authenticated.patch(
+            f"/bookings/{1}", json={"desk_id": 2, "date": "2020-05-21"}
+        )
+        assert response.status_code == 409, response.text
+        response = client_authenticated.get(f"/bookings/{1}")
+        assert response.json()["desk_id"] == 1
+        assert response.json()["date"] == "2020-05-19"
+        response = client_authenticated.patch(
+            f"/bookings/{1}", json={"desk_id": 2, "date": "2020-05-20"}
+        )
+        assert response.status_code == 200, response.text
+        assert response.json()["desk_id"] == 2
+        response = client_authenticated.patch(
+            f"/bookings/{1}", json={"desk_id": 1, "approved_status": True}
+        )
+        assert response.status_code == 200, response.text
+
+        response = client_authenticated.delete(f"/bookings/recurring/{1}")
+        assert response.status_code == 204, response.text
+
+        response = client_authenticated.post("/bookings", json=booking)
+        assert response.status_code == 200, response.text
+
+        response = client_authenticated.get(f"/bookings/recurring/{1}")
+        assert response.status_code == 404, response.text
+
+    def test_concurrent_writes_are_serialised_per_desk(self, db_session, postgres):
+        bind = db_session.get_bind()
+        # 2020-06-01 is a Monday
+        rule = schemas.RecurringBookingCreate(
+            desk_id=3,
+            user_id=1,
+            weekdays=[0],
+            start_date=datetime.date(2020, 6, 1),
+            end_date=datetime.date(2020, 6, 30),
+        )
+        booking = schemas.BookingCreate(
+            desk_id=3, user_id=1, date=datetime.date(2020, 6, 8), approved_status=False
+        )
+        results = {}
+        checked = threading.Event()
+        commit = threading.Event()
+
+        def hold_commit(session):
+            # The first recurring booking has checked for clashes and holds the lock on the desk
+            checked.set()
+            commit.wait(5)
+
+        def create(name, function, db=None, **kwargs):
+            with db or Session(bind) as session:
+                results[name] = function(current_uuid="test", db=session, **kwargs)
+
+        first = Session(bind)
+        event.listen(first, "before_commit", hold_commit)
+        threads = [
+            threading.Thread(
+                target=create,
+                args=("first", crud.create_recurring_booking, first),
+                kwargs={"recurring_booking": rule},
+            )
+        ]
+        try:
+            threads[0].start()
+            assert checked.wait(5)
+            threads += [
+                threading.Thread(
+                    target=create,
+                    args=("booking", crud.create_booking),
+                    kwargs={"booking": booking},
+                ),
+                threading.Thread(
+                    target=create,
+                    args=("second", crud.create_recurring_booking),
+                    kwargs={"recurring_booking": rule},
+                ),
+            ]
+            for thread in threads[1:]:
+                thread.start()
+            time.sleep(0.2)
+            # Both wait for the first recurring booking to commit, rather than checking before it has
+            assert all(thread.is_alive() for thread in threads[1:])
+            commit.set()
+            for thread in threads:
+                thread.join(5)
+        finally:
+            commit.set()
+        assert results["first"][0] is not None
+        assert results["booking"] is None
+        assert results["second"] == (None, [datetime.date(2020, 6, 1)])
+
+
+class TestDeskImport:
+    def test_import_desks_from_csv(self, client_authenticated, request_data):
+        client_authenticated.post("/rooms", json=request_data["room_request"])
+        client_authenticated.post("/desks", json=request_data["desk_request"])
+
+        upload = "number,room_id\n1,1\n2,1\n3,1\n2,1\n4,100\n4,1\n"
+        response = client_authenticated.post(
+            "/desks/import", files={"file": ("desks.csv", upload, "text/csv")}
+        )
+        assert response.status_code == 200, response.text
+        data = response.json()
+        assert data["rows"] == 6
+        assert data["created"] == 3
+        assert [(row["line"], row["reason"]) for row in data["skipped"]] == [
+            (5, "duplicate"),
+            (6, "unknown_room"),
+            (7, "exists"),
+        ]
+
+        response = client_authenticated.get("/desks?range=[0,9]")
+        assert response.headers["Content-Range"] == "desks 0-3/4"
+
+    def test_import_desks_from_ndjson(self, client_authenticated):
+        upload = '{"number": 3, "room_id": 1}\n{"number": 5, "room_id": 1}\n'
+        response = client_authenticated.post(
+            "/desks/import?format=ndjson",
+            files={"file": ("desks.ndjson", upload, "application/x-ndjson")},
+        )
+        assert response.status_code == 200, response.text
+        data = response.json()
+        assert data["created"] == 1
+        assert data["skipped"] == [
+            {"line": 1, "number": 3, "room_id": 1, "reason": "exists"}
+        ]
+
+    def test_import_malformed_desks(self, client_authenticated):
+        upload = "number,room_id\n6,1\nsix,1\n"
+        response = client_authenticated.post(
+            "/desks/import", files={"file": ("desks.csv", upload, "text/csv")}
+        )
+        assert response.status_code == 400, response.text
+        assert "Line 3" in response.json()["detail"]
+
+        response = client_authenticated.get("/desks?range=[0,9]")
+        assert len(response.json()) == 5
+
+    def test_parse_upload_without_readable(self):
+        # The SpooledTemporaryFile of an UploadFile has no readable() before Python 3.11
+        class Upload:
+            def __init__(self, content):
+                self._file = io.BytesIO(content)
+
+            def __iter__(self):
+                return iter(self._file)
+
+            def read(self, *args):
+                return self._file.read(*args)
+
+            def readline(self, *args):
+                return self._file.readline(*args)
+
+        upload = Upload(b'\xef\xbb\xbfnumber,room_id\r\n1,1\r\n"2",1\n')
+        assert list(desk_import.parse_rows(upload, "csv")) == [(2, 1, 1), (3, 2, 1)]
+        upload = Upload(b'{"number": 3, "room_id": 1}\n\n{"number": 5, "room_id": 2}')
+        assert list(desk_import.parse_rows(upload, "ndjson")) == [(1, 3, 1), (3, 5, 2)]
+
+    def test_copy_stream(self):
+        stream = desk_import.CopyStream(iter([(2, 1, 1), (3, 10, 2)]))
+        assert stream.read(4) == b"2,1,"
+        assert stream.read() == b"1\n3,10,2\n"
+        assert stream.read() == b""
+        assert stream.rows_read == 2
+
+        rows = desk_import.parse_rows(io.BytesIO(b"number,room_id\n1,1\nx,1\n"), "csv")
+        stream = desk_import.CopyStream(rows)
+        with pytest.raises(ValueError):
+            stream.read()
+        assert str(stream.error) == "Line 3 must have an integer number and room_id"
+
+    def test_import_desks_with_copy(
+        self, client_authenticated, request_data, postgres, monkeypatch
+    ):
+        streams = []
+
+        class RecordedCopyStream(desk_import.CopyStream):
+            def __init__(self, rows):
+                super().__init__(rows)
+                streams.append(self)
+
+        monkeypatch.setattr(desk_import, "CopyStream", RecordedCopyStream)
+        client_authenticated.post("/rooms", json={"name": "Copied Room"})
+        upload = "number,room_id\n101,1\n102,1\n101,1\n"
+        response = client_authenticated.post(
+            "/desks/import", files={"file": ("desks.csv", upload, "text/csv")}
+        )
+        assert response.status_code == 200, response.text
+        assert response.json()["created"] == 2
+        assert [stream.rows_read for stream in streams] == [3]
+
+
+class TestBookingExport:
+    def test_export_bookings(self, client_authenticated, request_data):
+        client_authenticated.post("/register", json=request_data["user_request"])
+        client_authenticated.post("/rooms", json=request_data["room_request"])
+        for desk in request_data["desk_request_multiple"]:
+            client_authenticated.post("/desks", json=desk)
+        for desk_id, date in ((1, "2020-05-17"), (2, "2020-05-18"), (3, "2020-05-19")):
+            client_authenticated.post(
+                "/bookings",
+                json={
+                    **request_data["booking_request"],
+                    "desk_id": desk_id,
+                    "date": date,
+                },
+            )
+
+        response = client_authenticated.get("/bookings/export")
+        assert response.status_code == 200, response.text
+        assert response.headers["content-type"].startswith("text/csv")
+        assert response.text.splitlines() == [
+            "id,date,desk_id,user_id,approved_status",
+            "1,2020-05-17,1,1,false",
+            "2,2020-05-18,2,1,false",
+            "3,2020-05-19,3,1,false",
+        ]
+
+        response = client_authenticated.get(
+            "/bookings/export?format=ndjson&from=2020-05-18&to=2020-05-18"
+        )
+        assert response.status_code == 200, response.text
+        assert [json.loads(line) for line in response.text.splitlines()] == [
+            {
+                "id": 2,
+                "date": "2020-05-18",
+                "desk_id": 2,
+                "user_id": 1,
+                "approved_status": False,
+            }
+        ]
+
+        response = client_authenticated.get("/bookings/export?format=xml")
+        assert response.status_code == 422, response.text
+
+
+class TestQueryBudgets:
+    def test_own_bookings_are_one_query(
+        self, client_authenticated, request_data, query_budget
+    ):
+        # The authenticated test user has an ID of 5
+        for number in range(5):
+            client_authenticated.post(
+                "/register",
+                json={
+                    "username": f"budget{number}",
+                    "email": f"budget{number}@test.com",
+                    "password": "testpass",
+                },
+            )
+        client_authenticated.post("/rooms", json=request_data["room_request"])
+        for desk_id, desk in enumerate(request_data["desk_request_multiple"], start=1):
+            client_authenticated.post("/desks", json=desk)
+            client_authenticated.post(
+                "/bookings",
+                json={
+                    **request_data["booking_request"],
+                    "desk_id": desk_id,
+                    "user_id": 5,
+                },
+            )
+
+        with query_budget(1):
+            response = client_authenticated.get("/users/me/bookings/")
+        assert response.status_code == 200, response.text
+        assert len(response.json()) == 3
+        assert response.json()[0]["desk"]["room"]["name"] == "Test Room"
+
+    def test_own_booking_entities_are_one_query(self, db_session, query_budget):
+        with query_budget(1):
+            bookings = crud.get_users_bookings(
+                current_uuid="test", db=db_session, user_id=5
+            )
+            summaries = [schemas.BookingSummary.from_orm(b) for b in bookings]
+        assert len(summaries) == 3
+        assert summaries[0].desk.room.name == "Test Room"
+
+    def test_room_availability_is_one_query(self, client_authenticated, query_budget):
+        with query_budget(1):
+            response = client_authenticated.get(
+                f"/rooms/{1}/availability?from=2020-05-01&to=2020-05-31"
+            )
+        assert response.status_code == 200, response.text
+
+
+class TestProjections:
+    def test_rows_are_not_tracked(self, client_authenticated, request_data, db_session):
+        client_authenticated.post("/rooms", json=request_data["room_request"])
+        for desk in request_data["desk_request_multiple"]:
+            client_authenticated.post("/desks", json=desk)
+        desks = crud.get_desks_in_room(
+            current_uuid="test",
+            db=db_session,
+            room_id=1,
+            range=[0, 2],
+            sort=["number", "DESC"],
+            schema=schemas.Desk,
+        )
+        assert [schemas.Desk.from_orm(desk).number for desk in desks] == [14, 12]
+        assert len(db_session.identity_map) == 0
+
+    def test_nested_schemas_are_joined(self):
+        columns, joins, build = loading.projection(
+            models.Booking, schemas.BookingSummary
+        )
+        assert len(joins) == 3
+        labels = [column.name for column in columns]
+        assert len(labels) == len(set(labels))
+        assert "user__hashed_password" not in labels
+
+        class RoomWithDesks(schemas.Room):
+            desks: list[schemas.Desk]
+
+        with pytest.raises(ValueError):
+            loading.projection(models.Room, RoomWithDesks)
+
+
+class TestAsyncSession:
+    def test_run_in_async_session(
+        self, client_authenticated, request_data, async_session
+    ):
+        client_authenticated.post("/rooms", json=request_data["room_request"])
+        client_authenticated.post("/desks", json=request_data["desk_request"])
+
+        async def create_and_read_desks():
+            async with async_session() as db:
+                desk = await database.run_in_session(
+                    db,
+                    crud.create_desk,
+                    current_uuid="test",
+                    desk=schemas.DeskCreate(number=99, room_id=1),
+                )
+                desks = await database.run_in_session(
+                    db,
+                    crud.get_desks_in_room,
+                    current_uuid="test",
+                    room_id=1,
+                    range=None,
+                    sort=None,
+                    schema=schemas.Desk,
+                )
+            return desk, desks
+
+        desk, desks = asyncio.run(create_and_read_desks())
+        # Still readable once the session is closed, as objects aren't expired on commit
+        assert desk.number == 99
+        assert [schemas.Desk.from_orm(desk).number for desk in desks] == [4, 99]
+
+        response = client_authenticated.get(f"/desks/{desk.id}")
+        assert response.status_code == 200, response.text
+
+
+class TestMiddleware:
+    def test_flatten_query_string(self):
+        assert (
+            middleware.flatten_query_string(b'range=[0,9]&sort=["id","ASC"]')
+            == b"range=0&range=9&sort=id&sort=ASC"
+        )
+        assert (
+            middleware.flatten_query_string(b"range=%5B0%2C9%5D&from=2020-05-17")
+            == b"range=0&range=9&from=2020-05-17"
+        )
+
+    def test_encoded_lists_are_flattened(self, client_authenticated, request_data):
+        client_authenticated.post("/rooms", json=request_data["room_request"])
+        response = client_authenticated.get("/rooms?range=%5B0%2C9%5D")
+        assert response.status_code == 200, response.text
+        assert response.headers["Content-Range"] == "rooms 0-0/1"
+
+    def test_requests_are_logged(self, client_authenticated, caplog):
+        caplog.set_level(logging.INFO, logger="app.middleware")
+        response = client_authenticated.get("/rooms/1")
+        messages = [record.getMessage() for record in caplog.records]
+        request_uuid = messages[0].split(" - ")[0]
+        assert messages[0] == f"{request_uuid} - Start of GET request to path /rooms/1"
+        assert messages[-1].startswith(f"{request_uuid} - Response sent")
+        assert messages[-1].endswith(f"status code {response.status_code}")
+
+
+class CollectingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.add(threading.get_ident())
+
+
+class TestLogPipeline:
+    def test_records_written_on_listener_thread(self):
+        target = CollectingHandler()
+        target.set_name("test_target")
+        handler = log_pipeline.QueueListenerHandler(["test_target"])
+        handler.addFilter(log_pipeline.RequestUUIDFilter())
+        logger = logging.getLogger("test.log_pipeline")
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            token = log_pipeline.request_uuid.set("request-uuid")
+            logger.info("%s - Retrieved %s rows", "request-uuid", 3)
+            log_pipeline.request_uuid.reset(token)
+            logger.debug("%s - Not formatted", object())
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+        assert [record.getMessage() for record in target.records] == [
+            "request-uuid - Retrieved 3 rows"
+        ]
+        assert target.records[0].uuid == "request-uuid"
+        assert threading.get_ident() not in target.threads
+
+        # Records are dropped rather than blocking once a bounded queue is full
+        handler = log_pipeline.QueueListenerHandler(["test_target"], queue_size=1)
+        handler.close()
+        for _ in range(2):
+            handler.handle(logging.makeLogRecord({"msg": "queued"}))
+        assert handler.dropped == 1
+
+    def test_json_formatter(self):
+        record = logging.makeLogRecord(
+            {"name": "app.crud", "levelname": "INFO", "msg": "%s - Retrieved %s rows"}
+        )
+        record.args = ("request-uuid", 3)
+        record.uuid = "request-uuid"
+        record.rows = 3
+        entry = json.loads(log_pipeline.JSONFormatter().format(record))
+        assert entry["uuid"] == "request-uuid"
+        assert entry["logger"] == "app.crud"
+        assert entry["message"] == "request-uuid - Retrieved 3 rows"
+        assert entry["rows"] == 3
+
+    def test_records_tagged_with_request_uuid(self, client_authenticated):
+        target = CollectingHandler()
+        target.addFilter(log_pipeline.RequestUUIDFilter())
+        logger = logging.getLogger("app")
+        level = logger.level
+        logger.addHandler(target)
+        logger.setLevel(logging.DEBUG)
+        try:
+            client_authenticated.get("/rooms/1")
+        finally:
+            logger.removeHandler(target)
+            logger.setLevel(level)
+
+        request_uuid = target.records[0].getMessage().split(" - ")[0]
+        # Including those logged by crud.py on the threadpool
+        assert any(record.name == "app.crud" for record in target.records)
+        assert all(record.uuid == request_uuid for record in target.records)
+
+
+class TestMetrics:
+    def sample(self, text, series):
+        for line in text.splitlines():
+            if line.startswith(series + " "):
+                return float(line.rsplit(" ", 1)[1])
+        return None
+
+    def test_metrics_endpoint(self, client_authenticated, request_data):
+        client_authenticated.post("/register", json=request_data["user_request"])
+        client_authenticated.get("/rooms/1")
+        client_authenticated.get("/not-a-route")
+        client_authenticated.get("/openapi.json")
+
+        response = client_authenticated.get("/metrics")
+        assert response.status_code == 200, response.text
+        assert response.headers["Content-Type"] == (
+            "text/plain; version=0.0.4; charset=utf-8"
+        )
+        text = response.text
+        route = 'method="GET",route="/rooms/{room_id}",status="404"'
+        assert self.sample(text, f"http_request_duration_seconds_count{{{route}}}") >= 1
+        assert self.sample(
+            text, f'http_request_duration_seconds_bucket{{{route},le="+Inf"}}'
+        ) == self.sample(text, f"http_request_duration_seconds_count{{{route}}}")
+        assert (
+            self.sample(
+                text,
+                'http_request_duration_seconds_count{method="GET",route="unmatched",status="404"}',
+            )
+            >= 1
+        )
+        assert (
+            self.sample(
+                text,
+                'http_request_duration_seconds_count{method="GET",route="/openapi.json",status="200"}',
+            )
+            >= 1
+        )
+        assert self.sample(text, "http_requests_in_flight") == 1
+        assert (
+            self.sample(text, 'db_statement_duration_seconds_count{statement="SELECT"}')
+            >= 1
+        )
+        assert (
+            self.sample(
+                text,
+                'password_hash_duration_seconds_count{function="get_hashed_password"}',
+            )
+            >= 1
+        )
+        assert (
+            self.sample(text, 'db_pool_connections{engine="sync",state="checked_out"}')
+            is not None
+        )
+
+    def test_histogram_shards_per_thread(self):
+        histogram = metrics.Histogram("test_seconds", "Test", ("name",), (0.25, 1))
+        threads = [
+            threading.Thread(target=histogram.observe, args=(value, ("test",)))
+            for value in (0.125, 0.5, 4)
+        ]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        histogram.observe(0.25, ("test",))
+
+        family = histogram.collect()
+        assert family["series"] == [[["test"], [2, 1, 1, 4.875]]]
+        # The shards of finished threads are folded together
+        assert len(histogram._shards) == 1
+        assert histogram.collect() == family
+        assert metrics.render([family]).splitlines()[2:] == [
+            'test_seconds_bucket{name="test",le="0.25"} 2',
+            'test_seconds_bucket{name="test",le="1"} 3',
+            'test_seconds_bucket{name="test",le="+Inf"} 4',
+            'test_seconds_sum{name="test"} 4.875',
+            'test_seconds_count{name="test"} 4',
+        ]
+
+    def test_workers_are_aggregated(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+        monkeypatch.setattr(metrics, "METRICS", [])
+        monkeypatch.setattr(metrics, "COLLECTORS", [])
+        counter = metrics.Counter("test_total", "Test", ("name",))
+        gauge = metrics.Gauge("test_in_flight", "Test")
+        metrics.METRICS.extend([counter, gauge])
+        counter.inc(("test",), 2)
+        gauge.inc()
+
+        exited = subprocess.Popen(["true"])
+        exited.wait()
+        for pid in (os.getppid(), exited.pid):
+            content = {"pid": pid, "families": metrics.collect()}
+            (tmp_path / f"worker-{pid}.json").write_text(json.dumps(content))
+        metrics.write_worker_metrics()
+
+        families = {family["name"]: family for family in metrics.collect_all()}
+        # Counters of exited workers are kept, but not their gauges
+        assert families["test_total"]["series"] == [[["test"], [6]]]
+        assert families["test_in_flight"]["series"] == [[[], [2]]]
+
+
+class TestPrincipalCache:
+    def test_cache_expires_and_evicts(self):
+        cache = principal_cache.PrincipalCache(max_size=2, ttl=30)
+        users = [
+            schemas.User(id=id, username=f"user{id}", email=f"user{id}@test.com")
+            for id in range(3)
+        ]
+        for id, user in enumerate(users):
+            cache.put(f"token{id}", user)
+        cache.put("expired", users[0], token_expires_at=time.time() - 1)
+
+        assert cache.get("token0") is None
+        assert cache.get("token1") == users[1]
+        assert cache.get("expired") is None
+        assert cache.statistics()["hits"] == 1
+        assert cache.statistics()["misses"] == 2
+
+    def test_user_changes_invalidate_cache(self, client_authenticated, request_data):
+        response = client_authenticated.post(
+            "/register", json=request_data["user_request"]
+        )
+        user = schemas.User(**response.json())
+        principal_cache.cache.put("token", user)
+
+        response = client_authenticated.patch(f"/users/{user.id}", json={"admin": True})
+        assert response.status_code == 200, response.text
+        assert principal_cache.cache.get("token") is None
+
+        response = client_authenticated.get("/admin/auth-cache")
+        assert response.status_code == 200, response.text
+        assert response.json()["misses"] >= 1
+
+
+class TestResponseCache:
+    def test_cache_expires_and_evicts(self):
+        cache = response_cache.ResponseCache(max_size=2, ttl=30)
+        cache.put("/rooms", "first", ["Room 1"], tables=(models.Room,))
+        cache.put("/desks", "first", ["Desk 1"], tables=(models.Desk,))
+        cache.put("/rooms", "second", ["Room 2"], tables=(models.Room,))
+
+        assert cache.get("/rooms", "first") is None
+        assert cache.get("/desks", "first") == ["Desk 1"]
+        cache.invalidate_model(models.Desk)
+        assert cache.get("/desks", "first") is None
+        assert cache.get("/rooms", "second") == ["Room 2"]
+
+        expired = response_cache.ResponseCache(max_size=2, ttl=0)
+        expired.put("/rooms", "first", ["Room 1"], tables=(models.Room,))
+        assert expired.get("/rooms", "first") is None
+
+    def test_writes_invalidate_cache(self, client_authenticated):
+        response = client_authenticated.post("/rooms", json={"name": "Cached Room"})
+        assert response.status_code == 200, response.text
+        room_id = response.json()["id"]
+        lookups = response_cache.cache.statistics()["routes"].get(
+            "/rooms", {"hits": 0, "misses": 0}
+        )
+
+        for _ in range(2):
+            response = client_authenticated.get("/rooms")
+            assert response.status_code == 200, response.text
+            assert response.json() == [{"id": room_id, "name": "Cached Room"}]
+            assert response.headers["Content-Range"] == "rooms 0-0/1"
+
+        response = client_authenticated.patch(
+            f"/rooms/{room_id}", json={"name": "Renamed Room"}
+        )
+        assert response.status_code == 200, response.text
+        response = client_authenticated.get("/rooms")
+        assert response.json() == [{"id": room_id, "name": "Renamed Room"}]
+
+        response = client_authenticated.get("/admin/response-cache")
+        assert response.status_code == 200, response.text
+        data = response.json()["routes"]["/rooms"]
+        assert data["hits"] == lookups["hits"] + 1
+        assert data["misses"] == lookups["misses"] + 2
+
+
+class TestConditionalRequests:
+    def test_unchanged_rooms_are_not_modified(self, client_authenticated):
+        client_authenticated.post("/rooms", json={"name": "Versioned Room"})
+        response = client_authenticated.get("/rooms")
+        assert response.status_code == 200, response.text
+        etag = response.headers["ETag"]
+
+        response = client_authenticated.get("/rooms", headers={"If-None-Match": etag})
+        assert response.status_code == 304, response.text
+        assert response.content == b""
+        assert response.headers["ETag"] == etag
+
+        client_authenticated.post("/rooms", json={"name": "Another Room"})
+        response = client_authenticated.get("/rooms", headers={"If-None-Match": etag})
+        assert response.status_code == 200, response.text
+        assert response.headers["ETag"] != etag
+        assert len(response.json()) == 2
+
+    def test_room_bookings_versioned_by_date(
+        self, client_authenticated, request_data, monkeypatch
+    ):
+        client_authenticated.post("/register", json=request_data["user_request"])
+        client_authenticated.post("/rooms", json=request_data["room_request"])
+        for desk in request_data["desk_request_multiple"]:
+            client_authenticated.post("/desks", json=desk)
+        response = client_authenticated.get("/rooms/1/bookings/2020-05-17")
+        etag = response.headers["ETag"]
+
+        client_authenticated.post(
+            "/bookings", json={**request_data["booking_request"], "date": "2020-05-18"}
+        )
+        response = client_authenticated.get(
+            "/rooms/1/bookings/2020-05-17", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 304, response.text
+
+        # Answered without querying the bookings
+        def get_bookings_by_room(**kwargs):
+            raise AssertionError("Bookings were queried")
+
+        monkeypatch.setattr(crud, "get_bookings_by_room", get_bookings_by_room)
+        response = client_authenticated.get(
+            "/rooms/1/bookings/2020-05-17", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 304, response.text
+        monkeypatch.undo()
+
+        client_authenticated.post("/bookings", json=request_data["booking_request"])
+        response = client_authenticated.get(
+            "/rooms/1/bookings/2020-05-17", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 200, response.text
+        assert len(response.json()) == 1
+
+
+class TestFastJSON:
+    def test_fast_path_matches_response_model(
+        self, client_authenticated, request_data, monkeypatch
+    ):
+        client_authenticated.post("/register", json=request_data["user_request"])
+        client_authenticated.post("/rooms", json=request_data["room_request"])
+        for desk in request_data["desk_request_multiple"]:
+            client_authenticated.post("/desks", json=desk)
+        client_authenticated.post("/bookings", json=request_data["booking_request"])
+        openapi = client_authenticated.get("/openapi.json").json()
+        paths = (
+            "/users?range=0&range=9",
+            "/desks?range=0&range=9",
+            "/bookings?range=0&range=9",
+            "/bookings?limit=2",
+        )
+        expected = [client_authenticated.get(path) for path in paths]
+
+        monkeypatch.setattr(fast_json, "FAST_JSON_RESPONSES", True)
+        for path, expected_response in zip(paths, expected):
+            response = client_authenticated.get(path)
+            assert response.status_code == 200, response.text
+            assert response.json() == expected_response.json()
+            assert response.headers["Content-Range"] == (
+                expected_response.headers["Content-Range"]
+            )
+        assert client_authenticated.get("/openapi.json").json() == openapi
+
+    def test_encode_without_orjson(self, monkeypatch):
+        row = {"id": 1, "date": datetime.date(2020, 5, 17), "approved_status": True}
+        encoded = fast_json.encode([row])
+        monkeypatch.setattr(fast_json, "orjson", None)
+        assert fast_json.encode([row]) == encoded
+        assert json.loads(encoded) == [
+            {"id": 1, "date": "2020-05-17", "approved_status": True}
+        ]
+
+
+class TestPasswordHashingPool:
+    def test_full_pool_fails_fast(
+        self, client_authenticated, request_data, monkeypatch
+    ):
+        pool = hashing.PasswordHashingPool(size=1, queue_limit=0)
+        monkeypatch.setattr(hashing, "pool", pool)
+        try:
+            running = pool.submit(time.sleep, 1)
+            response = client_authenticated.post(
+                "/register", json=request_data["user_request"]
+            )
+            assert response.status_code == 503, response.text
+            assert response.headers["Retry-After"] == "1"
+            assert pool.statistics()["rejected"] == 1
+
+            running.result()
+            # The slot is released by a callback which can run just after result() returns
+            while pool.statistics()["in_flight"]:
+                time.sleep(0.01)
+            response = client_authenticated.post(
+                "/register", json=request_data["user_request"]
+            )
+            assert response.status_code == 200, response.text
+        finally:
+            pool.shutdown()
+
+    def test_verify_password_is_awaited(self, monkeypatch):
+        pool = hashing.PasswordHashingPool(size=1, queue_limit=0)
+        monkeypatch.setattr(hashing, "pool", pool)
+        hashed_password = security.get_hashed_password("testpass")
+
+        async def verify():
+            verification = asyncio.ensure_future(
+                hashing.verify_password("testpass", hashed_password)
+            )
+            # The event loop keeps running while the pool verifies the password
+            ticks = 0
+            while not verification.done():
+                ticks += 1
+                await asyncio.sleep(0.01)
+            return ticks, verification.result()
+
+        try:
+            ticks, verified = asyncio.run(verify())
+        finally:
+            pool.shutdown()
+        assert verified
+        assert ticks > 0
+
+
+class TestRateLimitStorage:
+    def check_sliding_window(self, first_worker, second_worker):
+        limiter = strategies.MovingWindowRateLimiter(first_worker)
+        other_limiter = strategies.MovingWindowRateLimiter(second_worker)
+        limit = parse("3/minute")
+
+        assert limiter.hit(limit, "127.0.0.1")
+        assert other_limiter.hit(limit, "127.0.0.1")
+        assert limiter.hit(limit, "127.0.0.1")
+        # The limit is shared by both workers
+        assert not other_limiter.hit(limit, "127.0.0.1")
+        assert other_limiter.hit(limit, "127.0.0.2")
+
+        first_worker.reset()
+        assert other_limiter.hit(limit, "127.0.0.1")
+        assert other_limiter.hit(limit, "127.0.0.1")
+        assert other_limiter.hit(limit, "127.0.0.1")
+        assert not limiter.hit(limit, "127.0.0.1")
+        limiter.clear(limit, "127.0.0.1")
+        assert limiter.hit(limit, "127.0.0.1")
+
+    def test_shared_memory_storage(self, tmp_path):
+        uri = f"shm://{tmp_path}/rate-limits"
+        first_worker = storage_from_string(uri, slots=64)
+        second_worker = storage_from_string(uri, slots=64)
+        assert isinstance(first_worker, rate_limiting.SharedMemoryStorage)
+        self.check_sliding_window(first_worker, second_worker)
+
+    def test_resp_storage(self, resp_server):
+        uri = "resp://%s:%d" % resp_server
+        first_worker = storage_from_string(uri)
+        second_worker = storage_from_string(uri)
+        assert first_worker.check()
+        self.check_sliding_window(first_worker, second_worker)
+
+    def make_request(self, headers={}, query_string=b""):
+        return Request(
+            {
+                "type": "http",
+                "client": ("10.0.0.1", 5000),
+                "headers": [
+                    (name.lower().encode(), value.encode())
+                    for name, value in headers.items()
+                ],
+                "query_string": query_string,
+            }
+        )
+
+    def test_rate_limit_key(self):
+        token = jwt.encode(
+            {"sub": "gfgf", "uid": 5, "exp": time.time() + 60},
+            security.SECRET_KEY,
+            algorithm=security.ALGORITHM,
+        )
+        request = self.make_request({"Authorization": f"Bearer {token}"})
+        assert rate_limiting.rate_limit_key(request) == "user:5"
+        # Invalid tokens are limited by IP address
+        request = self.make_request({"Authorization": "Bearer not-a-token"})
+        assert rate_limiting.rate_limit_key(request) == "ip:10.0.0.1"
+        assert rate_limiting.rate_limit_key(self.make_request()) == "ip:10.0.0.1"
+
+    def test_list_cost(self):
+        assert rate_limiting.list_cost(self.make_request()) == 20
+        request = self.make_request(query_string=b"range=0&range=9")
+        assert rate_limiting.list_cost(request) == 1
+        request = self.make_request(query_string=b"limit=250")
+        assert rate_limiting.list_cost(request) == 3
+        # The second value of a range is the number of rows, not the last row
+        request = self.make_request(query_string=b"range=99990&range=100000")
+        assert rate_limiting.list_cost(request) == 20
+        request = self.make_request(query_string=b"range=99990&range=150")
+        assert rate_limiting.list_cost(request) == 2
+
+    def test_expensive_endpoints_share_budget(self, client_authenticated):
+        # Each export costs 20 of the 120 per minute
+        for _ in range(6):
+            response = client_authenticated.get("/bookings/export")
+            assert response.status_code == 200, response.text
+        response = client_authenticated.get("/bookings/export")
+        assert response.status_code == 429, response.text
+        response = client_authenticated.get("/users")
+        assert response.status_code == 429, response.text
+        # Light reads have their own limits
+        response = client_authenticated.get("/rooms/1")
+        assert response.status_code != 429, response.text
+
+
+class TestAdminEndpoints:
+    def test_get_pool_status(self, client_authenticated):
+        response = client_authenticated.get("/admin/pool")
+        assert response.status_code == 200, response.text
+        data = response.json()["sync"]
+        assert data["checked_out"] >= 0
+        assert data["idle"] >= 0
+        assert data["wait_histogram_ms"]["+Inf"] == data["wait_count"]